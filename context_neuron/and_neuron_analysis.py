@@ -38,16 +38,7 @@ german_data = haystack_utils.load_json_data("data/german_europarl.json")[:200]
 common_tokens = haystack_utils.get_common_tokens(german_data, model, all_ignore, k=100)
 
 # Sort tokens into new word vs continuation
-new_word_tokens = []
-continuation_tokens = []
-for token in common_tokens:
-    str_token = model.to_single_str_token(token.item())
-    if str_token.startswith(" "):
-        new_word_tokens.append(token)
-    else:
-        continuation_tokens.append(token)
-new_word_tokens = torch.stack(new_word_tokens)
-continuation_tokens = torch.stack(continuation_tokens)
+new_word_tokens, continuation_tokens = haystack_utils.split_tokens_with_space(common_tokens, model)
 
 context_direction = model.W_out[3, 669, :]
 
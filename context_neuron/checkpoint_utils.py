@@ -0,0 +1,59 @@
+import os
+from pathlib import Path
+from typing import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from transformer_lens import HookedTransformer
+from transformer_lens.loading_from_pretrained import get_checkpoint_labels
+
+
+def get_num_checkpoints(model_name: str) -> int:
+    """Number of training checkpoints available for the model, without downloading any of them."""
+    checkpoint_labels, _ = get_checkpoint_labels(model_name)
+    return len(checkpoint_labels)
+
+
+def iterate_checkpoint_models(
+    model_name: str, checkpoints: list[int], get_model: Callable[[str, int], HookedTransformer]
+) -> Iterator[tuple[int, HookedTransformer]]:
+    """Yields (checkpoint, model) for each checkpoint while the next checkpoint is loaded on a background thread.
+    At most two models are held in memory at a time."""
+    if len(checkpoints) == 0:
+        return
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_model = executor.submit(get_model, model_name, checkpoints[0])
+        for i, checkpoint in enumerate(checkpoints):
+            model = next_model.result()
+            if i + 1 < len(checkpoints):
+                next_model = executor.submit(get_model, model_name, checkpoints[i + 1])
+            yield checkpoint, model
+            del model
+
+
+def get_partition_path(output_dir: Path, name: str, checkpoint: int, layer: int | None = None) -> Path:
+    file_name = f"checkpoint_{checkpoint}.parquet" if layer is None else f"checkpoint_{checkpoint}_layer_{layer}.parquet"
+    return Path(output_dir).joinpath(name, file_name)
+
+
+def partition_exists(output_dir: Path, name: str, checkpoint: int, layer: int | None = None) -> bool:
+    return get_partition_path(output_dir, name, checkpoint, layer).exists()
+
+
+def save_partition(df: pd.DataFrame, output_dir: Path, name: str, checkpoint: int, layer: int | None = None) -> None:
+    """Writes the result for one (checkpoint, layer) to its own parquet file. The file is written under a temporary name
+    and renamed, so a crash never leaves a partial partition that would be skipped on restart."""
+    path = get_partition_path(output_dir, name, checkpoint, layer)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(".parquet.tmp")
+    df.to_parquet(temp_path, index=False)
+    os.replace(temp_path, path)
+
+
+def load_partitions(output_dir: Path, name: str) -> pd.DataFrame:
+    """Concatenates all saved partitions of a result in checkpoint and layer order."""
+    def sort_key(path: Path):
+        return tuple(int(part) for part in path.stem.split("_")[1::2])
+
+    paths = sorted(Path(output_dir).joinpath(name).glob("*.parquet"), key=sort_key)
+    return pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True)
@@ -22,6 +22,7 @@ from nltk import ngrams
 from neel_plotly import *
 import haystack_utils
 import probing_utils
+import checkpoint_utils
 
 
 SEED = 42
@@ -84,17 +85,12 @@ def eval_prompts(prompts, model, pos=-1):
     return loss
 
 
-def deactivate_neurons_hook(value, hook):
-    value[:, :, NEURON] = MEAN_ACTIVATION_INACTIVE
-    return value
-deactivate_neurons_fwd_hooks=[(f'blocks.{LAYER}.mlp.hook_post', deactivate_neurons_hook)]
-
-
 def get_ngram_losses(
     model: HookedTransformer,
     checkpoint: int,
     ngrams: list[str],
     common_tokens: list[str],
+    deactivate_neurons_fwd_hooks: list[tuple],
 ) -> pd.DataFrame:
     data = []
     for ngram in ngrams:
@@ -152,7 +148,6 @@ def eval_loss(model, data, mean=True):
 
 
 def eval_checkpoint(model: HookedTransformer, probe_df: pd.DataFrame, german_data: list[str], checkpoint: int, layer: int, neuron: int):
-    model = get_model(checkpoint)
     german_loss = eval_loss(model, german_data)
     f1, mcc = probe_df[(probe_df['Checkpoint']==checkpoint)&(probe_df['Layer']==layer)&(probe_df['Neuron']==neuron)][['F1', 'MCC']].values[0]
     return [checkpoint, german_loss, f1, mcc]
@@ -180,9 +175,8 @@ def build_dfs(
         model_name: HookedTransformer,
         lang_data: dict,
         probe_df: pd.DataFrame,
-        num_checkpoints: int 
-        layer: int,
-        neuron: int,
+        num_checkpoints: int,
+        neurons: list[tuple[int, int]],
         ngrams: bool, 
         dla: bool, 
         lang_losses: bool, 
@@ -199,29 +193,53 @@ def build_dfs(
     common_tokens = get_common_tokens(temp_model, german_data)
     random_trigrams = get_random_trigrams(temp_model, german_data)
 
-    ngram_loss_dfs = []
-    context_neuron_data = []
-    logit_atts = []
-
-    for checkpoint in tqdm(range(num_checkpoints)):
-        model = get_model(checkpoint)
-
-        ngram_loss_dfs.append(
-            get_ngram_losses(model, checkpoint, random_trigrams, common_tokens)
-        )
-
-        data = eval_checkpoint(model, probe_df, german_data, checkpoint, layer, neuron)
-        with model.hooks(deactivate_neurons_fwd_hooks):
-            german_ablated_loss = eval_loss(model, german_data)
-        non_german_loss = eval_loss(model, non_german_data)
-        data.extend([german_ablated_loss, non_german_loss])
-        context_neuron_data.append(data)
-
-        logit_attribution, labels = haystack_utils.pos_batch_DLA(german_data, model)
-        logit_atts.append(logit_attribution.cpu().numpy())
+    # Results are saved per checkpoint and neuron, the context neuron partition last, so a rerun skips finished work
+    partition_dirs = {(layer, neuron): save_path.joinpath("checkpoint_eval", f"L{layer}N{neuron}") for layer, neuron in neurons}
+    checkpoints = [
+        checkpoint for checkpoint in range(num_checkpoints)
+        if not all(checkpoint_utils.partition_exists(partition_dir, "context_neuron", checkpoint) for partition_dir in partition_dirs.values())
+    ]
 
-    context_neuron_df = pd.DataFrame(context_neuron_data, columns=["Checkpoint", "GermanLoss", "F1", "MCC", 'german_ablation_loss', 'non_german_ablation_loss'])
-    context_neuron_df.to_csv(save_path.joinpath("checkpoint_eval.csv"), index=False)
+    for checkpoint, model in tqdm(
+        checkpoint_utils.iterate_checkpoint_models(model_name, checkpoints, get_model), total=len(checkpoints)
+    ):
+        if dla:
+            logit_attribution, labels = haystack_utils.pos_batch_DLA(german_data, model)
+            logit_attribution_df = pd.DataFrame([logit_attribution.cpu().numpy()], columns=labels)
+            logit_attribution_df.insert(0, "Checkpoint", checkpoint)
+        if lang_losses:
+            non_german_loss = eval_loss(model, non_german_data)
+
+        for (layer, neuron), partition_dir in partition_dirs.items():
+            if checkpoint_utils.partition_exists(partition_dir, "context_neuron", checkpoint):
+                continue
+            # The mean inactive activation is measured on the current checkpoint
+            _, deactivate_neurons_fwd_hooks = haystack_utils.get_context_ablation_hooks(layer, [neuron], model)
+
+            data = eval_checkpoint(model, probe_df, german_data, checkpoint, layer, neuron)
+            if lang_losses:
+                with model.hooks(deactivate_neurons_fwd_hooks):
+                    german_ablated_loss = eval_loss(model, german_data)
+                data.extend([german_ablated_loss, non_german_loss])
+            else:
+                data.extend([np.nan, np.nan])
+            context_neuron_df = pd.DataFrame([data], columns=["Checkpoint", "GermanLoss", "F1", "MCC", 'german_ablation_loss', 'non_german_ablation_loss'])
+
+            if ngrams:
+                ngram_loss_df = get_ngram_losses(model, checkpoint, random_trigrams, common_tokens, deactivate_neurons_fwd_hooks)
+                checkpoint_utils.save_partition(ngram_loss_df, partition_dir, "ngram_loss", checkpoint)
+            if dla:
+                checkpoint_utils.save_partition(logit_attribution_df, partition_dir, "dla", checkpoint)
+            checkpoint_utils.save_partition(context_neuron_df, partition_dir, "context_neuron", checkpoint)
+
+    for (layer, neuron), partition_dir in partition_dirs.items():
+        neuron_path = save_path.joinpath(f"L{layer}N{neuron}")
+        neuron_path.mkdir(parents=True, exist_ok=True)
+        checkpoint_utils.load_partitions(partition_dir, "context_neuron").to_csv(neuron_path.joinpath("checkpoint_eval.csv"), index=False)
+        if ngrams:
+            checkpoint_utils.load_partitions(partition_dir, "ngram_loss").to_csv(neuron_path.joinpath("ngram_losses.csv"), index=False)
+        if dla:
+            checkpoint_utils.load_partitions(partition_dir, "dla").to_csv(neuron_path.joinpath("dla.csv"), index=False)
     
 
 def load_probe_data(save_path):
@@ -239,7 +257,7 @@ def analyze_contextual_ngrams(
         save_path: Path
     ):
     set_seeds()
-    num_checkpoints = preload_models(model_name)
+    num_checkpoints = checkpoint_utils.get_num_checkpoints(model_name)
     lang_data = load_language_data()
     probe_df = load_probe_data(save_path)
 
@@ -22,6 +22,7 @@ import plotly.graph_objects as go
 from neel_plotly import *
 import haystack_utils
 import probing_utils
+import checkpoint_utils
 
 # %reload_ext autoreload
 # %autoreload 2
@@ -137,15 +138,17 @@ def get_layer_probe_performance(
     mean_german_activations = german_activations.mean(0).cpu().numpy()
     mean_non_german_activations = non_german_activations.mean(0).cpu().numpy()
 
-    f1s = []
-    mccs = []
-    for neuron in range(model.cfg.d_mlp):
-        f1, mcc = train_probe(
-            german_activations[:, neuron].unsqueeze(-1),
-            non_german_activations[:, neuron].unsqueeze(-1),
-        )
-        f1s.append(f1)
-        mccs.append(mcc)
+    # Fit one probe per neuron at once, with the same scaling and split as train_probe
+    labels = torch.cat([torch.ones(len(german_activations)), torch.zeros(len(non_german_activations))]).to(german_activations.device)
+    data = torch.cat([german_activations, non_german_activations]).to(torch.float64)
+    std = data.std(0, unbiased=False)
+    data = (data - data.mean(0)) / torch.where(std == 0, 1, std)
+    train_indices, test_indices = train_test_split(
+        np.arange(len(labels)), test_size=0.2, random_state=SEED
+    )
+    train_indices, test_indices = torch.from_numpy(train_indices), torch.from_numpy(test_indices)
+    weights, intercepts = probing_utils.get_batched_probes(data[train_indices], labels[train_indices])
+    f1s, mccs = probing_utils.get_batched_probe_scores(weights, intercepts, data[test_indices], labels[test_indices])
 
     checkpoint_neuron_labels = [
         f"C{checkpoint}L{layer}N{i}" for i in range(model.cfg.d_mlp)
@@ -214,55 +217,48 @@ def run_probe_analysis(
     lang_data: dict,
     output_dir: Path,
 ) -> None:
-    """Collect several dataframes covering whole layer ablation losses, ngram loss, language losses, and neuron probe performance."""
+    """Collect several dataframes covering whole layer ablation losses, ngram loss, language losses, and neuron probe performance.
+    Each (checkpoint, layer) result is saved as its own parquet partition as soon as it is computed. Rerunning skips saved partitions."""
     model = get_model(model_name, 0)
     n_layers = model.cfg.n_layers
+    del model
 
     german_data = lang_data["de"]
     non_german_data = np.concatenate([lang_data[lang] for lang in lang_data.keys() if lang != "de"])
     np.random.shuffle(non_german_data)
     non_german_data = non_german_data[:200].tolist()
 
-    probe_dfs = []
-    layer_ablation_dfs = []
-    lang_loss_dfs = []
-    with tqdm(total=num_checkpoints * n_layers) as pbar:
-        for checkpoint in range(num_checkpoints):
-            model = get_model(model_name, checkpoint)
-            for layer in range(n_layers):
-                partial_probe_df = get_layer_probe_performance(
-                    model, checkpoint, layer, german_data, non_german_data
-                )
-                probe_dfs.append(partial_probe_df)
+    partition_dir = output_dir.joinpath(model_name + "_checkpoint_features")
 
-                partial_layer_ablation_df = get_layer_ablation_loss(
-                    model, german_data, checkpoint, layer
-                )
+    def is_complete(checkpoint: int, layer: int) -> bool:
+        return all(checkpoint_utils.partition_exists(partition_dir, name, checkpoint, layer) for name in ["probe", "layer_ablation"])
 
-                layer_ablation_dfs.append(partial_layer_ablation_df)
-                lang_loss_dfs.append(get_language_losses(model, checkpoint, lang_data))
-
-                # Save progress to allow for checkpointing the analysis
-                with open(
-                    output_dir.joinpath(model_name + "_checkpoint_features.pkl.gz"), "wb"
-                ) as f:
-                    pickle.dump(
-                        {
-                            "probe": probe_dfs,
-                            "layer_ablation": layer_ablation_dfs,
-                            "lang_loss": lang_loss_dfs,
-                        },
-                        f,
-                    )
+    checkpoints = [
+        checkpoint for checkpoint in range(num_checkpoints)
+        if not checkpoint_utils.partition_exists(partition_dir, "lang_loss", checkpoint)
+        or not all(is_complete(checkpoint, layer) for layer in range(n_layers))
+    ]
+    print(f"Skipping {num_checkpoints - len(checkpoints)} checkpoints with saved results")
 
+    with tqdm(total=len(checkpoints) * n_layers) as pbar:
+        for checkpoint, model in checkpoint_utils.iterate_checkpoint_models(model_name, checkpoints, get_model):
+            if not checkpoint_utils.partition_exists(partition_dir, "lang_loss", checkpoint):
+                checkpoint_utils.save_partition(
+                    get_language_losses(model, checkpoint, lang_data), partition_dir, "lang_loss", checkpoint
+                )
+            for layer in range(n_layers):
+                if not is_complete(checkpoint, layer):
+                    probe_df = get_layer_probe_performance(
+                        model, checkpoint, layer, german_data, non_german_data
+                    )
+                    layer_ablation_df = get_layer_ablation_loss(
+                        model, german_data, checkpoint, layer
+                    )
+                    checkpoint_utils.save_partition(probe_df, partition_dir, "probe", checkpoint, layer)
+                    checkpoint_utils.save_partition(layer_ablation_df, partition_dir, "layer_ablation", checkpoint, layer)
                 pbar.update(1)
 
-    # Open the pickle file
-    with open(output_dir.joinpath(model_name + "_checkpoint_features.pkl.gz"), "rb") as f:
-        data = pickle.load(f)
-
-    # Concatenate the dataframes
-    data = {dfs_name: pd.concat(dfs) for dfs_name, dfs in data.items()}
+    data = {name: checkpoint_utils.load_partitions(partition_dir, name) for name in ["probe", "layer_ablation", "lang_loss"]}
 
     # Compress with gzip using high compression and save
     with gzip.open(
@@ -274,8 +270,8 @@ def run_probe_analysis(
 def analyze_model_checkpoints(model_name: str, output_dir: Path) -> None:
     set_seeds()
 
-    # Will take about 50GB of disk space for Pythia 70M models
-    num_checkpoints = preload_models(model_name)
+    # Checkpoints are downloaded as the analysis reaches them, about 50GB of disk space for Pythia 70M models
+    num_checkpoints = checkpoint_utils.get_num_checkpoints(model_name)
 
     # Load probe data
     lang_data = load_language_data()
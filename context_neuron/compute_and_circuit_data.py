@@ -45,16 +45,7 @@ german_data = haystack_utils.load_json_data("data/german_europarl.json")[:200]
 common_tokens = haystack_utils.get_common_tokens(german_data, model, all_ignore, k=100)
 
 # Sort tokens into new word vs continuation
-new_word_tokens = []
-continuation_tokens = []
-for token in common_tokens:
-    str_token = model.to_single_str_token(token.item())
-    if str_token.startswith(" "):
-        new_word_tokens.append(token)
-    else:
-        continuation_tokens.append(token)
-new_word_tokens = torch.stack(new_word_tokens)
-continuation_tokens = torch.stack(continuation_tokens)
+new_word_tokens, continuation_tokens = haystack_utils.split_tokens_with_space(common_tokens, model)
 
 # %%
 # all_prompts = {}
@@ -76,97 +67,9 @@ PROMPT_START, PROMPT_END = 2000, 3000
 file_name_append = "_2000"
 # %%
 def compute_and_conditions(option, type: Literal["logits", "loss"]):
-    ANSWER_TOKEN_ID = model.to_tokens(option).flatten()[-1].item()
     prompts = all_prompts[option][PROMPT_START:PROMPT_END]
-    multiplier = 1 if type == "loss" else -1
-
-    def get_value(prompts, activated=False):
-        if activated:
-            if type == "logits":
-                _, _, _, value = haystack_utils.get_direct_effect(prompts, model, 
-                        context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks,
-                        return_type=type, pos=-2)
-                return value[:, ANSWER_TOKEN_ID].mean().item()
-            elif type == "loss":
-                _, _, _, value = haystack_utils.get_direct_effect(prompts, model, 
-                        context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks,
-                        return_type=type, pos=-1)
-                return value.mean().item()
-        with model.hooks(fwd_hooks=deactivate_neurons_fwd_hooks):
-            if type == "logits":
-                return model(prompts, return_type="logits", loss_per_token=True)[:, -2, ANSWER_TOKEN_ID].mean().item()
-            elif type == "loss":
-                return model(prompts, return_type="loss", loss_per_token=True)[:, -1].mean().item()
-
-    
-    # COMPUTE AND CONDITIONS
-    ablated_prompts_ny = haystack_utils.create_ablation_prompts(prompts, "NYY", common_tokens)
-    ablated_prompts_yn = haystack_utils.create_ablation_prompts(prompts, "YNY", common_tokens)
-    ablated_prompts_nn = haystack_utils.create_ablation_prompts(prompts, "NNY", common_tokens)
-
-    yyy_value = get_value(prompts, activated=True)
-    nyy_value = get_value(ablated_prompts_ny, activated=True)
-    yny_value = get_value(ablated_prompts_yn, activated=True)
-    nny_value = get_value(ablated_prompts_nn, activated=True)
-
-    yyn_value = get_value(prompts, activated=False)
-    nyn_value = get_value(ablated_prompts_ny, activated=False)
-    ynn_value = get_value(ablated_prompts_yn, activated=False)
-    nnn_value = get_value(ablated_prompts_nn, activated=False)
-
-    # Fix current token
-    yyn_nyn_diff = (nyn_value - yyn_value) * multiplier
-    nyy_nyn_diff = (nyn_value - nyy_value) * multiplier
-    yyy_nyn_diff =  (nyn_value - yyy_value) * multiplier
-    current_diffs = yyy_nyn_diff - (yyn_nyn_diff + nyy_nyn_diff)
-
-    # Fix previous token
-    yyn_ynn_diff = (ynn_value - yyn_value) * multiplier
-    yny_ynn_diff = (ynn_value - yny_value) * multiplier
-    yyy_ynn_diff =  (ynn_value - yyy_value) * multiplier
-    previous_diffs = yyy_ynn_diff - (yyn_ynn_diff + yny_ynn_diff)
-
-    # Fix context neuron
-    yyy_nny_diff = (nny_value - yyy_value) * multiplier
-    nyy_nny_diff = (nny_value - nyy_value) * multiplier 
-    yny_nny_diff =  (nny_value - yny_value) * multiplier
-    context_diffs = yyy_nny_diff - (nyy_nny_diff + yny_nny_diff)
-
-    # All groups of two features
-    nyy_nnn_diff = (nnn_value - nyy_value) * multiplier
-    yny_nnn_diff = (nnn_value - yny_value) * multiplier
-    yyn_nnn_diff = (nnn_value - yyn_value) * multiplier
-    # Individual features
-    nny_nnn_diff = (nnn_value - nny_value) * multiplier
-    nyn_nnn_diff = (nnn_value - nyn_value) * multiplier
-    ynn_nnn_diff = (nnn_value - ynn_value) * multiplier
-    # Loss increase for all features
-    yyy_nnn_diff = (nnn_value - yyy_value) * multiplier
-
-    individual_diffs = yyy_nnn_diff - (nny_nnn_diff + nyn_nnn_diff + ynn_nnn_diff)
-    two_feature_diffs = yyy_nnn_diff - (nyy_nnn_diff + yny_nnn_diff + yyn_nnn_diff)/2
-
-    # Merge current and previous tokens
-    merged_tokens_diff = yyy_nnn_diff - (yyn_nnn_diff + nny_nnn_diff)
-
-    result = {
-        "NNN": nnn_value,
-        "NNY": nny_value,
-        "NYN": nyn_value,
-        "YNN": ynn_value,
-        "NYY": nyy_value,
-        "YNY": yny_value,
-        "YYN": yyn_value,
-        "YYY": yyy_value,
-        "Fix Current": current_diffs,
-        "Fix Previous": previous_diffs,
-        "Fix Context": context_diffs,
-        "Single Feature": individual_diffs,
-        "Two Features": two_feature_diffs,
-        "Merge Tokens": merged_tokens_diff,
-    }
-
-    return result
+    return haystack_utils.compute_and_conditions(prompts, model, option, type, common_tokens,
+                                                 activate_neurons_fwd_hooks, deactivate_neurons_fwd_hooks)
 
 
 #%%
@@ -51,25 +51,21 @@ mean_attention_activations = torch.stack(mean_attention_activations)
 
 # %%
 head_ablation_losses = {}
-names = ["Original"] + [f"L{layer}H{head}" for layer in range(5) for head in range(8)]
+heads = [(layer, head) for layer in range(model.cfg.n_layers) for head in range(model.cfg.n_heads)]
+names = ["Original"] + [f"L{layer}H{head}" for layer, head in heads]
 
 for option in tqdm(options):
     head_ablation_losses[option] = {}
     prompts = all_prompts[option]
     str_tokens = model.to_str_tokens(model.to_tokens(option, prepend_bos=False))
-    for pos in range(1-len(str_tokens), -1, 1):
-        losses = []
-        ablated_pos = str_tokens[pos]
-        for layer in range(6):
-            for head in range(8):
-                ablate_head_hook = [haystack_utils.get_ablate_attention_hook(layer, head, mean_attention_activations, pos=pos)]
-                with model.hooks(fwd_hooks=ablate_head_hook):
-                    loss = model(prompts, return_type="loss", loss_per_token=True)[:, -1].tolist()
-                    losses.append(loss)
+    positions = list(range(1-len(str_tokens), -1, 1))
+    # (position * head, prompt) losses of all heads at all positions of the option
+    losses = haystack_utils.get_head_ablation_losses(prompts, model, mean_attention_activations, heads, positions)
+    losses = losses.reshape(len(positions), len(heads), -1).tolist()
 
-        original_loss = model(prompts, return_type="loss", loss_per_token=True)[:, -1].tolist()
-        all_losses = [original_loss] + losses
-        head_ablation_losses[option][ablated_pos] = all_losses
+    original_loss = model(prompts, return_type="loss", loss_per_token=True)[:, -1].tolist()
+    for i, pos in enumerate(positions):
+        head_ablation_losses[option][str_tokens[pos]] = [original_loss] + losses[i]
 
 # %%
 with open('data/bigram_attention/head_ablation_losses.json', 'w') as f:
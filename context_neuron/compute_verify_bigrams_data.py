@@ -152,28 +152,27 @@ with open('data/verify_bigrams/pos_loss_data.json', 'w') as f:
 # %% 
 
 individual_neuron_loss_diffs = {}
+# Estimate the effect of all neurons with attribution patching and only ablate the top candidates exactly
+USE_ATTRIBUTION_PATCHING = False
+VERIFY_TOP_K = 100
 
 for option in options:
 
     prompts = generate_random_prompts(option, n=100, length=20)
 
-    with model.hooks(deactivate_neurons_fwd_hooks):
-        _, ablated_cache = model.run_with_cache(prompts)
+    ablated_post, activated_post = haystack_utils.get_direct_effect(prompts, model, pos=-1, context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks, return_type="cache")
 
-    def get_ablate_neurons_hook(neuron: int | list[int], ablated_cache, layer=5):
-        def ablate_neurons_hook(value, hook):
-            value[:, :, neuron] = ablated_cache[f'blocks.{layer}.mlp.hook_post'][:, :, neuron]
-            return value
-        return [(f'blocks.{layer}.mlp.hook_post', ablate_neurons_hook)]
+    # Path patched MLP5 neurons: the context neuron is ablated everywhere but MLP5, whose activations come from the activated run
+    def path_patch_mlp5_hook(value, hook):
+        return activated_post["hook_post"]
+    path_patch_hooks = deactivate_neurons_fwd_hooks + [('blocks.5.mlp.hook_post', path_patch_mlp5_hook)]
 
-    diffs = torch.zeros(2048, prompts.shape[0])
-    # Loss with path patched MLP5 neurons
-    _, _, _, baseline_loss = haystack_utils.get_direct_effect(prompts, model, pos=-1, context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks)
-    for neuron in tqdm(range(2048)):
-        ablate_single_neuron_hook = get_ablate_neurons_hook(neuron, ablated_cache)
-        # Loss with path patched MLP5 neurons but a single neuron changed back to original ablated value
-        _, _, _, only_activated_loss = haystack_utils.get_direct_effect(prompts, model, pos=-1, context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks+ablate_single_neuron_hook)
-        diffs[neuron] = only_activated_loss - baseline_loss
+    # Loss with path patched MLP5 neurons but a single neuron changed back to original ablated value, minus the path patched loss
+    if USE_ATTRIBUTION_PATCHING:
+        diffs, top_neurons, exact_diffs = haystack_utils.get_neuron_attribution_patching_effects(prompts, model, ablated_post["hook_post"], path_patch_hooks, layer=5, pos=-1, verify_top_k=VERIFY_TOP_K)
+        diffs[top_neurons] = exact_diffs
+    else:
+        diffs = haystack_utils.get_neuron_patching_losses(prompts, model, torch.arange(model.cfg.d_mlp), ablated_post["hook_post"], path_patch_hooks, layer=5, pos=-1)
 
     individual_neuron_loss_diffs[option] = diffs.mean(1).tolist()
     # sorted_means, indices = torch.sort(diffs.mean(1))
@@ -187,6 +186,7 @@ with open('data/verify_bigrams/neuron_loss_diffs.json', 'w') as f:
 
 top_bottom_neuron_losses = {}
 
+neuron_counts = list(range(1, 26))
 for option in tqdm(options):
     prompts = generate_random_prompts(option, n=200, length=20)
 
@@ -194,42 +194,31 @@ for option in tqdm(options):
     sorted_means, indices = torch.sort(torch.tensor(diffs))
     sorted_means = sorted_means.tolist()
 
-    top_bottom_neuron_losses[option] = {}
-
-    for num_neurons in range(1, 26):
-        # Check loss change when ablating top / bottom neurons
-        top_neurons_count = num_neurons
-        top_neurons = indices[-top_neurons_count:]
-        bottom_neurons = indices[:top_neurons_count]
-
-        with model.hooks(deactivate_neurons_fwd_hooks):
-            ablated_loss, ablated_cache = model.run_with_cache(prompts, return_type="loss")
-
-        ablate_top_neurons_hook = get_ablate_neurons_hook(top_neurons, ablated_cache)
-        ablate_bottom_neurons_hook = get_ablate_neurons_hook(bottom_neurons, ablated_cache)
-
-        original_loss, ablated_loss, _, all_MLP5_loss = haystack_utils.get_direct_effect(prompts, model, pos=-1, context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks)
-        _, _, _, top_MLP5_ablated_loss = haystack_utils.get_direct_effect(prompts, model, pos=-1, context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks+ablate_top_neurons_hook)
-        _, _, _, bottom_MLP5_ablated_loss = haystack_utils.get_direct_effect(prompts, model, pos=-1, context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks+ablate_bottom_neurons_hook)
-
-        names = ["Original", "Ablated", "MLP5 path patched", f"MLP5 path patched + Top {top_neurons_count} MLP5 neurons ablated", f"MLP5 path patched + Bottom {top_neurons_count} MLP5 neurons ablated"]
-        short_names = ["Original", "Ablated", "MLP5 path patched", f"Top MLP5 removed", f"Bottom MLP5 removed"]
+    original_loss, ablated_loss, _, _ = haystack_utils.get_direct_effect(prompts, model, pos=-1, context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks)
+    # Check loss change when ablating top / bottom neurons, all counts from one neuron subset sweep with cached MLP5 activations
+    subset_losses = haystack_utils.get_neuron_subset_metrics(
+        prompts, model, [indices[-num_neurons:] for num_neurons in neuron_counts] + [indices[:num_neurons] for num_neurons in neuron_counts],
+        context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks, pos=-1)
+    all_MLP5_loss = subset_losses[0]
+    top_MLP5_ablated_losses, bottom_MLP5_ablated_losses = subset_losses[1:].split(len(neuron_counts))
 
+    top_bottom_neuron_losses[option] = {}
+    for i, num_neurons in enumerate(neuron_counts):
         top_bottom_neuron_losses[option][num_neurons] = {
             "Original": original_loss.tolist(),
             "Ablated": ablated_loss.tolist(),
             "MLP5 path patched": all_MLP5_loss.tolist(),
-            f"Top MLP5 removed": top_MLP5_ablated_loss.tolist(),
-            f"Bottom MLP5 removed": bottom_MLP5_ablated_loss.tolist()
+            f"Top MLP5 removed": top_MLP5_ablated_losses[i].tolist(),
+            f"Bottom MLP5 removed": bottom_MLP5_ablated_losses[i].tolist()
         }
 
 # %%
 with open('data/verify_bigrams/neuron_loss_data.json', 'w') as f:
     json.dump(top_bottom_neuron_losses, f)
 # %%
-def get_top_difference_neurons(baseline_logprobs, ablated_logprops, positive=True, logprob_threshold=-7, k=50):
-    neuron_logprob_difference = (baseline_logprobs - ablated_logprops).mean(0)
-    neuron_logprob_difference[baseline_logprobs.mean(0) < logprob_threshold] = 0
+def get_top_difference_neurons(mean_logprobs, logprob_difference, positive=True, logprob_threshold=-7, k=50):
+    neuron_logprob_difference = logprob_difference.clone()
+    neuron_logprob_difference[mean_logprobs < logprob_threshold] = 0
     if positive:
         non_zero_count = (neuron_logprob_difference > 0).sum()
     else:
@@ -237,63 +226,50 @@ def get_top_difference_neurons(baseline_logprobs, ablated_logprops, positive=Tru
     top_logprob_difference, top_neurons = haystack_utils.top_k_with_exclude(neuron_logprob_difference, min(non_zero_count, k), all_ignore, largest=positive)
     return top_logprob_difference, top_neurons
 
+def get_boosts(top_logprob_differences: dict[str, tuple[Tensor, Tensor]]):
+    return {
+        name: {
+            "Tokens": [model.to_str_tokens([i])[0] for i in token_indices],
+            "Logprob difference": logprob_differences.tolist()
+        }
+        for name, (logprob_differences, token_indices) in top_logprob_differences.items()
+    }
+
 # %%
-summed_neuron_logprob_boosts = {}
-# Compute summed neuron boosts / deboosts
-for option in options: 
-    summed_neuron_logprob_boosts[option] = {}
+# Logprob differences from resetting the top / bottom num_neurons neurons and each of the top / bottom 25 neurons
+# to their ablated values, all from one neuron subset sweep per option
+neuron_sweeps = {}
+for option in tqdm(options):
     prompts = generate_random_prompts(option, n=200, length=20)
 
     diffs = individual_neuron_loss_diffs[option]
     sorted_means, indices = torch.sort(torch.tensor(diffs))
-    sorted_means = sorted_means.tolist()
 
-    for num_neurons in tqdm(range(1, 26)):
-        
-        summed_neuron_logprob_boosts[option][num_neurons] = {}
-        summed_neuron_logprob_boosts[option][num_neurons]["Top"] = {}
-        summed_neuron_logprob_boosts[option][num_neurons]["Bottom"] = {}
-
-        top_neurons = indices[-num_neurons:]
-        bottom_neurons = indices[:num_neurons]
-
-        with model.hooks(deactivate_neurons_fwd_hooks):
-            ablated_logits, ablated_cache = model.run_with_cache(prompts)
-
-        ablate_top_neurons_hook = get_ablate_neurons_hook(top_neurons, ablated_cache)
-        ablate_bottom_neurons_hook = get_ablate_neurons_hook(bottom_neurons, ablated_cache)
-
-        original_logits, ablated_logprobs, _, all_MLP5_logprobs = haystack_utils.get_direct_effect(prompts, model, pos=-2, context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks, return_type='logprobs')
-        _, _, _, top_MLP5_ablated_logprobs = haystack_utils.get_direct_effect(prompts, model, pos=-2, context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks+ablate_top_neurons_hook, return_type='logprobs')
-        _, _, _, bottom_MLP5_ablated_logprobs = haystack_utils.get_direct_effect(prompts, model, pos=-2, context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks+ablate_bottom_neurons_hook, return_type='logprobs')
-            
-        # Boosted tokens
-        bottom_neuron_pos_difference_logprobs, bottom_pos_indices = get_top_difference_neurons(all_MLP5_logprobs, bottom_MLP5_ablated_logprobs, positive=True)
-        top_neuron_pos_difference_logprobs, top_pos_indices = get_top_difference_neurons(all_MLP5_logprobs, top_MLP5_ablated_logprobs, positive=True)
-        # Deboosted tokens
-        bottom_neuron_neg_difference_logprobs, bottom_neg_indices = get_top_difference_neurons(all_MLP5_logprobs, bottom_MLP5_ablated_logprobs, positive=False)
-        top_neuron_neg_difference_logprobs, top_neg_indices = get_top_difference_neurons(all_MLP5_logprobs, top_MLP5_ablated_logprobs, positive=False)
-
-        bottom_pos_tokens = [model.to_str_tokens([i])[0] for i in bottom_pos_indices]
-        top_pos_tokens = [model.to_str_tokens([i])[0] for i in top_pos_indices]
-        bottom_neg_tokens = [model.to_str_tokens([i])[0] for i in bottom_neg_indices]
-        top_neg_tokens = [model.to_str_tokens([i])[0] for i in top_neg_indices]
-
-        summed_neuron_logprob_boosts[option][num_neurons]["Top"]["Boosted"] = {
-            "Tokens": top_pos_tokens,
-            "Logprob difference": top_neuron_pos_difference_logprobs.tolist()
-        }
-        summed_neuron_logprob_boosts[option][num_neurons]["Top"]["Deboosted"] = {
-            "Tokens": top_neg_tokens,
-            "Logprob difference": top_neuron_neg_difference_logprobs.tolist()
-        }
-        summed_neuron_logprob_boosts[option][num_neurons]["Bottom"]["Boosted"] = {
-            "Tokens": bottom_pos_tokens,
-            "Logprob difference": bottom_neuron_pos_difference_logprobs.tolist()
-        }
-        summed_neuron_logprob_boosts[option][num_neurons]["Bottom"]["Deboosted"] = {
-            "Tokens": bottom_neg_tokens,
-            "Logprob difference": bottom_neuron_neg_difference_logprobs.tolist()
+    subsets = {
+        "Top": [indices[-num_neurons:] for num_neurons in neuron_counts],
+        "Bottom": [indices[:num_neurons] for num_neurons in neuron_counts],
+        "Top individual": [indices[[-(neuron_pos+1)]] for neuron_pos in range(25)],
+        "Bottom individual": [indices[[neuron_pos]] for neuron_pos in range(25)],
+    }
+    all_MLP5_logprobs, logprob_differences = haystack_utils.get_neuron_subset_logprob_differences(
+        prompts, model, [neurons for select_subsets in subsets.values() for neurons in select_subsets],
+        context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks)
+    logprob_differences = logprob_differences.split([len(select_subsets) for select_subsets in subsets.values()])
+    neuron_sweeps[option] = {"indices": indices, "all_MLP5_logprobs": all_MLP5_logprobs, **dict(zip(subsets.keys(), logprob_differences))}
+
+# %%
+summed_neuron_logprob_boosts = {}
+# Compute summed neuron boosts / deboosts
+for option in options: 
+    sweep = neuron_sweeps[option]
+    summed_neuron_logprob_boosts[option] = {}
+    for i, num_neurons in enumerate(neuron_counts):
+        summed_neuron_logprob_boosts[option][num_neurons] = {
+            select: get_boosts({
+                "Boosted": get_top_difference_neurons(sweep["all_MLP5_logprobs"], sweep[select][i], positive=True),
+                "Deboosted": get_top_difference_neurons(sweep["all_MLP5_logprobs"], sweep[select][i], positive=False),
+            })
+            for select in ["Top", "Bottom"]
         }
 
 with open('data/verify_bigrams/summed_neuron_boosts.json', 'w') as f:
@@ -303,86 +279,31 @@ with open('data/verify_bigrams/summed_neuron_boosts.json', 'w') as f:
 
 individual_neuron_logprob_boosts = {}
 for option in options: 
+    sweep = neuron_sweeps[option]
     individual_neuron_logprob_boosts[option] = {}
-    prompts = generate_random_prompts(option, n=200, length=20)
-
-    diffs = individual_neuron_loss_diffs[option]
-    sorted_means, indices = torch.sort(torch.tensor(diffs))
-    sorted_means = sorted_means.tolist()
-
-    for neuron_pos in tqdm(range(0, 25)):
-        
+    for neuron_pos in range(0, 25):
         individual_neuron_logprob_boosts[option][neuron_pos] = {}
-
-        top_neurons = indices[-(neuron_pos+1)]
-        bottom_neurons = indices[neuron_pos]
-
-        individual_neuron_logprob_boosts[option][neuron_pos]["Top"] = {"Neuron": top_neurons.item()}
-        individual_neuron_logprob_boosts[option][neuron_pos]["Bottom"] = {"Neuron": bottom_neurons.item()}
-
-        with model.hooks(deactivate_neurons_fwd_hooks):
-            ablated_logits, ablated_cache = model.run_with_cache(prompts)
-
-        ablate_top_neurons_hook = get_ablate_neurons_hook([top_neurons], ablated_cache)
-        ablate_bottom_neurons_hook = get_ablate_neurons_hook([bottom_neurons], ablated_cache)
-
-        original_logits, ablated_logprobs, _, all_MLP5_logprobs = haystack_utils.get_direct_effect(prompts, model, pos=-2, context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks, return_type='logprobs')
-        _, _, _, top_MLP5_ablated_logprobs = haystack_utils.get_direct_effect(prompts, model, pos=-2, context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks+ablate_top_neurons_hook, return_type='logprobs')
-        _, _, _, bottom_MLP5_ablated_logprobs = haystack_utils.get_direct_effect(prompts, model, pos=-2, context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks+ablate_bottom_neurons_hook, return_type='logprobs')
-            
-        # Boosted tokens
-        bottom_neuron_pos_difference_logprobs, bottom_pos_indices = get_top_difference_neurons(all_MLP5_logprobs, bottom_MLP5_ablated_logprobs, positive=True)
-        top_neuron_pos_difference_logprobs, top_pos_indices = get_top_difference_neurons(all_MLP5_logprobs, top_MLP5_ablated_logprobs, positive=True)
-        # Deboosted tokens
-        bottom_neuron_neg_difference_logprobs, bottom_neg_indices = get_top_difference_neurons(all_MLP5_logprobs, bottom_MLP5_ablated_logprobs, positive=False)
-        top_neuron_neg_difference_logprobs, top_neg_indices = get_top_difference_neurons(all_MLP5_logprobs, top_MLP5_ablated_logprobs, positive=False)
-
-        bottom_pos_tokens = [model.to_str_tokens([i])[0] for i in bottom_pos_indices]
-        top_pos_tokens = [model.to_str_tokens([i])[0] for i in top_pos_indices]
-        bottom_neg_tokens = [model.to_str_tokens([i])[0] for i in bottom_neg_indices]
-        top_neg_tokens = [model.to_str_tokens([i])[0] for i in top_neg_indices]
-
-        individual_neuron_logprob_boosts[option][neuron_pos]["Top"]["Boosted"] = {
-            "Tokens": top_pos_tokens,
-            "Logprob difference": top_neuron_pos_difference_logprobs.tolist()
-        }
-        individual_neuron_logprob_boosts[option][neuron_pos]["Top"]["Deboosted"] = {
-            "Tokens": top_neg_tokens,
-            "Logprob difference": top_neuron_neg_difference_logprobs.tolist()
-        }
-        individual_neuron_logprob_boosts[option][neuron_pos]["Bottom"]["Boosted"] = {
-            "Tokens": bottom_pos_tokens,
-            "Logprob difference": bottom_neuron_pos_difference_logprobs.tolist()
-        }
-        individual_neuron_logprob_boosts[option][neuron_pos]["Bottom"]["Deboosted"] = {
-            "Tokens": bottom_neg_tokens,
-            "Logprob difference": bottom_neuron_neg_difference_logprobs.tolist()
-        }
+        for select, neuron in [("Top", sweep["indices"][-(neuron_pos+1)]), ("Bottom", sweep["indices"][neuron_pos])]:
+            logprob_difference = sweep[f"{select} individual"][neuron_pos]
+            individual_neuron_logprob_boosts[option][neuron_pos][select] = {
+                "Neuron": neuron.item(),
+                **get_boosts({
+                    "Boosted": get_top_difference_neurons(sweep["all_MLP5_logprobs"], logprob_difference, positive=True),
+                    "Deboosted": get_top_difference_neurons(sweep["all_MLP5_logprobs"], logprob_difference, positive=False),
+                })
+            }
 
 with open('data/verify_bigrams/individual_neuron_boosts.json', 'w') as f:
     json.dump(individual_neuron_logprob_boosts, f)
 
 # %%
-def get_individual_neuron_logprob_effect(sorted_indices, ablated_cache, neuron_pos=0, top=True, positive=True):
-    if top:
-        neurons = sorted_indices[-(neuron_pos+1)]
-    else:
-        neurons = sorted_indices[neuron_pos]
-    neurons_hook = get_ablate_neurons_hook([neurons], ablated_cache)
-
-    original_logits, ablated_logprobs, _, all_MLP5_logprobs = haystack_utils.get_direct_effect(prompts, model, pos=-2, context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks, return_type='logprobs')
-    _, _, _, neuron_ablated_logprobs = haystack_utils.get_direct_effect(prompts, model, pos=-2, context_ablation_hooks=deactivate_neurons_fwd_hooks, context_activation_hooks=activate_neurons_fwd_hooks+neurons_hook, return_type='logprobs')
-    neuron_difference_logprobs, difference_indices = \
-        get_top_difference_neurons(all_MLP5_logprobs, neuron_ablated_logprobs, positive=positive)
-    
-    return neuron_difference_logprobs, difference_indices
-
 # Sum individual weighted positive / negative effects
-def summed_neuron_differences(ablated_cache, num_neurons=10, top=True, positive=True, k=50):
+def summed_neuron_differences(sweep, num_neurons=10, top=True, positive=True, k=50):
+    individual_differences = sweep["Top individual" if top else "Bottom individual"]
     summed_neuron_diffs = torch.zeros(model.cfg.d_vocab).cuda()
     for neuron_pos in range(num_neurons):
         # It would probably be more principle to do our filtering on the summed diffs instead of per neuron
-        neuron_diff, token_indices = get_individual_neuron_logprob_effect(indices, ablated_cache, neuron_pos=neuron_pos, top=top, positive=positive)
+        neuron_diff, token_indices = get_top_difference_neurons(sweep["all_MLP5_logprobs"], individual_differences[neuron_pos], positive=positive)
         summed_neuron_diffs[token_indices] += neuron_diff
     if positive:
         non_zero_count = (summed_neuron_diffs > 0).sum()
@@ -396,53 +317,17 @@ def summed_neuron_differences(ablated_cache, num_neurons=10, top=True, positive=
 
 summed_split_neuron_logprob_boosts = {}
 for option in options: 
+    sweep = neuron_sweeps[option]
     summed_split_neuron_logprob_boosts[option] = {}
-    prompts = generate_random_prompts(option, n=200, length=20)
-
-    diffs = individual_neuron_loss_diffs[option]
-    sorted_means, indices = torch.sort(torch.tensor(diffs))
-    sorted_means = sorted_means.tolist()
-
-    # Horribly inefficient implementation, previous neurons can be reused
-    for num_neurons in tqdm(range(1, 26)):
-        summed_split_neuron_logprob_boosts[option][num_neurons] = {}
-        summed_split_neuron_logprob_boosts[option][num_neurons]["Top"] = {}
-        summed_split_neuron_logprob_boosts[option][num_neurons]["Bottom"] = {}
-
-        top_neurons = indices[-num_neurons:]
-        bottom_neurons = indices[:num_neurons]
-
-        with model.hooks(deactivate_neurons_fwd_hooks):
-            ablated_logits, ablated_cache = model.run_with_cache(prompts)
-
-        pos_top_logprob_differences, top_pos_indices = summed_neuron_differences(ablated_cache, num_neurons, top=True, positive=True, k=15)
-        neg_top_logprob_differences, top_neg_indices = summed_neuron_differences(ablated_cache, num_neurons, top=True, positive=False, k=15)
-
-        pos_bottom_logprob_differences, bottom_pos_indices = summed_neuron_differences(ablated_cache, num_neurons, top=False, positive=True, k=15)
-        neg_bottom_logprob_differences, bottom_neg_indices = summed_neuron_differences(ablated_cache, num_neurons, top=False, positive=False, k=15)
-
-        bottom_pos_tokens = [model.to_str_tokens([i])[0] for i in bottom_pos_indices]
-        top_pos_tokens = [model.to_str_tokens([i])[0] for i in top_pos_indices]
-        bottom_neg_tokens = [model.to_str_tokens([i])[0] for i in bottom_neg_indices]
-        top_neg_tokens = [model.to_str_tokens([i])[0] for i in top_neg_indices]
-
-        summed_split_neuron_logprob_boosts[option][num_neurons]["Top"]["Boosted"] = {
-            "Tokens": top_pos_tokens,
-            "Logprob difference": pos_top_logprob_differences.tolist()
-        }
-        summed_split_neuron_logprob_boosts[option][num_neurons]["Top"]["Deboosted"] = {
-            "Tokens": top_neg_tokens,
-            "Logprob difference": neg_top_logprob_differences.tolist()
-        }
-        summed_split_neuron_logprob_boosts[option][num_neurons]["Bottom"]["Boosted"] = {
-            "Tokens": bottom_pos_tokens,
-            "Logprob difference": pos_bottom_logprob_differences.tolist()
-        }
-        summed_split_neuron_logprob_boosts[option][num_neurons]["Bottom"]["Deboosted"] = {
-            "Tokens": bottom_neg_tokens,
-            "Logprob difference": neg_bottom_logprob_differences.tolist()
+    for num_neurons in tqdm(neuron_counts):
+        summed_split_neuron_logprob_boosts[option][num_neurons] = {
+            select: get_boosts({
+                "Boosted": summed_neuron_differences(sweep, num_neurons, top=(select == "Top"), positive=True, k=15),
+                "Deboosted": summed_neuron_differences(sweep, num_neurons, top=(select == "Top"), positive=False, k=15),
+            })
+            for select in ["Top", "Bottom"]
         }
     
 with open('data/verify_bigrams/summed_split_neuron_boosts.json', 'w') as f:
     json.dump(summed_split_neuron_logprob_boosts, f)
-# %%
+# %%
\ No newline at end of file
@@ -0,0 +1,162 @@
+"""Columnar store behind the Streamlit pages. Run this file after computing new data/verify_bigrams or data/and_neurons
+results to convert them:
+
+```
+python dashboard_data.py
+```
+
+Every table is written as one parquet file per partition, i.e. per n-gram option (and run for the AND-neuron data). The
+partitions of a table are listed in its index.json, so a page reads only the slice for the current selection.
+"""
+import os
+import json
+import shutil
+from pathlib import Path
+
+import pandas as pd
+
+
+DATA_PATH = Path(__file__).parent / "data"
+STORE_PATH = DATA_PATH / "dashboard"
+RUNS = {"Run 1": "_0000", "Run 2": "_1000", "Run 3": "_2000"}
+
+
+def save_table(partitions: dict[tuple, pd.DataFrame], table: str, partition_cols: list[str], store_path: Path = STORE_PATH):
+    """Replace a table with one parquet file per partition key. Files are written under a temporary name and renamed, and the
+    index is written last, so readers never see a partially written table."""
+    table_path = Path(store_path) / table
+    if table_path.exists():
+        shutil.rmtree(table_path)
+    table_path.mkdir(parents=True)
+    index = {"partition_cols": partition_cols, "partitions": []}
+    for i, (key, df) in enumerate(partitions.items()):
+        path = table_path / f"part_{i}.parquet"
+        df.to_parquet(path.with_suffix(".parquet.tmp"))
+        os.replace(path.with_suffix(".parquet.tmp"), path)
+        index["partitions"].append({"key": list(key), "file": path.name})
+    with open(table_path / "index.json.tmp", "w") as f:
+        json.dump(index, f, indent=4)
+    os.replace(table_path / "index.json.tmp", table_path / "index.json")
+
+
+def load_index(table: str, store_path: Path = STORE_PATH) -> dict:
+    index_path = Path(store_path) / table / "index.json"
+    if not index_path.exists():
+        raise FileNotFoundError(f"Table {table} not found in {store_path}, run dashboard_data.py first")
+    with open(index_path, "r") as f:
+        return json.load(f)
+
+
+def get_partition_keys(table: str, store_path: Path = STORE_PATH) -> list[tuple]:
+    """Partition keys of a table in the order of the source data"""
+    return [tuple(partition["key"]) for partition in load_index(table, store_path)["partitions"]]
+
+
+def load_partition(table: str, *key, store_path: Path = STORE_PATH) -> pd.DataFrame:
+    for partition in load_index(table, store_path)["partitions"]:
+        if tuple(partition["key"]) == key:
+            return pd.read_parquet(Path(store_path) / table / partition["file"])
+    raise KeyError(f"No partition {key} in table {table}")
+
+
+def convert_loss_data(data: dict, key_name: str) -> dict[tuple, pd.DataFrame]:
+    """{option: {key: {name: [loss per prompt]}}} to one (key, name, prompt, loss) frame per option"""
+    partitions = {}
+    for option, option_data in data.items():
+        rows = [
+            (key, name, prompt, loss)
+            for key, losses in option_data.items()
+            for name, prompt_losses in losses.items()
+            for prompt, loss in enumerate(prompt_losses)
+        ]
+        partitions[(option,)] = pd.DataFrame(rows, columns=[key_name, "name", "prompt", "loss"])
+    return partitions
+
+
+def convert_boosts(data: dict, key_name: str) -> dict[tuple, pd.DataFrame]:
+    """{option: {key: {Top/Bottom: {Boosted/Deboosted: {Tokens, Logprob difference}}}}} to one frame per option. The
+    individual neuron boosts also store the neuron of each Top/Bottom entry."""
+    partitions = {}
+    for option, option_data in data.items():
+        rows = []
+        for key, selections in option_data.items():
+            for select, boosts in selections.items():
+                for direction in ["Boosted", "Deboosted"]:
+                    tokens, values = boosts[direction]["Tokens"], boosts[direction]["Logprob difference"]
+                    for rank, (token, value) in enumerate(zip(tokens, values)):
+                        rows.append((int(key), select, boosts.get("Neuron", -1), direction, rank, token, value))
+        partitions[(option,)] = pd.DataFrame(
+            rows, columns=[key_name, "select", "neuron", "direction", "rank", "token", "logprob_difference"]
+        )
+    return partitions
+
+
+def convert_verify_bigrams(data_path: Path = DATA_PATH, store_path: Path = STORE_PATH):
+    def load(name: str):
+        with open(data_path / "verify_bigrams" / f"{name}.json", "r") as f:
+            return json.load(f)
+
+    save_table(convert_loss_data(load("pos_loss_data"), "replace_column"), "pos_loss_data", ["option"], store_path)
+    neuron_loss_diffs = {
+        (option,): pd.DataFrame({"neuron": range(len(diffs)), "loss_diff": diffs}) for option, diffs in load("neuron_loss_diffs").items()
+    }
+    save_table(neuron_loss_diffs, "neuron_loss_diffs", ["option"], store_path)
+    save_table(convert_loss_data(load("neuron_loss_data"), "num_neurons"), "neuron_loss_data", ["option"], store_path)
+    save_table(convert_boosts(load("summed_neuron_boosts"), "num_neurons"), "summed_neuron_boosts", ["option"], store_path)
+    save_table(convert_boosts(load("summed_split_neuron_boosts"), "num_neurons"), "summed_split_neuron_boosts", ["option"], store_path)
+    save_table(convert_boosts(load("individual_neuron_boosts"), "neuron_pos"), "individual_neuron_boosts", ["option"], store_path)
+
+
+def convert_and_neurons(data_path: Path = DATA_PATH, store_path: Path = STORE_PATH):
+    path = data_path / "and_neurons"
+    runs = {run: file_name_append for run, file_name_append in RUNS.items() if (path / f"activation_dfs{file_name_append}.pkl").exists()}
+
+    for type in ["logits", "loss"]:
+        and_conditions = {}
+        for run, file_name_append in RUNS.items():
+            if (path / f"and_conditions_{type}{file_name_append}.csv").exists():
+                df = pd.read_csv(path / f"and_conditions_{type}{file_name_append}.csv")
+                and_conditions[(run,)] = df.rename(columns={"Unnamed: 0": "Value"})
+        save_table(and_conditions, f"and_conditions_{type}", ["run"], store_path)
+
+    activation_dfs = {}
+    ablation_losses = {}
+    for run, file_name_append in runs.items():
+        dfs = pd.read_pickle(path / f"activation_dfs{file_name_append}.pkl")
+        for option, hooks in dfs.items():
+            for hook_name, scales in hooks.items():
+                for scale, df in scales.items():
+                    activation_dfs[(run, option, hook_name, scale)] = df
+
+        with open(path / f"ablation_losses{file_name_append}.json", "r") as f:
+            losses = json.load(f)
+        for option, hooks in losses.items():
+            rows = [
+                (hook_name, scale, include_mode, num_neurons, name, loss)
+                for hook_name, scales in hooks.items()
+                for scale, include_modes in scales.items()
+                for include_mode, num_neurons_losses in include_modes.items()
+                for num_neurons, named_losses in num_neurons_losses.items()
+                for name, loss in named_losses.items()
+            ]
+            ablation_losses[(run, option)] = pd.DataFrame(
+                rows, columns=["hook_name", "scale", "include_mode", "num_neurons", "name", "loss"]
+            )
+    save_table(activation_dfs, "activation_dfs", ["run", "option", "hook_name", "scale"], store_path)
+    save_table(ablation_losses, "ablation_losses", ["run", "option"], store_path)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", type=str, default=str(DATA_PATH))
+    parser.add_argument("--store_path", type=str, default=str(STORE_PATH))
+    args = parser.parse_args()
+
+    if Path(args.data_path).joinpath("verify_bigrams", "pos_loss_data.json").exists():
+        convert_verify_bigrams(Path(args.data_path), Path(args.store_path))
+        print("Converted verify_bigrams data")
+    if Path(args.data_path).joinpath("and_neurons").exists():
+        convert_and_neurons(Path(args.data_path), Path(args.store_path))
+        print("Converted and_neurons data")
@@ -1,12 +1,12 @@
 import warnings
 from transformer_lens import HookedTransformer, ActivationCache, utils
 from transformer_lens.hook_points import HookPoint
-from jaxtyping import Float, Int
+from jaxtyping import Float, Int, Bool
 from torch import Tensor
 import einops
 from tqdm.auto import tqdm
 import torch
-from typing import Callable, List, Tuple, Literal
+from typing import Callable, List, Tuple, Literal, Iterator, Any, Iterable
 import plotly.express as px
 import plotly.graph_objects as go
 import gc
@@ -14,10 +14,13 @@ import numpy as np
 from einops import einsum
 from IPython.display import display, HTML
 import re
+import string
 from pathlib import Path
 import json
+import hashlib
 import pandas as pd
 from collections import defaultdict
+from functools import lru_cache
 from hook_utils import save_activation
 import hook_utils
 
@@ -61,6 +64,64 @@ def pos_batch_neuron_dla(tokens: Int[Tensor, "batch pos"], model: HookedTransfor
     return neuron_dla
 
 
+def get_stop_at_layer(names: list[str]) -> int | None:
+    """Number of blocks that have to run for every hook point in names to be reached, None if one of them is after the last block"""
+    layers = [0]
+    for name in names:
+        if name.startswith("blocks."):
+            layers.append(int(name.split(".")[1]) + 1)
+        elif name not in ["hook_embed", "hook_pos_embed"]:
+            return None
+    return max(layers)
+
+
+def run_with_cache_plan(
+    tokens: Int[Tensor, "batch pos"] | str | list[str],
+    model: HookedTransformer,
+    names: str | Iterable[str] | None,
+    storage: Literal["device", "cpu", "fp16", "cpu_fp16"] = "device",
+    **kwargs,
+) -> tuple[Any, ActivationCache]:
+    """run_with_cache that only caches the hook points an analysis reads, e.g. the components it freezes or patches, instead of every
+    hook point of every layer (names=None). storage="cpu" offloads the cached activations, "fp16" stores them in half precision and
+    "cpu_fp16" does both, so hooks reading from the cache should cast with .to(value). kwargs are passed to the model."""
+    if names is None:
+        names = model.hook_dict.keys()
+    names = {names} if isinstance(names, str) else set(names)
+    device = "cpu" if storage in ["cpu", "cpu_fp16"] else None
+    dtype = torch.float16 if storage in ["fp16", "cpu_fp16"] else None
+    cache = {}
+
+    def cache_hook(value, hook: HookPoint):
+        cache[hook.name] = value.detach().to(device=device, dtype=dtype)
+
+    with model.hooks(fwd_hooks=[(name, cache_hook) for name in names]):
+        output = model(tokens, **kwargs)
+    return output, ActivationCache(cache, model)
+
+
+def get_truncated_cache(
+    tokens: Int[Tensor, "batch pos"] | str | list[str],
+    model: HookedTransformer,
+    names: str | list[str],
+    storage: Literal["device", "cpu", "fp16", "cpu_fp16"] = "device",
+) -> ActivationCache:
+    """run_with_cache for activation extraction. Only caches the given hook points and stops the forward pass after the last block
+    containing one of them, so the later blocks, the final layer norm and the unembedding are never run. See run_with_cache_plan
+    for storage."""
+    names = [names] if isinstance(names, str) else list(names)
+    _, cache = run_with_cache_plan(tokens, model, names, storage, return_type=None, stop_at_layer=get_stop_at_layer(names))
+    return cache
+
+
+def get_decompose_resid_names(model: HookedTransformer) -> list[str]:
+    """Hook points read by ActivationCache.decompose_resid for the residual stream after the last layer"""
+    names = ["hook_embed"]
+    if model.cfg.positional_embedding_type in ["standard", "shortformer"]:
+        names.append("hook_pos_embed")
+    return names + [f"blocks.{layer}.hook_{component}_out" for layer in range(model.cfg.n_layers) for component in ["attn", "mlp"]]
+
+
 def get_mlp_activations(
     prompts: List[str],
     layer: int,
@@ -102,7 +163,7 @@ def get_mlp_activations(
     for i in tqdm(range(num_prompts), disable=disable_tqdm):
         tokens = model.to_tokens(prompts[i])
         with model.hooks([(act_label, save_activation)]):
-            model(tokens)
+            model(tokens, return_type=None, stop_at_layer=layer + 1)
             act = model.hook_dict[act_label].ctx['activation'][:, context_crop_start:context_crop_end, :]
         if pos is not None:
             act = act[:, pos, :].unsqueeze(1)
@@ -132,15 +193,41 @@ def weighted_mean(mean_acts: list[Float[Tensor, "n_acts n_neurons"]], batch_size
     return weighted_mean
 
 
+def get_length_bucketed_batches(
+        prompts: list[str],
+        model: HookedTransformer,
+        batch_size: int,
+        max_length: int | None = None,
+        return_indices: bool = False) -> Iterator[Int[Tensor, "batch pos"]] | Iterator[tuple[list[int], Int[Tensor, "batch pos"]]]:
+    """
+    Tokenizes all prompts in one call, with the same tokens as model.to_tokens, and yields right-padded batches of prompts sorted by length, longest first.
+    Batching prompts of similar length keeps padding to a minimum, and the largest batch is run first so out of memory errors appear immediately.
+    With return_indices, each batch is yielded together with the indices of its prompts in prompts.
+    """
+    max_length = model.cfg.n_ctx if max_length is None else min(max_length, model.cfg.n_ctx)
+    input_ids = model.tokenizer(list(prompts), add_special_tokens=False)["input_ids"]
+    rows = [[model.tokenizer.bos_token_id] + ids[:max_length - 1] for ids in input_ids]
+    order = sorted(range(len(rows)), key=lambda i: len(rows[i]), reverse=True)
+    for i in range(0, len(order), batch_size):
+        indices = order[i:i + batch_size]
+        batch = [rows[index] for index in indices]
+        tokens = torch.full((len(batch), len(batch[0])), model.tokenizer.pad_token_id, dtype=torch.long)
+        for row, ids in enumerate(batch):
+            tokens[row, :len(ids)] = torch.tensor(ids)
+        yield (indices, tokens) if return_indices else tokens
+
+
 def get_average_loss(
         data: list[str], 
         model: HookedTransformer, 
         crop_context=-1, 
         fwd_hooks=[], 
-        positionwise=False):
+        positionwise=False,
+        batch_size: int | None = None):
     """
     Mean over all tokens in the data, not the mean of the mean of each batch. 
     Uses a mask to account for padding tokens, differing prompt lengths, and final tokens not having a loss value.
+    With batch_size set, prompts are run in batches of similar length, see get_length_bucketed_batches.
     """
     if crop_context == -1:
         crop_context = model.cfg.n_ctx
@@ -148,8 +235,13 @@ def get_average_loss(
     position_counts = torch.zeros(model.cfg.n_ctx).cuda()
     position_loss = torch.zeros(model.cfg.n_ctx).cuda()
 
-    for item in data:
-        tokens = model.to_tokens(item)[:, :crop_context].cuda()
+    if batch_size is None:
+        batches = (model.to_tokens(item) for item in data)
+    else:
+        batches = get_length_bucketed_batches(data, model, batch_size, max_length=crop_context)
+
+    for tokens in batches:
+        tokens = tokens[:, :crop_context].cuda()
         loss = model.run_with_hooks(tokens, return_type="loss", loss_per_token=True, fwd_hooks=fwd_hooks) # includes BOS, excludes final token of longest prompt in batch
 
         # Produce a mask of every token which we expect to produce a valid loss value. Excludes padding tokens and the final token of each row.
@@ -171,10 +263,8 @@ def get_average_loss(
         position_counts[0:active_tokens.shape[1]] += active_tokens.sum(dim=0).float()
 
     if positionwise:
-        avg_position_loss = []
-        for i in range(len(position_loss)):
-            avg_position_loss.append((position_loss[i] / position_counts[i]).item() if position_counts[i] != 0 else 0)
-        return avg_position_loss
+        avg_position_loss = torch.where(position_counts != 0, position_loss / position_counts, 0)
+        return avg_position_loss.tolist()
 
     return position_loss.sum() / position_counts.sum()
 
@@ -207,7 +297,7 @@ def get_direct_loss_increase_for_component(
             tokens = model.to_tokens(prompt)
 
         original_loss, _, original_cache, ablated_cache = get_caches_single_prompt(
-            prompt, model, fwd_hooks=fwd_hooks, crop_context_end=crop_context_end, return_type="loss")
+            prompt, model, fwd_hooks=fwd_hooks, crop_context_end=crop_context_end, return_type="loss", names=get_decompose_resid_names(model))
 
         # Applying layer norm here with layer=-1 would apply the final layer's layer norm to the component output we're going to patch.
         # Since we're adding/removing these components from hook_resid_post before the final layer norm is appled, we don't need this.
@@ -257,7 +347,9 @@ def get_caches_single_prompt(
     model: HookedTransformer, 
     fwd_hooks=[], 
     crop_context_end=None,
-    return_type: str = "loss"
+    return_type: str = "loss",
+    names: Iterable[str] | None = None,
+    storage: Literal["device", "cpu", "fp16", "cpu_fp16"] = "device",
 ) -> Tuple[float, float, ActivationCache, ActivationCache]:
     """ Runs the model with and without ablation on a single prompt and returns the caches.
 
@@ -266,6 +358,7 @@ def get_caches_single_prompt(
         model (HookedTransformer): Model to run.
         fwd_hooks (list, optional): Forward hooks to apply during ablation.
         crop_context_end (int, optional): Crops the tokens to the specified length.
+        names (Iterable[str], optional): Hook points to cache, every hook point if None. See run_with_cache_plan for storage.
 
     Returns:
         tuple[float, float, ActivationCache, ActivationCache]: original_loss, ablated_loss, original_cache, ablated_cache.
@@ -277,9 +370,9 @@ def get_caches_single_prompt(
     else:
         tokens = model.to_tokens(prompt)
   
-    original_return_value, original_cache = model.run_with_cache(tokens, return_type=return_type)
+    original_return_value, original_cache = run_with_cache_plan(tokens, model, names, storage, return_type=return_type)
     with model.hooks(fwd_hooks=fwd_hooks):
-        ablated_return_value, ablated_cache = model.run_with_cache(tokens, return_type=return_type)
+        ablated_return_value, ablated_cache = run_with_cache_plan(tokens, model, names, storage, return_type=return_type)
     
     if return_type == "loss":  
         return original_return_value.item(), ablated_return_value.item(), original_cache, ablated_cache
@@ -531,7 +624,7 @@ def get_frozen_loss_difference_for_component(
             tokens = model.to_tokens(prompt)
 
         original_loss, ablated_loss, original_cache, ablated_cache = get_caches_single_prompt(
-            prompt, model, fwd_hooks=ablation_hooks, crop_context_end=crop_context_end, return_type="loss")
+            prompt, model, fwd_hooks=ablation_hooks, crop_context_end=crop_context_end, return_type="loss", names=freeze_act_names)
 
         # ['embed', '0_attn_out', '0_mlp_out', '1_attn_out', '1_mlp_out', '2_attn_out', '2_mlp_out', '3_attn_out', '3_mlp_out', '4_attn_out', '4_mlp_out', '5_attn_out', '5_mlp_out']
         # Ablate at the final residual stream value to remove the direct component output
@@ -707,6 +800,89 @@ def get_ablated_logits(prompt: str, model: HookedTransformer, ablation_hooks, fr
 
     return frozen_logits
 
+
+def get_crop_sweep_losses(
+        prompts: list[str] | Int[Tensor, "batch pos"],
+        model: HookedTransformer,
+        ablation_hooks=[],
+        freeze_act_names=[],
+        freeze_to: Literal["original", "ablated"] = "original",
+        batch_size: int = 8,
+    ) -> tuple[Float[Tensor, "prompt pos"], Float[Tensor, "prompt pos"], Float[Tensor, "prompt pos"]]:
+    """Final token losses of get_frozen_loss_difference_position (freeze_to="original") or get_ablated_loss_difference_position
+    (freeze_to="ablated") for every crop_context_end of every prompt. The model is causal, so with hooks that act on each position
+    independently the final token loss of a prompt cropped to crop_context_end equals the loss at position crop_context_end - 2 of the
+    full prompt, and one forward pass covers all crop points. The original, ablated and frozen runs are stacked variants of that pass,
+    see get_variant_metrics, and string prompts are run in length-bucketed batches, see get_length_bucketed_batches.
+
+    Returns:
+        original, ablated and frozen loss matrices where column j holds crop_context_end = j + 2, NaN past the end of a prompt.
+    """
+    if freeze_to == "original":
+        # Ablated run with the frozen components kept at their original values
+        variants = {"original": [], "ablated": ablation_hooks, "frozen": ablation_hooks}
+    else:
+        # Original run with the frozen components set to their ablated values
+        variants = {"original": [], "ablated": ablation_hooks, "frozen": []}
+    patches = {"frozen": {name: freeze_to for name in freeze_act_names}}
+
+    if isinstance(prompts, Tensor):
+        batches = ((list(range(i, min(i + batch_size, len(prompts)))), prompts[i:i + batch_size]) for i in range(0, len(prompts), batch_size))
+    else:
+        batches = get_length_bucketed_batches(prompts, model, batch_size, return_indices=True)
+
+    losses = None
+    for indices, tokens in batches:
+        tokens = tokens.to(model.cfg.device)
+        loss = get_variant_metrics(tokens, model, variants, patches)
+        # The loss at position j predicts token j + 1
+        loss = torch.where(get_active_token_mask(tokens, model)[:, 1:], loss, float("nan"))
+        if losses is None:
+            # The first batch holds the longest prompts
+            losses = torch.full((len(variants), len(prompts), loss.shape[-1]), float("nan"), device=loss.device)
+        losses[:, indices, :loss.shape[-1]] = loss
+    return losses[0], losses[1], losses[2]
+
+
+def get_left_crop_attention_hooks(model: HookedTransformer, starts: Int[Tensor, "batch"]) -> list[tuple[str, Callable]]:
+    """Attention score hooks that crop row i of a batch to the tokens from starts[i] on, without BOS, by masking the earlier keys of
+    every later query. Queries before starts[i] keep their causal attention so no row attends to nothing; their outputs are never
+    read by the cropped positions. Only equivalent to cropping the tokens for relative positional embeddings."""
+    assert model.cfg.positional_embedding_type in ["rotary", "alibi"], "Left crops in place need relative positional embeddings"
+
+    def left_crop_hook(value, hook: HookPoint):
+        positions = torch.arange(value.shape[-1], device=value.device)
+        row_starts = starts.to(value.device)[:, None, None]
+        cropped = (positions[None, :, None] >= row_starts) & (positions[None, None, :] < row_starts) # [batch query key]
+        return value.masked_fill(cropped[:, None], float("-inf"))
+
+    return [(f"blocks.{layer}.attn.hook_attn_scores", left_crop_hook) for layer in range(model.cfg.n_layers)]
+
+
+def get_left_crop_loss_differences(
+        tokens: Int[Tensor, "batch pos"] | Int[Tensor, "pos"],
+        model: HookedTransformer,
+        fwd_hooks: list,
+        starts: list[int] | None = None,
+        crop_batch_size: int = 32,
+    ) -> Float[Tensor, "batch n_starts"]:
+    """Final token loss difference (ablated - original) of every prompt cropped to tokens[:, start:] for every start, by default -2 to
+    -pos + 1. The crops are stacked copies of the prompts masked with get_left_crop_attention_hooks, so crop_batch_size crops of all
+    prompts and their ablated variants are evaluated in one forward pass."""
+    tokens = tokens.unsqueeze(0) if tokens.dim() == 1 else tokens
+    starts = list(range(-2, -tokens.shape[1], -1)) if starts is None else starts
+    starts = torch.tensor(starts) % tokens.shape[1]
+
+    loss_diffs = []
+    for i in range(0, len(starts), crop_batch_size):
+        crop_starts = starts[i:i + crop_batch_size]
+        crop_hooks = get_left_crop_attention_hooks(model, crop_starts.repeat_interleave(tokens.shape[0]))
+        variants = {"original": crop_hooks, "ablated": crop_hooks + fwd_hooks}
+        original_loss, ablated_loss = get_variant_metrics(tokens.repeat(len(crop_starts), 1), model, variants, pos=-1)
+        loss_diffs.append((ablated_loss - original_loss).reshape(len(crop_starts), tokens.shape[0]).T)
+    return torch.cat(loss_diffs, dim=1)
+
+
 def get_frozen_loss_difference_measure(
         prompt: str,
         model: HookedTransformer,
@@ -923,6 +1099,11 @@ def get_mlp3_4_attribution(prompt: str, model: HookedTransformer, ablation_hooks
         return direct_mlp3_mlp4_loss[0, :]
 
 
+def get_neuron_logit_contribution_names(layer: int) -> list[str]:
+    """Hook points read by get_neuron_logit_contribution"""
+    return [f"blocks.{layer}.mlp.hook_post", "ln_final.hook_scale"]
+
+
 def get_neuron_logit_contribution(cache: ActivationCache, model: HookedTransformer, answer_tokens: Int[Tensor, "batch pos"], layer: int, pos:int | None) -> Float[Tensor, "neuron pos"]:
     # Expects cache from a single example, won't work on batched examples
     # Get per neuron output of MLP layer
@@ -953,7 +1134,7 @@ def MLP_attribution(prompt: str, model: HookedTransformer, fwd_hooks, layer_to_c
         answer_tokens = tokens[:, pos+1] #TODO check
     # Get difference between ablated and unablated neurons' contribution to answer logit
     _, _, original_cache, ablated_cache = get_caches_single_prompt(
-        prompt, model, fwd_hooks)
+        prompt, model, fwd_hooks, names=get_neuron_logit_contribution_names(layer_to_compare))
     original_unembedded = get_neuron_logit_contribution(original_cache, model, answer_tokens, layer=layer_to_compare, pos=pos) # [neuron]
     ablated_unembedded = get_neuron_logit_contribution(ablated_cache, model, answer_tokens, layer=layer_to_compare, pos=pos)
     differences = (original_unembedded - ablated_unembedded).detach().cpu() # [neuron]
@@ -1062,11 +1243,12 @@ def MLP_attribution_4_5(prompt: str, model: HookedTransformer, fwd_hooks, layer_
         answer_tokens = tokens[:, pos+1] #TODO check
 
     # Get difference between ablated and unablated neurons' contribution to answer logit
+    names = get_neuron_logit_contribution_names(layer_to_compare)
     _, _, original_cache, ablated_cache = get_caches_single_prompt(
-        prompt, model, fwd_hooks)
+        prompt, model, fwd_hooks, names=names + ["blocks.4.mlp.hook_pre"])
     
     with model.hooks(fwd_hooks=fwd_hooks+[(f"blocks.4.mlp.hook_pre", lambda value, hook: ablated_cache[hook.name])]):
-        logits, mlp_3_4_disabled_cache = model.run_with_cache(prompt)
+        logits, mlp_3_4_disabled_cache = run_with_cache_plan(prompt, model, names)
 
     mlp_3_4_disabled_unembedded = get_neuron_logit_contribution(mlp_3_4_disabled_cache, model, answer_tokens, layer=layer_to_compare, pos=pos) # [neuron]
     mlp_3_disabled_unembedded = get_neuron_logit_contribution(ablated_cache, model, answer_tokens, layer=layer_to_compare, pos=pos)
@@ -1131,9 +1313,77 @@ def effect_of_context_and_mlp_4_on_neurons_vs_just_context(prompt: str, model:Ho
         return original_loss, total_effect_loss, direct_mlp3_mlp5_loss, direct_mlp3_loss, frozen_loss, frozen_loss_inactive_mlp4, top_diff_neurons, top_diff_neurons_3_4_disabled
 
 
+def get_variant_hooks(variants: dict[str, list[tuple]], batch_size: int, patches: dict[str, dict[str, str]] = {}) -> list[tuple[str, Callable]]:
+    """Combines the hooks of several variants into hooks on a stacked batch, where variant i owns rows [i * batch_size, (i + 1) * batch_size).
+
+    Args:
+        variants (dict[str, list[tuple]]): Forward hooks per variant, each applied to its own slice of the batch only.
+        batch_size (int): Number of rows per variant.
+        patches (dict[str, dict[str, str]], optional): patches[variant][hook_name] = source_variant copies the activation of source_variant
+            at hook_name into variant's slice. Runs after every variant's own hooks at that hook point, in the order of variants, so activations
+            can be frozen to or patched from another variant in the same forward pass instead of a cached run.
+    """
+    variant_names = list(variants.keys())
+    hook_names = {name for hooks in variants.values() for name, _ in hooks} | {name for variant_patches in patches.values() for name in variant_patches}
+
+    def get_variant_hook(hook_name):
+        def variant_hook(value, hook):
+            for i, variant in enumerate(variant_names):
+                for name, fn in variants[variant]:
+                    if name == hook_name:
+                        result = fn(value[i * batch_size:(i + 1) * batch_size], hook)
+                        if result is not None:
+                            value[i * batch_size:(i + 1) * batch_size] = result
+            for i, variant in enumerate(variant_names):
+                source = patches.get(variant, {}).get(hook_name)
+                if source is not None:
+                    j = variant_names.index(source)
+                    value[i * batch_size:(i + 1) * batch_size] = value[j * batch_size:(j + 1) * batch_size]
+            return value
+        return variant_hook
+
+    return [(hook_name, get_variant_hook(hook_name)) for hook_name in hook_names]
+
+
+def get_variant_metrics(
+    prompts: str | list[str] | Int[Tensor, "batch pos"],
+    model: HookedTransformer,
+    variants: dict[str, list[tuple]],
+    patches: dict[str, dict[str, str]] = {},
+    return_type: Literal["loss", "logits"] = "loss",
+    pos: int | None = None,
+    batch_size: int | None = None,
+) -> Float[Tensor, "variant batch pos"] | Float[Tensor, "variant batch pos d_vocab"]:
+    """Evaluates the prompts under every variant (a named list of forward hooks) in a single forward pass per batch by stacking one copy
+    of the batch per variant, see get_variant_hooks. A variant with no hooks is the clean run. Tokens of shape (variant, batch, pos)
+    give each variant its own prompts, e.g. ablated versions of the same prompts.
+
+    Returns:
+        Per token loss or logits indexed by variant in the order of the variants dict. Padding positions are not masked, use get_active_token_mask.
+    """
+    tokens = prompts if isinstance(prompts, Tensor) else model.to_tokens(prompts)
+    if tokens.dim() == 2:
+        tokens = tokens.unsqueeze(0).expand(len(variants), -1, -1)
+    assert tokens.shape[0] == len(variants), "Tokens must be shared by all variants or given per variant"
+    if batch_size is None:
+        batch_size = tokens.shape[1]
+
+    metrics = []
+    for i in range(0, tokens.shape[1], batch_size):
+        batch = tokens[:, i:i + batch_size]
+        with model.hooks(fwd_hooks=get_variant_hooks(variants, batch.shape[1], patches)):
+            metric = model(batch.reshape(-1, batch.shape[-1]), return_type=return_type, loss_per_token=True)
+        metric = metric.reshape(len(variants), batch.shape[1], *metric.shape[1:])
+        if pos is not None:
+            metric = metric[:, :, pos]
+        metrics.append(metric)
+    return torch.cat(metrics, dim=1)
+
+
 def get_direct_effect(prompt: str | list[str], model: HookedTransformer, context_ablation_hooks: list, context_activation_hooks: list, pos: int | None = -1,
                       deactivated_components=("blocks.4.hook_attn_out", "blocks.5.hook_attn_out", "blocks.4.hook_mlp_out"),
-                      activated_components=("blocks.5.hook_mlp_out",), return_type: Literal['logits', 'logprobs', 'loss', "cache"] = 'loss'
+                      activated_components=("blocks.5.hook_mlp_out",), return_type: Literal['logits', 'logprobs', 'loss', "cache"] = 'loss',
+                      cache_storage: Literal["device", "cpu", "fp16", "cpu_fp16"] = "device"
 ):
     """ Direct MLP5 effect
 
@@ -1145,6 +1395,7 @@ def get_direct_effect(prompt: str | list[str], model: HookedTransformer, context
         pos (int | None, optional): _description_. Defaults to -1.
         deactivated_components (tuple, optional): _description_. Defaults to ("blocks.4.hook_attn_out", "blocks.5.hook_attn_out", "blocks.4.hook_mlp_out").
         activated_components (tuple, optional): _description_. Defaults to ("blocks.5.hook_mlp_out",).
+        cache_storage (str, optional): Storage of the cached activations, see run_with_cache_plan.
 
     Returns:
         _type_: _description_
@@ -1154,16 +1405,20 @@ def get_direct_effect(prompt: str | list[str], model: HookedTransformer, context
     # 1. Cache activations and ablated activations
     with model.hooks(fwd_hooks=context_activation_hooks):
         original_metric = model(prompt, return_type=metric_return_type, loss_per_token=True)
+    # Only the frozen and patched components, and the MLP5 activations for return_type "cache", are read from the caches
+    mlp_names = [utils.get_act_name("pre", 5), utils.get_act_name("post", 5)] if return_type == "cache" else []
     with model.hooks(fwd_hooks=context_ablation_hooks):
-        ablated_metric, ablated_cache = model.run_with_cache(prompt, return_type=metric_return_type, loss_per_token=True)
+        ablated_metric, ablated_cache = run_with_cache_plan(
+            prompt, model, [*mlp_names, *deactivated_components], cache_storage, return_type=metric_return_type, loss_per_token=True)
 
     # 2. Activate context neuron, ablate deactivated_components, cache activations    
     def deactivate_components_hook(value, hook: HookPoint):
-        value = ablated_cache[hook.name]
+        value = ablated_cache[hook.name].to(value)
         return value
     deactivate_components_hooks = [(freeze_act_name, deactivate_components_hook) for freeze_act_name in deactivated_components]
     with model.hooks(fwd_hooks=deactivate_components_hooks+context_activation_hooks):
-        context_and_activated_metric, context_and_activated_cache = model.run_with_cache(prompt, return_type=metric_return_type, loss_per_token=True)
+        context_and_activated_metric, context_and_activated_cache = run_with_cache_plan(
+            prompt, model, [*mlp_names, *activated_components], cache_storage, return_type=metric_return_type, loss_per_token=True)
 
     if return_type == "cache":
         pre_ablated_cache = ablated_cache["pre", 5]
@@ -1174,7 +1429,7 @@ def get_direct_effect(prompt: str | list[str], model: HookedTransformer, context
     
     # 3. Deactivate context neuron, patch context neuron into activated_components, deactivate deactivated_components (doesn't matter when looking at MLP5)
     def activate_components_hook(value, hook: HookPoint):
-        value = context_and_activated_cache[hook.name]
+        value = context_and_activated_cache[hook.name].to(value)
         return value         
     activate_components_hooks = [(freeze_act_name, activate_components_hook) for freeze_act_name in activated_components]
     with model.hooks(fwd_hooks=activate_components_hooks+context_ablation_hooks+deactivate_components_hooks):
@@ -1203,6 +1458,194 @@ def get_direct_effect(prompt: str | list[str], model: HookedTransformer, context
         return original_metric[0, :], ablated_metric[0, :], context_and_activated_metric[0, :], only_activated_metric[0, :]
 
 
+def get_neuron_subset_metrics(
+    prompts: Int[Tensor, "batch pos"],
+    model: HookedTransformer,
+    neuron_subsets: list[Int[Tensor, "n_neurons"] | list[int]],
+    context_ablation_hooks: list,
+    context_activation_hooks: list,
+    return_type: Literal["loss", "logits"] = "loss",
+    layer: int = 5,
+    pos: int = -1,
+    deactivated_components=("blocks.4.hook_attn_out", "blocks.5.hook_attn_out", "blocks.4.hook_mlp_out"),
+    variant_batch_size: int = 8,
+) -> Float[Tensor, "subset batch"] | Float[Tensor, "subset d_vocab"]:
+    """Effect of neuron subsets of the MLP in layer on the path patched run of get_direct_effect (only_activated, with
+    activated_components=(f"blocks.{layer}.hook_mlp_out",)): each subset variant resets its neurons to their ablated values
+    in the context activated run before its MLP output is patched in, like adding get_ablate_neurons_hook to the context
+    activation hooks.
+
+    The ablated and context activated MLP activations are cached once, after which the run only depends on the MLP
+    activations, so chunks of variant_batch_size subsets are evaluated in one stacked forward pass each.
+
+    Returns:
+        The metric at pos of the path patched run followed by one per subset: the loss per prompt, or the logits averaged
+        over the prompts.
+    """
+    post_name = f"blocks.{layer}.mlp.hook_post"
+    with model.hooks(fwd_hooks=context_ablation_hooks):
+        ablated_cache = get_truncated_cache(prompts, model, [post_name, *deactivated_components])
+
+    def freeze_hook(value, hook: HookPoint):
+        return ablated_cache[hook.name]
+    freeze_hooks = [(name, freeze_hook) for name in deactivated_components]
+    with model.hooks(fwd_hooks=context_activation_hooks + freeze_hooks):
+        activated_post = get_truncated_cache(prompts, model, post_name)[post_name]
+    ablated_post = ablated_cache[post_name]
+
+    # Upstream of the MLP the path patched run equals the ablated run, so replacing the MLP activations of the ablated run
+    # patches the MLP output. The empty first subset is the path patched run itself.
+    neuron_subsets = [[]] + list(neuron_subsets)
+    metrics = []
+    for i in range(0, len(neuron_subsets), variant_batch_size):
+        chunk = neuron_subsets[i:i + variant_batch_size]
+        reset_mask = torch.zeros(len(chunk), model.cfg.d_mlp, dtype=torch.bool, device=ablated_post.device)
+        for j, neurons in enumerate(chunk):
+            reset_mask[j, torch.as_tensor(neurons, dtype=torch.long)] = True
+
+        def reset_neurons_hook(value, hook: HookPoint):
+            post = torch.where(reset_mask[:, None, None, :], ablated_post.unsqueeze(0), activated_post.unsqueeze(0))
+            return post.reshape(value.shape)
+
+        with model.hooks(fwd_hooks=context_ablation_hooks + [(post_name, reset_neurons_hook)]):
+            if return_type == "loss":
+                loss = model(prompts.repeat(len(chunk), 1), return_type="loss", loss_per_token=True)[:, pos]
+                metrics.append(loss.view(len(chunk), prompts.shape[0]))
+            else:
+                residual = model(prompts.repeat(len(chunk), 1), stop_at_layer=model.cfg.n_layers)
+                logits = model.unembed(model.ln_final(residual[:, [pos]]))[:, 0]
+                metrics.append(logits.view(len(chunk), prompts.shape[0], -1).mean(1))
+    return torch.cat(metrics)
+
+
+def get_neuron_subset_logprob_differences(
+    prompts: Int[Tensor, "batch pos"],
+    model: HookedTransformer,
+    neuron_subsets: list[Int[Tensor, "n_neurons"] | list[int]],
+    context_ablation_hooks: list,
+    context_activation_hooks: list,
+    layer: int = 5,
+    pos: int = -2,
+    deactivated_components=("blocks.4.hook_attn_out", "blocks.5.hook_attn_out", "blocks.4.hook_mlp_out"),
+    variant_batch_size: int = 8,
+) -> tuple[Float[Tensor, "d_vocab"], Float[Tensor, "subset d_vocab"]]:
+    """Logprob effect of neuron subsets of the MLP in layer on the path patched run of get_direct_effect, see
+    get_neuron_subset_metrics.
+
+    Like get_direct_effect with return_type='logprobs', the "logprobs" are the unnormalized logits at pos, so the
+    results match the serial get_direct_effect analyses they replace.
+
+    Returns:
+        The mean logprobs at pos of the path patched run and the mean logprob difference (path patched - subset reset) per subset.
+    """
+    mean_logprobs = get_neuron_subset_metrics(
+        prompts, model, neuron_subsets, context_ablation_hooks, context_activation_hooks, return_type="logits", layer=layer,
+        pos=pos, deactivated_components=deactivated_components, variant_batch_size=variant_batch_size)
+    return mean_logprobs[0], mean_logprobs[0] - mean_logprobs[1:]
+
+
+def get_repeated_losses(
+    tokens: Int[Tensor, "batch pos"],
+    model: HookedTransformer,
+    n_variants: int,
+    fwd_hooks: list = [],
+    stacked_hooks: list = [],
+    pos: int | None = -1,
+) -> Float[Tensor, "variant batch"]:
+    """Loss at pos (mean over positions if None) of n_variants stacked copies of tokens. fwd_hooks are applied to each copy on its own,
+    so they may replace activations with batch sized tensors, while stacked_hooks see the whole stack and run after fwd_hooks at the
+    same hook point, to treat each copy as a variant."""
+    variant_hooks = get_variant_hooks({i: fwd_hooks for i in range(n_variants)}, tokens.shape[0])
+    with model.hooks(fwd_hooks=variant_hooks + stacked_hooks):
+        loss = model(tokens.repeat(n_variants, 1), return_type="loss", loss_per_token=True)
+    loss = loss[:, pos] if pos is not None else loss.mean(1)
+    return loss.reshape(n_variants, tokens.shape[0])
+
+
+def get_activation_loss_gradient(
+    prompts: str | list[str] | Int[Tensor, "batch pos"],
+    model: HookedTransformer,
+    hook_name: str,
+    fwd_hooks: list = [],
+    pos: int | None = -1,
+) -> tuple[Float[Tensor, "batch pos d"], Float[Tensor, "batch pos d"]]:
+    """Activation at hook_name under fwd_hooks and the gradient of the loss at pos (mean over positions if None) with respect to it,
+    from one forward and one backward pass. Works with grad disabled globally. The losses of the prompts are summed, so every prompt
+    gets the gradient of its own loss."""
+    tokens = prompts if isinstance(prompts, Tensor) else model.to_tokens(prompts)
+    activation = {}
+
+    def track_activation_hook(value, hook: HookPoint):
+        activation[hook.name] = value.detach().requires_grad_(True)
+        return activation[hook.name]
+
+    with torch.enable_grad(), model.hooks(fwd_hooks=fwd_hooks + [(hook_name, track_activation_hook)]):
+        loss = model(tokens, return_type="loss", loss_per_token=True)
+        loss = loss[:, pos] if pos is not None else loss.mean(1)
+        gradient, = torch.autograd.grad(loss.sum(), activation[hook_name])
+    return activation[hook_name].detach(), gradient
+
+
+def get_neuron_patching_losses(
+    prompts: str | list[str] | Int[Tensor, "batch pos"],
+    model: HookedTransformer,
+    neurons: Int[Tensor, "n_neurons"] | list[int],
+    patched_post: Float[Tensor, "batch pos d_mlp"],
+    fwd_hooks: list = [],
+    layer: int = 5,
+    pos: int | None = -1,
+    variant_batch_size: int = 8,
+) -> Float[Tensor, "n_neurons batch"]:
+    """Exact loss change at pos from setting each single neuron of the MLP in layer to its value in patched_post, e.g. an ablated
+    cache, on top of fwd_hooks. Chunks of variant_batch_size neurons are evaluated in one stacked forward pass each, with fwd_hooks
+    applied to every variant, so they may replace activations with batch sized tensors."""
+    tokens = prompts if isinstance(prompts, Tensor) else model.to_tokens(prompts)
+    post_name = f"blocks.{layer}.mlp.hook_post"
+    neurons = torch.as_tensor(neurons, dtype=torch.long, device=patched_post.device)
+    original_loss = get_repeated_losses(tokens, model, 1, fwd_hooks, pos=pos)
+
+    loss_diffs = []
+    for i in range(0, len(neurons), variant_batch_size):
+        chunk = neurons[i:i + variant_batch_size]
+        patch_mask = torch.zeros(len(chunk), model.cfg.d_mlp, dtype=torch.bool, device=patched_post.device)
+        patch_mask[torch.arange(len(chunk), device=chunk.device), chunk] = True
+
+        def patch_neurons_hook(value, hook: HookPoint):
+            value = value.reshape(len(chunk), *patched_post.shape)
+            return torch.where(patch_mask[:, None, None, :], patched_post.unsqueeze(0), value).reshape(-1, *patched_post.shape[1:])
+
+        loss = get_repeated_losses(tokens, model, len(chunk), fwd_hooks, [(post_name, patch_neurons_hook)], pos)
+        loss_diffs.append(loss - original_loss)
+    return torch.cat(loss_diffs)
+
+
+def get_neuron_attribution_patching_effects(
+    prompts: str | list[str] | Int[Tensor, "batch pos"],
+    model: HookedTransformer,
+    patched_post: Float[Tensor, "batch pos d_mlp"],
+    fwd_hooks: list = [],
+    layer: int = 5,
+    pos: int | None = -1,
+    verify_top_k: int | None = None,
+    variant_batch_size: int = 8,
+) -> Float[Tensor, "d_mlp batch"] | tuple[Float[Tensor, "d_mlp batch"], Int[Tensor, "k"], Float[Tensor, "k batch"]]:
+    """Attribution patching: linear estimate of get_neuron_patching_losses for every neuron of the MLP in layer from one forward and one
+    backward pass, as (patched_post - activation) * loss gradient summed over positions. The estimate is only accurate for small
+    changes, so it is meant as a candidate filter before exact ablations.
+
+    Returns:
+        The estimated loss change per neuron and prompt. With verify_top_k, also the k neurons with the largest absolute mean estimate
+        and their exact loss changes from get_neuron_patching_losses.
+    """
+    post, gradient = get_activation_loss_gradient(prompts, model, f"blocks.{layer}.mlp.hook_post", fwd_hooks, pos)
+    effects = ((patched_post - post) * gradient).sum(1).T
+    if verify_top_k is None:
+        return effects
+    top_neurons = effects.mean(1).abs().topk(verify_top_k).indices
+    exact_effects = get_neuron_patching_losses(prompts, model, top_neurons, patched_post, fwd_hooks, layer, pos, variant_batch_size)
+    return effects, top_neurons, exact_effects
+
+
 def relevant_names_filter(name: str):
     return any([name.endswith(s) for s in ["attn_out", "mlp_out"]])
 
@@ -1405,13 +1848,42 @@ def get_average_loss_plot_method(activate_context_fwd_hooks, deactivate_context_
             return original_losses, ablated_losses, context_and_activated_losses, only_activated_losses
     return average_loss_plot
 
-def get_common_tokens(data, model, ignore_tokens, k=100, return_counts=False, return_unsorted_counts=False) -> Tensor:
+def get_token_count_cache_path(data: list[str], model: HookedTransformer, cache_dir: str | Path) -> Path:
+    """Cache file for the token counts of data, keyed by a hash of the prompts and the tokenizer"""
+    key = hashlib.sha256()
+    key.update(f"{model.tokenizer.name_or_path}_{len(model.tokenizer)}_{model.cfg.n_ctx}".encode())
+    for prompt in data:
+        key.update(prompt.encode())
+        key.update(b"\0")
+    return Path(cache_dir).joinpath(f"token_counts_{key.hexdigest()[:16]}.pt")
+
+
+def count_tokens(data: list[str], model: HookedTransformer, batch_size=1000, cache_dir: str | Path | None = None) -> Float[Tensor, "d_vocab"]:
+    """Number of occurrences of each token in model.to_tokens(prompt) over all prompts. Prompts are tokenized in batches
+    and counted with bincount. If cache_dir is set the counts are saved there and reused for the same data and tokenizer."""
+    if cache_dir is not None:
+        cache_path = get_token_count_cache_path(data, model, cache_dir)
+        if cache_path.exists():
+            return torch.load(cache_path).to("cuda")
+
+    token_counts = torch.zeros(model.cfg.d_vocab, dtype=torch.long)
+    for i in tqdm(range(0, len(data), batch_size)):
+        # Same tokens as model.to_tokens: BOS prepended, truncated to n_ctx
+        input_ids = model.tokenizer(data[i : i + batch_size], add_special_tokens=False)["input_ids"]
+        tokens = torch.tensor([token for ids in input_ids for token in ids[: model.cfg.n_ctx - 1]], dtype=torch.long)
+        token_counts += torch.bincount(tokens, minlength=model.cfg.d_vocab)[: model.cfg.d_vocab]
+        token_counts[model.tokenizer.bos_token_id] += len(input_ids)
+    token_counts = token_counts.float()
+
+    if cache_dir is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        torch.save(token_counts, cache_path)
+    return token_counts.to("cuda")
+
+
+def get_common_tokens(data, model, ignore_tokens, k=100, return_counts=False, return_unsorted_counts=False, cache_dir=None) -> Tensor:
     # Get top common german tokens excluding punctuation
-    token_counts = torch.zeros(model.cfg.d_vocab).cuda()
-    for example in tqdm(data):
-        tokens = model.to_tokens(example)
-        for token in tokens[0]:
-            token_counts[token.item()] += 1
+    token_counts = count_tokens(data, model, cache_dir=cache_dir)
 
     punctuation = ["\n", ".", ",", "!", "?", ";", ":", "-", "(", ")", "[", "]", "{", "}", "<", ">", "/", "\\", "\"", "'"]
     leading_space_punctuation = [" " + char for char in punctuation]
@@ -1482,6 +1954,58 @@ def get_ablate_attention_hook(layer, head, mean_activation, pos: int | None=-2):
 
     return (f'blocks.{layer}.attn.hook_z', ablate_attention_head)
 
+
+def get_head_ablation_hooks(
+    variants: list[tuple[int, int, int | None]], batch_size: int, mean_activation: Float[Tensor, "layer head d_head"]
+) -> list[tuple[str, Callable]]:
+    """Vectorized get_ablate_attention_hook for a stacked batch where variant i owns rows [i * batch_size, (i + 1) * batch_size)
+    and ablates head variants[i] = (layer, head, pos) to its mean activation. pos None ablates every position."""
+    layers = sorted({layer for layer, _, _ in variants})
+
+    def get_layer_hook(layer):
+        variant_indices = [i for i, variant in enumerate(variants) if variant[0] == layer]
+        heads = torch.tensor([variants[i][1] for i in variant_indices])
+
+        def ablate_attention_heads(value, hook):
+            n_pos = value.shape[1]
+            value = value.reshape(-1, batch_size, *value.shape[1:])  # variant batch pos head d_head
+            positions = [range(n_pos) if variants[i][2] is None else [variants[i][2] % n_pos] for i in variant_indices]
+            counts = torch.tensor([len(variant_positions) for variant_positions in positions])
+            variant_index = torch.repeat_interleave(torch.tensor(variant_indices), counts).to(value.device)
+            head_index = torch.repeat_interleave(heads, counts).to(value.device)
+            pos_index = torch.tensor([p for variant_positions in positions for p in variant_positions], device=value.device)
+            value[variant_index, :, pos_index, head_index] = mean_activation[layer, head_index].unsqueeze(1).to(value.dtype)
+            return value.reshape(-1, *value.shape[2:])
+        return ablate_attention_heads
+
+    return [(f'blocks.{layer}.attn.hook_z', get_layer_hook(layer)) for layer in layers]
+
+
+def get_head_ablation_losses(
+    prompts: Int[Tensor, "batch pos"],
+    model: HookedTransformer,
+    mean_activation: Float[Tensor, "layer head d_head"],
+    heads: list[tuple[int, int]] | None = None,
+    positions: list[int | None] = [-2],
+    loss_pos: int = -1,
+    variant_batch_size: int = 16,
+) -> Float[Tensor, "variant batch"]:
+    """Loss at loss_pos when mean ablating each head at each position, with variants ordered by position and then head.
+    Chunks of variant_batch_size variants run in one forward pass on variant_batch_size stacked copies of the prompts.
+    Defaults to all heads of the model."""
+    if heads is None:
+        heads = [(layer, head) for layer in range(model.cfg.n_layers) for head in range(model.cfg.n_heads)]
+    variants = [(layer, head, pos) for pos in positions for layer, head in heads]
+    batch_size = prompts.shape[0]
+
+    losses = []
+    for i in range(0, len(variants), variant_batch_size):
+        chunk = variants[i:i + variant_batch_size]
+        with model.hooks(fwd_hooks=get_head_ablation_hooks(chunk, batch_size, mean_activation)):
+            loss = model(prompts.repeat(len(chunk), 1), return_type="loss", loss_per_token=True)[:, loss_pos]
+        losses.append(loss.view(len(chunk), batch_size))
+    return torch.cat(losses)
+
 def get_trigram_prompts(prompts, first_replacement_tokens, second_replacement_tokens):
     # Create prev-random prompts
     test_prompts_prev = replace_column(prompts, -2, second_replacement_tokens)
@@ -1686,18 +2210,39 @@ def get_top_k_neurons(df, condition, sortby, k=10, ascending=False):
     tmp_df = tmp_df.sort_values(by=sortby, ascending=ascending)
     return tmp_df.index[:k]
 
+NEW_WORD_START_CHARS = [" ", ",", ".", ":", ";", "!", "?"]
+
+
+@lru_cache(maxsize=2)
+def get_vocab_token_classes(model: HookedTransformer) -> dict[str, Bool[Tensor, "d_vocab"]]:
+    """Boolean lookup tables over the vocabulary, built once per model from the decoded string of every token id.
+    Padding ids beyond the tokenizer's vocabulary are False in every table."""
+    n_tokens = min(len(model.tokenizer), model.cfg.d_vocab)
+    str_tokens = model.tokenizer.batch_decode(torch.arange(n_tokens).unsqueeze(1), clean_up_tokenization_spaces=False)
+    predicates = {
+        "starts_with_space": lambda s: s.startswith(" "),
+        "starts_new_word": lambda s: s[:1] in NEW_WORD_START_CHARS,
+        "is_punctuation": lambda s: len(s.strip()) > 0 and all(c in string.punctuation for c in s.strip()),
+        "is_alpha": lambda s: s.strip().isalpha(),
+        "is_numeric": lambda s: s.strip().isnumeric(),
+    }
+    token_classes = {}
+    for name, predicate in predicates.items():
+        table = torch.zeros(model.cfg.d_vocab, dtype=torch.bool)
+        table[:n_tokens] = torch.tensor([predicate(s) for s in str_tokens], dtype=torch.bool)
+        token_classes[name] = table.to(model.cfg.device)
+    return token_classes
+
+
+def get_token_class_mask(tokens: Int[Tensor, "..."], model: HookedTransformer, token_class: str) -> Bool[Tensor, "..."]:
+    """Mask of the tokens that belong to a class of get_vocab_token_classes, one gather for a tensor of any shape."""
+    table = get_vocab_token_classes(model)[token_class]
+    return table.to(tokens.device)[tokens]
+
+
 def split_tokens_with_space(tokens: Tensor, model: HookedTransformer) -> tuple[Tensor, Tensor]:
-    new_word_tokens = []
-    continuation_tokens = []
-    for token in tokens:
-        str_token = model.to_single_str_token(token.item())
-        if str_token.startswith(" "):
-            new_word_tokens.append(token)
-        else:
-            continuation_tokens.append(token)
-    new_word_tokens = torch.stack(new_word_tokens)
-    continuation_tokens = torch.stack(continuation_tokens)
-    return new_word_tokens, continuation_tokens
+    starts_with_space = get_token_class_mask(tokens, model, "starts_with_space")
+    return tokens[starts_with_space], tokens[~starts_with_space]
 
 def activation_data_frame(ngram: str, prompts: Tensor, model: HookedTransformer, common_tokens: Tensor, activate_neurons_fwd_hooks, deactivate_neurons_fwd_hooks: list[tuple[str, Callable]], layer=5, mlp_hook="hook_pre") -> pd.DataFrame:
     new_word_tokens, continuation_tokens = split_tokens_with_space(common_tokens, model)
@@ -1732,43 +2277,48 @@ def get_neurons_tuples(neurons: dict[int, list[int]]) -> list[(int, int)]:
         result.extend([(layer, neuron) for neuron in neurons])
     return result
 
-def compute_and_conditions(prompts, model, option, type: Literal["logits", "loss"], common_tokens, activate_context_hook, deactivate_context_hooks):
+def compute_and_conditions(prompts, model, option, type: Literal["logits", "loss"], common_tokens, activate_context_hook, deactivate_context_hooks,
+                           deactivated_components=("blocks.4.hook_attn_out", "blocks.5.hook_attn_out", "blocks.4.hook_mlp_out"),
+                           activated_components=("blocks.5.hook_mlp_out",), batch_size=32):
+    """Values of the eight conditions of previous token (first letter), current token (second letter) and context neuron (third letter)
+    being present (Y) or ablated (N), and the AND metrics derived from them. An activated context neuron only acts through the direct
+    effect of activated_components as in get_direct_effect.
+
+    The ablated prompts are created once per token condition and all eight conditions are evaluated in one stacked forward pass per batch:
+    each token condition runs with the context neuron ablated (xxN), activated with deactivated_components frozen to the ablated run, and
+    ablated with activated_components patched in from the activated run (xxY).
+    """
     ANSWER_TOKEN_ID = model.to_tokens(option).flatten()[-1].item()
     multiplier = 1 if type == "loss" else -1
 
-    def get_value(prompts, activated=False):
-        if activated:
-            if type == "logits":
-                _, _, _, value = get_direct_effect(prompts, model, 
-                        context_ablation_hooks=deactivate_context_hooks, context_activation_hooks=activate_context_hook,
-                        return_type=type, pos=-2)
-                return value[:, ANSWER_TOKEN_ID].mean().item()
-            elif type == "loss":
-                _, _, _, value = get_direct_effect(prompts, model, 
-                        context_ablation_hooks=deactivate_context_hooks, context_activation_hooks=activate_context_hook,
-                        return_type=type, pos=-1)
-                return value.mean().item()
-        with model.hooks(fwd_hooks=deactivate_context_hooks):
-            if type == "logits":
-                return model(prompts, return_type="logits", loss_per_token=True)[:, -2, ANSWER_TOKEN_ID].mean().item()
-            elif type == "loss":
-                return model(prompts, return_type="loss", loss_per_token=True)[:, -1].mean().item()
-
-    
     # COMPUTE AND CONDITIONS
-    ablated_prompts_ny = create_ablation_prompts(prompts, "NYY", common_tokens)
-    ablated_prompts_yn = create_ablation_prompts(prompts, "YNY", common_tokens)
-    ablated_prompts_nn = create_ablation_prompts(prompts, "NNY", common_tokens)
+    tokens = prompts if isinstance(prompts, Tensor) else model.to_tokens(prompts)
+    token_conditions = {
+        "YY": tokens,
+        "NY": create_ablation_prompts(tokens, "NYY", common_tokens),
+        "YN": create_ablation_prompts(tokens, "YNY", common_tokens),
+        "NN": create_ablation_prompts(tokens, "NNY", common_tokens),
+    }
+    variants, patches, variant_tokens = {}, {}, []
+    for condition, condition_tokens in token_conditions.items():
+        variants[condition + "N"] = deactivate_context_hooks
+        variants[condition + "_context_and_activated"] = activate_context_hook
+        variants[condition + "Y"] = deactivate_context_hooks
+        patches[condition + "_context_and_activated"] = {name: condition + "N" for name in deactivated_components}
+        patches[condition + "Y"] = {
+            **{name: condition + "_context_and_activated" for name in activated_components},
+            **{name: condition + "N" for name in deactivated_components},
+        }
+        variant_tokens.extend([condition_tokens] * 3)
 
-    yyy_value = get_value(prompts, activated=True)
-    nyy_value = get_value(ablated_prompts_ny, activated=True)
-    yny_value = get_value(ablated_prompts_yn, activated=True)
-    nny_value = get_value(ablated_prompts_nn, activated=True)
+    if type == "logits":
+        metrics = get_variant_metrics(torch.stack(variant_tokens), model, variants, patches, return_type="logits", pos=-2, batch_size=batch_size)[:, :, ANSWER_TOKEN_ID]
+    elif type == "loss":
+        metrics = get_variant_metrics(torch.stack(variant_tokens), model, variants, patches, return_type="loss", pos=-1, batch_size=batch_size)
+    values = dict(zip(variants.keys(), metrics.mean(dim=1).tolist()))
 
-    yyn_value = get_value(prompts, activated=False)
-    nyn_value = get_value(ablated_prompts_ny, activated=False)
-    ynn_value = get_value(ablated_prompts_yn, activated=False)
-    nnn_value = get_value(ablated_prompts_nn, activated=False)
+    yyy_value, nyy_value, yny_value, nny_value = values["YYY"], values["NYY"], values["YNY"], values["NNY"]
+    yyn_value, nyn_value, ynn_value, nnn_value = values["YYN"], values["NYN"], values["YNN"], values["NNN"]
 
     # Fix current token
     yyn_nyn_diff = (nyn_value - yyn_value) * multiplier
@@ -1917,11 +2467,11 @@ def get_context_effect(prompt: str | list[str], model: HookedTransformer, contex
     original_metric = model(prompt, return_type=return_type, loss_per_token=True)
     # 1. Activated loss: activate context
     with model.hooks(fwd_hooks=context_activation_hooks):
-        activated_metric, activated_cache = model.run_with_cache(prompt, return_type=return_type, loss_per_token=True)
+        activated_metric, activated_cache = run_with_cache_plan(prompt, model, downstream_components, return_type=return_type, loss_per_token=True)
 
     # 2. Total effect: deactivate context
     with model.hooks(fwd_hooks=context_ablation_hooks):
-        ablated_metric, ablated_cache = model.run_with_cache(prompt, return_type=return_type, loss_per_token=True)
+        ablated_metric, ablated_cache = run_with_cache_plan(prompt, model, downstream_components, return_type=return_type, loss_per_token=True)
 
     # 3. Direct effect: activate context, deactivate later components
     def deactivate_components_hook(value, hook: HookPoint):
@@ -1946,26 +2496,15 @@ def get_context_effect(prompt: str | list[str], model: HookedTransformer, contex
 
 def get_next_token_punctuation_mask(tokens: torch.LongTensor, model: HookedTransformer, fill_last_pos=True) -> torch.BoolTensor:
     """ Returns boolean mask where True indicates that the next token is a new word.
-    Input should not have a batch dimension! """
-    next_token_punctuation_mask = torch.zeros_like(tokens, dtype=torch.bool)
-    token_strs = model.to_str_tokens(tokens)
-    for i in range(tokens.shape[0] - 1):
-        next_token_str = token_strs[i + 1]
-        next_is_space = next_token_str[0] in [" ", ",", ".", ":", ";", "!", "?"]
-        next_token_punctuation_mask[i] = next_is_space
+    Works on the last dimension, so tokens may have a batch dimension. The last position is False, or dropped if not fill_last_pos. """
+    next_token_punctuation_mask = get_token_class_mask(tokens[..., 1:], model, "starts_new_word")
     if not fill_last_pos:
-        return next_token_punctuation_mask[:-1]
-    return next_token_punctuation_mask
+        return next_token_punctuation_mask
+    return torch.cat([next_token_punctuation_mask, torch.zeros_like(next_token_punctuation_mask[..., :1])], dim=-1)
 
 
-def get_token_counts(data, model) -> Tensor:
-    # Get top common german tokens excluding punctuation
-    token_counts = torch.zeros(model.cfg.d_vocab).cuda()
-    for example in tqdm(data):
-        tokens = model.to_tokens(example)
-        for token in tokens[0]:
-            token_counts[token.item()] += 1
-
+def get_token_counts(data, model, cache_dir=None) -> Tensor:
+    token_counts = count_tokens(data, model, cache_dir=cache_dir)
     _, top_tokens = torch.topk(token_counts, model.cfg.d_vocab)
     return token_counts, top_tokens
 
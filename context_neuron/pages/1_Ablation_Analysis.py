@@ -1,39 +1,39 @@
 # %%
 import streamlit as st
-import json
 import plotting_utils
-from pathlib import Path
+import dashboard_data
 
 st.set_page_config(page_title="Ablation analysis", page_icon="📊",)
 st.sidebar.success("Select an analysis above.")
 
 st.title("MLP5 N-Gram Analysis")
 
-#@st.cache_data
-def load_data():
-    path = Path(__file__).parent
-    with open(path / '../data/verify_bigrams/pos_loss_data.json', 'r') as f:
-        all_loss_data = json.load(f)
-    with open(path / '../data/verify_bigrams/neuron_loss_diffs.json', 'r') as f:
-        neuron_loss_diffs = json.load(f)
-    with open(path / '../data/verify_bigrams/neuron_loss_data.json', 'r') as f:
-        neuron_loss_data = json.load(f)
-    with open(path / '../data/verify_bigrams/summed_neuron_boosts.json', 'r') as f:
-        summed_neuron_boosts = json.load(f)
-    with open(path / '../data/verify_bigrams/summed_split_neuron_boosts.json', 'r') as f:
-        summed_individual_neuron_boosts = json.load(f)
-    with open(path / '../data/verify_bigrams/individual_neuron_boosts.json', 'r') as f:
-        individual_neuron_boosts = json.load(f)
-    return all_loss_data, neuron_loss_diffs, neuron_loss_data, summed_neuron_boosts, summed_individual_neuron_boosts, individual_neuron_boosts
-
-all_loss_data, neuron_loss_diffs, neuron_loss_data, summed_neuron_boosts, summed_individual_neuron_boosts, individual_neuron_boosts = load_data()
-
-tokens = list(all_loss_data.keys())
+@st.cache_data
+def load_options():
+    return [option for option, in dashboard_data.get_partition_keys("pos_loss_data")]
+
+@st.cache_data
+def load_data(option):
+    tables = ["pos_loss_data", "neuron_loss_diffs", "neuron_loss_data", "summed_neuron_boosts", "summed_split_neuron_boosts", "individual_neuron_boosts"]
+    return tuple(dashboard_data.load_partition(table, option) for table in tables)
+
+def get_losses(df, column, value):
+    '''Per prompt losses of each name in order'''
+    df = df[df[column] == value]
+    return [group["loss"].tolist() for _, group in df.groupby("name", sort=False)]
+
+def get_boosts(df, column, value, select, direction):
+    df = df[(df[column] == value) & (df["select"] == select) & (df["direction"] == direction)]
+    return df.sort_values("rank")
+
+tokens = load_options()
 
 option = st.selectbox(
     'Select the N-Gram to analyze',
     tokens, index=0)
 
+all_loss_data, neuron_loss_diffs, neuron_loss_data, summed_neuron_boosts, summed_individual_neuron_boosts, individual_neuron_boosts = load_data(option)
+
 st.markdown("""
             ## Position-wise loss analysis
             
@@ -49,7 +49,7 @@ st.markdown("""
 
 # %%
 
-replacable_tokens = list(all_loss_data[option].keys())[1:]
+replacable_tokens = all_loss_data["replace_column"].unique().tolist()[1:]
 replace_column = st.selectbox(
     'Select the token to replace with random tokens',
     replacable_tokens, index=0)
@@ -63,14 +63,14 @@ short_names = ["Original", "Ablated", "MLP5"]
 
 with col1:
     title = f"Last token loss on full prompt"
-    original_loss, ablated_loss, only_activated_loss = all_loss_data[option]["None"].values()
+    original_loss, ablated_loss, only_activated_loss = get_losses(all_loss_data, "replace_column", "None")
     plot = plotting_utils.plot_barplot([original_loss, ablated_loss, only_activated_loss], 
                                        names, legend=False, width=300, yaxis=dict(range=[0, 15]), short_names=short_names, ylabel="Loss", title=title, show=False)
     st.plotly_chart(plot)
 
 with col2:
     title = f"Last token loss when replacing '{replace_column}' token"
-    original_loss, ablated_loss, only_activated_loss = all_loss_data[option][replace_column].values()
+    original_loss, ablated_loss, only_activated_loss = get_losses(all_loss_data, "replace_column", replace_column)
     plot = plotting_utils.plot_barplot([original_loss, ablated_loss, only_activated_loss], 
                                        names, legend=False, width=300, yaxis=dict(range=[0, 15]), short_names=short_names, ylabel="Loss", title=title, show=False)
     st.plotly_chart(plot) 
@@ -83,7 +83,7 @@ st.markdown("""
             We compute the difference in loss when path patching all MLP5 neurons compared to ablating a single neuron (i.e. removing it from the set of patched neurons).
             """)
 
-neuron_loss_diffs = neuron_loss_diffs[option]
+neuron_loss_diffs = neuron_loss_diffs["loss_diff"].tolist()
 
 sort = st.checkbox("Sort by difference", value=True)
 
@@ -102,8 +102,7 @@ top_neurons_count = st.slider("Number of neurons to remove", 1, 25, 10, 1)
 names = ["Original", "Ablated", "MLP5 path patched", f"MLP5 path patched + Top {top_neurons_count} MLP5 neurons ablated", f"MLP5 path patched + Bottom {top_neurons_count} MLP5 neurons ablated"]
 short_names = ["Original", "Ablated", "MLP5 path patched", f"Top MLP5 removed", f"Bottom MLP5 removed"]
 
-loss_data = neuron_loss_data[option][str(top_neurons_count)]
-values = list(loss_data.values())
+values = get_losses(neuron_loss_data, "num_neurons", str(top_neurons_count))
 #values = [original_loss.tolist(), ablated_loss.tolist(), all_MLP5_loss.tolist(), top_MLP5_ablated_loss.tolist(), bottom_MLP5_ablated_loss.tolist()]
 plot = plotting_utils.plot_barplot(values, names, short_names=short_names, 
                                    width=650, yaxis=dict(range=[0, 10]), show=False, ylabel="Loss", 
@@ -132,18 +131,15 @@ else:
     top_select_str = "Bottom"
     title_append = f" from bottom {top_neurons_count_logprob} neurons"
 
-if isolate_effects:
-    summed_neuron_boosted = summed_individual_neuron_boosts[option][str(top_neurons_count_logprob)][top_select_str]["Boosted"]
-    summed_neuron_deboosted = summed_individual_neuron_boosts[option][str(top_neurons_count_logprob)][top_select_str]["Deboosted"]
-else:
-    summed_neuron_boosted = summed_neuron_boosts[option][str(top_neurons_count_logprob)][top_select_str]["Boosted"]
-    summed_neuron_deboosted = summed_neuron_boosts[option][str(top_neurons_count_logprob)][top_select_str]["Deboosted"]
+boosts = summed_individual_neuron_boosts if isolate_effects else summed_neuron_boosts
+summed_neuron_boosted = get_boosts(boosts, "num_neurons", top_neurons_count_logprob, top_select_str, "Boosted")
+summed_neuron_deboosted = get_boosts(boosts, "num_neurons", top_neurons_count_logprob, top_select_str, "Deboosted")
 
-summed_neuron_boosted_values = summed_neuron_boosted["Logprob difference"]
-summed_neuron_boosted_tokens = summed_neuron_boosted["Tokens"]
+summed_neuron_boosted_values = summed_neuron_boosted["logprob_difference"].tolist()
+summed_neuron_boosted_tokens = summed_neuron_boosted["token"].tolist()
 
-summed_neuron_deboosted_values = summed_neuron_deboosted["Logprob difference"]
-summed_neuron_deboosted_tokens = summed_neuron_deboosted["Tokens"]
+summed_neuron_deboosted_values = summed_neuron_deboosted["logprob_difference"].tolist()
+summed_neuron_deboosted_tokens = summed_neuron_deboosted["token"].tolist()
 
 col1, col2 = st.columns(2)
 
@@ -177,25 +173,17 @@ st.markdown("""
 top_neuron_selector = st.slider("Top / bottom neuron", 1, 25, 1, 1)
 top_individual_neuron_checkbox = st.checkbox("Top neuron", value=True)
 
-bottom_neuron = individual_neuron_boosts[option][str(top_neuron_selector-1)][top_select_str]["Neuron"]
-
-if top_individual_neuron_checkbox:
-    top_select_str = "Top"
-    top_neuron = individual_neuron_boosts[option][str(top_neuron_selector-1)][top_select_str]["Neuron"]
-    title_append = f" from neuron {top_neuron}"
-else:
-    top_select_str = "Bottom"
-    bottom_neuron = individual_neuron_boosts[option][str(top_neuron_selector-1)][top_select_str]["Neuron"]
-    title_append = f" from neuron {bottom_neuron}"
-
-individual_neuron_boosted = individual_neuron_boosts[option][str(top_neuron_selector-1)][top_select_str]["Boosted"]
-individual_neuron_deboosted = individual_neuron_boosts[option][str(top_neuron_selector-1)][top_select_str]["Deboosted"]
+top_select_str = "Top" if top_individual_neuron_checkbox else "Bottom"
+individual_neuron_boosted = get_boosts(individual_neuron_boosts, "neuron_pos", top_neuron_selector-1, top_select_str, "Boosted")
+individual_neuron_deboosted = get_boosts(individual_neuron_boosts, "neuron_pos", top_neuron_selector-1, top_select_str, "Deboosted")
+selected_neuron = individual_neuron_boosts[(individual_neuron_boosts["neuron_pos"] == top_neuron_selector-1) & (individual_neuron_boosts["select"] == top_select_str)]["neuron"].iloc[0]
+title_append = f" from neuron {selected_neuron}"
 
-individual_neuron_boosted_values = individual_neuron_boosted["Logprob difference"]
-individual_neuron_boosted_tokens = individual_neuron_boosted["Tokens"]
+individual_neuron_boosted_values = individual_neuron_boosted["logprob_difference"].tolist()
+individual_neuron_boosted_tokens = individual_neuron_boosted["token"].tolist()
 
-individual_neuron_deboosted_values = individual_neuron_deboosted["Logprob difference"]
-individual_neuron_deboosted_tokens = individual_neuron_deboosted["Tokens"]
+individual_neuron_deboosted_values = individual_neuron_deboosted["logprob_difference"].tolist()
+individual_neuron_deboosted_tokens = individual_neuron_deboosted["token"].tolist()
 
 col1, col2 = st.columns(2)
 
@@ -1,9 +1,8 @@
 import streamlit as st
 import pandas as pd
 import plotly.express as px
-from pathlib import Path
-import json
 import plotting_utils
+import dashboard_data
 import plotly.graph_objects as go
 
 st.set_page_config(page_title="AND-Neurons", page_icon="📊")
@@ -15,21 +14,13 @@ run_select = st.sidebar.selectbox(
     "Select run", options=["Run 1", "Run 2", "Run 3"], index=0
 )
 
-if run_select == "Run 1":
-    file_name_append = "_0000"
-elif run_select == "Run 2":
-    file_name_append = "_1000"
-else:
-    file_name_append = "_2000"
-
-#@st.cache_data
-def load_data():
-    path = Path(__file__).parent / f"../data/and_neurons/"
-    df_logits = pd.read_csv(path / f"and_conditions_logits{file_name_append}.csv")
-    df_loss = pd.read_csv(path / f"and_conditions_loss{file_name_append}.csv")
+@st.cache_data
+def load_data(run):
+    df_logits = dashboard_data.load_partition("and_conditions_logits", run)
+    df_loss = dashboard_data.load_partition("and_conditions_loss", run)
     return df_logits, df_loss
 
-df_logits, df_loss = load_data()
+df_logits, df_loss = load_data(run_select)
 
 st.markdown("""
             ### Looking for non-linearities
@@ -47,7 +38,6 @@ with st.expander("Show AND condition formulas"):
 data_select = st.sidebar.selectbox(label="Select which value to compare", 
              options=["Loss", "Correct Token Logit"], index=1)
 df = df_loss if data_select == "Loss" else df_logits
-df = df.rename(columns = {"Unnamed: 0": 'Value'})
 st.dataframe(df, hide_index=True, height=500, width=500)
 
 
@@ -1,9 +1,8 @@
 import streamlit as st
 import pandas as pd
 import plotly.express as px
-from pathlib import Path
-import json
 import plotting_utils
+import dashboard_data
 
 st.set_page_config(page_title="AND-Neurons", page_icon="📊")
 st.sidebar.success("Select an analysis above.")
@@ -20,27 +19,17 @@ run_select = st.sidebar.selectbox(
     "Select run", options=["Run 1", "Run 2", "Run 3"], index=0
 )
 
-if run_select == "Run 1":
-    file_name_append = "_0000"
-elif run_select == "Run 2":
-    file_name_append = "_1000"
-else:
-    file_name_append = "_2000"
-
-#@st.cache_data
-def load_data():
-    path = Path(__file__).parent / f"../data/and_neurons/"
-    dfs = pd.read_pickle(path / f"activation_dfs{file_name_append}.pkl")
-    with open(path / f"ablation_losses{file_name_append}.json", "r") as f:
-        ablation_losses = json.load(f)
-    return dfs, ablation_losses
-
-dfs, ablation_losses = load_data()
-
 hook_select = st.sidebar.selectbox(label="Select between pre-gelu activations and post-gelu activations", options=["hook_pre", "hook_post"], index=1)
 scale_select = st.sidebar.selectbox(label="Select between scaled activation or original activation values", options=["Scaled", "Unscaled"], index=1)
 
-df = dfs[option][hook_select][scale_select]
+@st.cache_data
+def load_data(run, option, hook_name, scale):
+    df = dashboard_data.load_partition("activation_dfs", run, option, hook_name, scale)
+    ablation_losses = dashboard_data.load_partition("ablation_losses", run, option)
+    ablation_losses = ablation_losses[(ablation_losses["hook_name"] == hook_name) & (ablation_losses["scale"] == scale)]
+    return df, ablation_losses
+
+df, ablation_losses = load_data(run_select, option, hook_select, scale_select)
 
 st.markdown("""
             ### Neuron activation data
@@ -124,11 +113,11 @@ st.markdown("""
 
             Uses AND features to select sets of neurons and compares their loss increase.
             """)
-#[option][hook_name][include_mode]
-keys = list(ablation_losses[option][hook_select][scale_select].keys())
+keys = ablation_losses["include_mode"].unique().tolist()
 select_mode = st.selectbox(label="Select whether to use all AND neurons or only the neurons where (YYY>others)",
                               options=keys, index=0)
-num_keys = list(ablation_losses[option][hook_select][scale_select][select_mode].keys())
+mode_losses = ablation_losses[ablation_losses["include_mode"] == select_mode]
+num_keys = mode_losses["num_neurons"].unique().tolist()
 all_option = num_keys.pop(0)
 num_keys.append(all_option)
 
@@ -137,18 +126,13 @@ num_neurons = st.select_slider(
     options=num_keys)
 #st.selectbox(label="Select the number of neurons to ablate", options=num_keys, index=0)
 
-max_loss = -1000
-min_loss = 1000
-for key in num_keys:
-    losses = ablation_losses[option][hook_select][scale_select][select_mode][num_neurons].values()
-    max_loss = max(max_loss, max(losses))
-    min_loss = min(min_loss, min(losses))
-min_loss = min(min_loss, 0)
-max_loss += 0.3
+num_neurons_losses = mode_losses[mode_losses["num_neurons"] == num_neurons]
+max_loss = num_neurons_losses["loss"].max() + 0.3
+min_loss = min(num_neurons_losses["loss"].min(), 0)
 
-names = list(ablation_losses[option][hook_select][scale_select][select_mode][num_neurons].keys())
+names = num_neurons_losses["name"].tolist()
 short_names = [name.split(" ")[0] for name in names]
-loss_values = [[ablation_losses[option][hook_select][scale_select][select_mode][num_neurons][name]] for name in names]
+loss_values = [[loss] for loss in num_neurons_losses["loss"].tolist()]
 plot = plotting_utils.plot_barplot(loss_values, names,
                             short_names=short_names, ylabel="Last token loss",
                             title=f"Loss increase when patching groups of neurons (ablation mode: YYN)",
@@ -16,6 +16,7 @@ from sklearn.metrics import f1_score, matthews_corrcoef
 from sklearn.utils import shuffle
 
 from hook_utils import save_activation
+import haystack_utils
 
 pio.renderers.default = "notebook_connected+notebook"
 device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -30,12 +31,7 @@ def get_act_dimension(model, prompt, activation_hook_name, activation_slice):
     return prompt_activations.shape[-1]
 
 def get_new_word_labels(model: HookedTransformer, tokens: torch.Tensor) -> np.ndarray[bool]:
-    prompt_labels = []
-    for i in range(tokens.shape[0] - 1):
-        next_token_str = model.to_single_str_token(tokens[i + 1].item())
-        next_is_space = next_token_str[0] in [" ", ",", ".", ":", ";", "!", "?"] # [" "] # 
-        prompt_labels.append(next_is_space)
-    return np.array(prompt_labels)
+    return haystack_utils.get_next_token_punctuation_mask(tokens, model, fill_last_pos=False).cpu().numpy()
 
 def get_new_word_labels_and_activations(
     model: HookedTransformer, 
@@ -83,7 +79,8 @@ def get_new_word_labels_and_resid_activations(
     num_class_examples=20_000, scale_x=True
 ) -> tuple[defaultdict, np.ndarray]:
     '''Get activations and labels for predicting word end from activation'''
-    _, cache = model.run_with_cache(model.to_tokens(german_data[0])[0])
+    resid_names = haystack_utils.get_decompose_resid_names(model)
+    cache = haystack_utils.get_truncated_cache(model.to_tokens(german_data[0])[0], model, resid_names)
     resid = cache.decompose_resid(apply_ln=False)[:, 0, :-1, :]
     
     positive_activations = {i: np.empty((num_class_examples, model.cfg.d_model)) for i in range(resid.shape[0])}
@@ -93,7 +90,7 @@ def get_new_word_labels_and_resid_activations(
     for prompt in german_data:
         tokens = model.to_tokens(prompt)[0]
         labels = get_new_word_labels(model, tokens)
-        _, cache = model.run_with_cache(tokens)
+        cache = haystack_utils.get_truncated_cache(tokens, model, resid_names)
         resid = cache.decompose_resid(apply_ln=False)[:, 0, :-1, :]
 
         for i in range(resid.shape[0]):
@@ -132,7 +129,7 @@ def get_is_german_labels_and_resid_activations(
     start = 0
     for prompt in german_data:
         tokens = model.to_tokens(prompt)[0]
-        _, cache = model.run_with_cache(tokens)
+        cache = haystack_utils.get_truncated_cache(tokens, model, f'blocks.{layer}.hook_resid_pre')
         acts = cache[f'blocks.{layer}.hook_resid_pre'][0].cpu().numpy()
 
 
@@ -147,7 +144,7 @@ def get_is_german_labels_and_resid_activations(
     start = 0
     for prompt in english_data:
         tokens = model.to_tokens(prompt)[0]
-        _, cache = model.run_with_cache(tokens)
+        cache = haystack_utils.get_truncated_cache(tokens, model, f'blocks.{layer}.hook_resid_pre')
         acts = cache[f'blocks.{layer}.hook_resid_pre'][0].cpu().numpy()
 
         if start < num_class_examples:
@@ -180,6 +177,82 @@ def get_probe_score(lr_model: LogisticRegression, x: np.ndarray, y: np.ndarray)
     mcc = matthews_corrcoef(y, preds)
     return f1, mcc
 
+def get_batched_probes(x: torch.Tensor, y: torch.Tensor, C=1.0, max_iter=100, tol=1e-8, max_halvings=30) -> tuple[torch.Tensor, torch.Tensor]:
+    """Fits an independent 1-D logistic regression probe to every column of x with vectorised Newton steps.
+    Minimises the same objective as sklearn's default LogisticRegression: summed log loss plus an L2 penalty of 1 / 2C on the
+    (unpenalised intercept excluded) weight.
+
+    Each probe's step is halved until its objective decreases, so probes with saturated probabilities (a near singular
+    Hessian) take short steps instead of diverging, and each probe stops once its own step is below tol.
+
+    Args:
+        x: [n_samples n_probes] features, one column per probe.
+        y: [n_samples] binary labels shared by all probes.
+
+    Returns:
+        weights, intercepts: [n_probes] each.
+    """
+    x = x.to(torch.float64)
+    y = y.to(torch.float64).unsqueeze(-1)
+
+    def get_objectives(weights, intercepts):
+        logits = x * weights + intercepts
+        return (torch.nn.functional.softplus(logits) - y * logits).sum(0) + weights**2 / (2 * C)
+
+    weights = torch.zeros(x.shape[1], dtype=torch.float64, device=x.device)
+    intercepts = torch.zeros_like(weights)
+    objectives = get_objectives(weights, intercepts)
+    active = torch.ones_like(weights, dtype=torch.bool)
+    for _ in range(max_iter):
+        probs = torch.sigmoid(x * weights + intercepts)
+        residuals = probs - y
+        grad_w = (residuals * x).sum(0) + weights / C
+        grad_b = residuals.sum(0)
+        # Per probe 2x2 Hessian, inverted in closed form. The determinant is 0 once the probabilities saturate.
+        s = probs * (1 - probs)
+        h_ww = (s * x * x).sum(0) + 1 / C
+        h_wb = (s * x).sum(0)
+        h_bb = s.sum(0)
+        det = (h_ww * h_bb - h_wb**2).clamp_min(1e-12)
+        step_w = torch.where(active, (h_bb * grad_w - h_wb * grad_b) / det, 0)
+        step_b = torch.where(active, (h_ww * grad_b - h_wb * grad_w) / det, 0)
+
+        # Backtracking line search with the Armijo condition, per probe
+        expected_decrease = grad_w * step_w + grad_b * step_b
+        step_size = torch.ones_like(weights)
+        for _ in range(max_halvings):
+            new_objectives = get_objectives(weights - step_size * step_w, intercepts - step_size * step_b)
+            accepted = new_objectives <= objectives - 1e-4 * step_size * expected_decrease
+            if accepted.all():
+                break
+            step_size = torch.where(accepted, step_size, step_size / 2)
+        step_size = torch.where(accepted, step_size, 0)
+        weights -= step_size * step_w
+        intercepts -= step_size * step_b
+        objectives = torch.where(accepted, new_objectives, objectives)
+
+        active &= accepted & (torch.maximum((step_size * step_w).abs(), (step_size * step_b).abs()) >= tol)
+        if not active.any():
+            break
+    return weights, intercepts
+
+
+def get_batched_probe_scores(weights: torch.Tensor, intercepts: torch.Tensor, x: torch.Tensor, y: torch.Tensor) -> tuple[np.ndarray, np.ndarray]:
+    """F1 and MCC of every probe from get_batched_probes, matching get_probe_score (scores are 0 where they are undefined)."""
+    preds = (x.to(torch.float64) * weights + intercepts) > 0
+    y = y.bool().unsqueeze(-1)
+    tp = (preds & y).sum(0).to(torch.float64)
+    fp = (preds & ~y).sum(0).to(torch.float64)
+    fn = (~preds & y).sum(0).to(torch.float64)
+    tn = (~preds & ~y).sum(0).to(torch.float64)
+
+    f1_denominator = 2 * tp + fp + fn
+    f1 = torch.where(f1_denominator > 0, 2 * tp / f1_denominator, 0)
+    mcc_denominator = ((tp + fp) * (tp + fn) * (tn + fp) * (tn + fn)).sqrt()
+    mcc = torch.where(mcc_denominator > 0, (tp * tn - fp * fn) / mcc_denominator, 0)
+    return f1.cpu().numpy(), mcc.cpu().numpy()
+
+
 def get_and_score_new_word_probe(
     model: HookedTransformer, 
     german_data: list[str], 
@@ -34,15 +34,6 @@ common_tokens = haystack_utils.get_common_tokens(german_data, model, all_ignore,
 LAYER, NEURON = 8, 2994
 neuron_activations = haystack_utils.get_mlp_activations(german_data, LAYER, model, neurons=torch.LongTensor([NEURON]), mean=False).flatten()
 
-def get_next_token_punctuation_mask(tokens: torch.LongTensor) -> torch.BoolTensor:
-    next_token_punctuation_mask = torch.zeros_like(tokens, dtype=torch.bool)
-    token_strs = model.to_str_tokens(tokens)
-    for i in range(tokens.shape[0] - 1):
-        next_token_str = token_strs[i + 1]
-        next_is_space = next_token_str[0] in [" ", ",", ".", ":", ";", "!", "?"]
-        next_token_punctuation_mask[i] = next_is_space
-    return next_token_punctuation_mask
-
 # %% 
 
 def snap_pos_to_peak_1(value, hook):
@@ -130,7 +121,7 @@ activate_context_hooks = []
 data = []
 for prompt in tqdm(german_data[:200]):
     tokens = model.to_tokens(prompt)[0]
-    mask = get_next_token_punctuation_mask(tokens)[:-1].cpu()
+    mask = haystack_utils.get_next_token_punctuation_mask(tokens, model)[:-1].cpu()
 
     # Snap to peak 1
     # Let other components read from normal context neuron
@@ -201,7 +192,7 @@ for prompt in german_data[:10]:
 data = []
 for prompt in tqdm(german_data[:200]):
     tokens = model.to_tokens(prompt)[0]
-    mask = get_next_token_punctuation_mask(tokens)[:-1].cpu()
+    mask = haystack_utils.get_next_token_punctuation_mask(tokens, model)[:-1].cpu()
 
     original_p1, activated_p1, ablated_p1, direct_effect_p1, indirect_effect_p1 = haystack_utils.get_context_effect(prompt, model,
                             context_ablation_hooks=snap_pos_to_peak_1_hook, context_activation_hooks=snap_pos_to_peak_2_hook,
@@ -244,7 +235,7 @@ fig.show()
 data = []
 for prompt in tqdm(german_data[:200]):
     tokens = model.to_tokens(prompt)[0]
-    mask = get_next_token_punctuation_mask(tokens)[:-1].cpu()
+    mask = haystack_utils.get_next_token_punctuation_mask(tokens, model)[:-1].cpu()
 
     original_p1, activated_p1, ablated_p1, direct_effect_p1, indirect_effect_p1 = haystack_utils.get_context_effect(prompt, model,
                             context_ablation_hooks=snap_pos_to_peak_2_hook, context_activation_hooks=snap_pos_to_peak_1_hook,
@@ -294,7 +285,7 @@ erase_feature_l8_hooks = [('blocks.8.mlp.hook_post', erase_next_token_is_space_l
 data = []
 for prompt in tqdm(german_data[:200]):
     tokens = model.to_tokens(prompt)[0]
-    mask = get_next_token_punctuation_mask(tokens)[:-1].cpu()
+    mask = haystack_utils.get_next_token_punctuation_mask(tokens, model)[:-1].cpu()
 
     original_leace, activated, ablated_leace, direct_effect_leace, indirect_effect_leace = haystack_utils.get_context_effect(prompt, model,
                             context_ablation_hooks=erase_feature_l8_hooks, context_activation_hooks=[],
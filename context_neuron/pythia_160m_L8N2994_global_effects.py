@@ -36,15 +36,6 @@ common_tokens = haystack_utils.get_common_tokens(german_data, model, all_ignore,
 LAYER, NEURON = 8, 2994
 neuron_activations = haystack_utils.get_mlp_activations(german_data, LAYER, model, neurons=torch.LongTensor([NEURON]), mean=False).flatten()
 
-def get_next_token_punctuation_mask(tokens: torch.LongTensor) -> torch.BoolTensor:
-    next_token_punctuation_mask = torch.zeros_like(tokens, dtype=torch.bool)
-    token_strs = model.to_str_tokens(tokens)
-    for i in range(tokens.shape[0] - 1):
-        next_token_str = token_strs[i + 1]
-        next_is_space = next_token_str[0] in [" ", ",", ".", ":", ";", "!", "?"]
-        next_token_punctuation_mask[i] = next_is_space
-    return next_token_punctuation_mask
-
 
 # %%
 
@@ -53,14 +53,6 @@ common_tokens = haystack_utils.get_common_tokens(german_data, model, all_ignore,
 LAYER, NEURON = 8, 2994
 neuron_activations = haystack_utils.get_mlp_activations(german_data, LAYER, model, neurons=torch.LongTensor([NEURON]), mean=False).flatten()
 
-def get_next_token_punctuation_mask(tokens: torch.LongTensor) -> torch.BoolTensor:
-    next_token_punctuation_mask = torch.zeros_like(tokens, dtype=torch.bool)
-    token_strs = model.to_str_tokens(tokens)
-    for i in range(tokens.shape[0] - 1):
-        next_token_str = token_strs[i + 1]
-        next_is_space = next_token_str[0] in [" ", ",", ".", ":", ";", "!", "?"]
-        next_token_punctuation_mask[i] = next_is_space
-    return next_token_punctuation_mask
 # %%
 # px.histogram(neuron_activations.cpu().numpy())
 ranges, labels = [(-10, 0.2), (0.8, 4.1), (4.8, 10)], ['Inactive', 'Peak 1', 'Peak 2']
@@ -80,10 +72,7 @@ def compute_new_word_f1(model, german_data, layer, neuron):
             with model.hooks([(hook_name, save_activation)]):
                 model(prompt)
             prompt_activations = model.hook_dict[hook_name].ctx['activation'][0, :-1, neuron].flatten().tolist()
-            for i in range(tokens.shape[0] - 1):
-                next_token_str = model.to_single_str_token(tokens[i + 1].item())
-                next_is_space = next_token_str[0] in [" ", ",", ".", ":", ";", "!", "?"]
-                prompt_labels.append(next_is_space)
+            prompt_labels = haystack_utils.get_next_token_punctuation_mask(tokens, model, fill_last_pos=False).tolist()
             activations.extend(prompt_activations)
             labels.extend(prompt_labels)
             assert len(prompt_activations) == len(prompt_labels)
@@ -115,9 +104,9 @@ def plot_peak_new_word_accuracies(model, german_data, layer, neuron):
         with model.hooks([(hook_name, save_activation)]):
             model(prompt)
         pos_wise_diff = trimodal_interest_measure(model.hook_dict[hook_name].ctx['activation'][0, :, neuron])
+        next_is_space_mask = haystack_utils.get_next_token_punctuation_mask(tokens, model, fill_last_pos=False).tolist()
         for i in range(tokens.shape[0] - 1):
-            next_token_str = model.to_single_str_token(tokens[i + 1].item())
-            next_is_space = next_token_str[0] in [" ", ",", ".", ":", ";", "!", "?"]
+            next_is_space = next_is_space_mask[i]
             if pos_wise_diff[i] == 1:
                 data.append(["Peak 1", next_is_space])
             elif pos_wise_diff[i] == 2:
@@ -160,7 +149,7 @@ def print_conditional_ablation_losses(model=model, german_data=german_data, neur
     original_other_token_losses = []
     for prompt in tqdm(german_data):
         tokens = model.to_tokens(prompt)[0]
-        mask = get_next_token_punctuation_mask(tokens)
+        mask = haystack_utils.get_next_token_punctuation_mask(tokens, model)
 
         original_loss = model(prompt, return_type='loss', loss_per_token=True).flatten()
         
@@ -242,12 +231,12 @@ def get_tokenwise_high_loss_diffs(prompt: str, model: HookedTransformer):
 # %%
 for prompt in german_data[:5]:
     tokens = model.to_tokens(prompt)[0]
-    mask = get_next_token_punctuation_mask(tokens)
+    mask = haystack_utils.get_next_token_punctuation_mask(tokens, model)
     print_prompt(prompt, get_ablate_at_mask_hooks(mask, 5.5))
 # %%
 for prompt in german_data[:5]:
     tokens = model.to_tokens(prompt)[0]
-    mask = get_next_token_punctuation_mask(tokens)
+    mask = haystack_utils.get_next_token_punctuation_mask(tokens, model)
     print_prompt(prompt, get_ablate_at_mask_hooks(~mask, 5.5))
 
 # %%
@@ -388,7 +377,7 @@ def get_peak_losses(model: HookedTransformer, data: list[str]) -> pd.DataFrame:
 
     for prompt in tqdm(data):
         tokens = model.to_tokens(prompt)[0]
-        mask = get_next_token_punctuation_mask(tokens)[:-1].cpu()
+        mask = haystack_utils.get_next_token_punctuation_mask(tokens, model)[:-1].cpu()
 
         with model.hooks([(f'blocks.{LAYER}.mlp.hook_post', snap_to_closest_peak)]):
             loss = model(prompt, return_type='loss', loss_per_token=True).flatten().cpu()
@@ -524,13 +513,10 @@ def final_token_loss_diff(model: HookedTransformer, tokens: torch.Tensor, fwd_ho
 
 def plot_truncated_prompt_losses(model: HookedTransformer, fwd_hooks: list[tuple[str, callable]], 
                                  tokens: torch.LongTensor, stop: int | None=None, title: str | None=None) -> None:
-    loss_diffs = []
-    xticks = []
     stop = stop if stop is not None else tokens.shape[-1]
-    for i in range(-2, -stop, -1):
-        loss_diffs.append(final_token_loss_diff(model, tokens[..., i:], fwd_hooks))
-        xticks.append(str(i))
-    plotting_utils.line(loss_diffs, xticks=xticks, xlabel='Starting left index', ylabel='Final token loss', 
+    starts = list(range(-2, -stop, -1))
+    loss_diffs = haystack_utils.get_left_crop_loss_differences(tokens, model, fwd_hooks, starts).mean(dim=0).cpu()
+    plotting_utils.line(loss_diffs, xticks=[str(i) for i in starts], xlabel='Starting left index', ylabel='Final token loss', 
                         title=title if title is not None else "Loss diff with different number of tokens before the high loss token")
 
 # %%
@@ -61,15 +61,6 @@ LAYER, NEURON = 3, 669
 neuron_activations = haystack_utils.get_mlp_activations(german_data, LAYER, model, neurons=torch.LongTensor([NEURON]), mean=False).flatten()
 # %%
 
-def get_next_token_punctuation_mask(tokens: torch.LongTensor) -> torch.BoolTensor:
-    next_token_punctuation_mask = torch.zeros_like(tokens, dtype=torch.bool)
-    token_strs = model.to_str_tokens(tokens)
-    for i in range(tokens.shape[0] - 1):
-        next_token_str = token_strs[i + 1]
-        next_is_space = next_token_str[0] in [" ", ",", ".", ":", ";", "!", "?"]
-        next_token_punctuation_mask[i] = next_is_space
-    return next_token_punctuation_mask
-
 # %%
 hook_name = 'blocks.3.mlp.hook_post'
 
@@ -80,7 +71,7 @@ labels = []
 hooks = [(hook_name, save_activation)]
 for prompt in german_data:
     tokens = model.to_tokens(prompt)[0]
-    next_token_punctuation_mask = get_next_token_punctuation_mask(tokens).flatten()
+    next_token_punctuation_mask = haystack_utils.get_next_token_punctuation_mask(tokens, model).flatten()
 
     with model.hooks(hooks):
         model(prompt)
@@ -51,6 +51,16 @@ def test_get_average_loss_batched():
     torch.testing.assert_close(loss.mean(), avg_loss)
 
 
+def test_get_average_loss_length_bucketed():
+    model = HookedTransformer.from_pretrained("pythia-70m-v0", fold_ln=True, device="cuda")
+    prompts = haystack_utils.load_txt_data("data/kde4_french.txt")[:20]
+
+    avg_loss = haystack_utils.get_average_loss(prompts, model, crop_context=-1, fwd_hooks=[], positionwise=False)
+    batched_avg_loss = haystack_utils.get_average_loss(prompts, model, crop_context=-1, fwd_hooks=[], positionwise=False, batch_size=8)
+
+    torch.testing.assert_close(batched_avg_loss, avg_loss)
+
+
 def test_weighted_mean():
     mean_acts = [torch.tensor([0.0]), torch.tensor([1.0])]
     weighted_mean = haystack_utils.weighted_mean(mean_acts, [1, 2])
@@ -145,4 +155,141 @@ def test_get_direct_effect_consistency():
         disabled_loss_increase = ((disabled_loss.mean() - original_loss.mean()) / original_loss.mean()).item()
 
     torch.testing.assert_close(ablation_loss_increase.item(), disabled_loss_increase, atol=0.01, rtol=0.0)
-    torch.testing.assert_close(ablation_loss_increase.item(), 0.1341, atol=0.01, rtol=0.0)
\ No newline at end of file
+    torch.testing.assert_close(ablation_loss_increase.item(), 0.1341, atol=0.01, rtol=0.0)
+
+def test_neuron_attribution_patching_matches_exact_patching():
+    test_prompts = ["chicken soup", "chicken wing"]
+    model = HookedTransformer.from_pretrained("EleutherAI/pythia-70m", fold_ln=True, device="cuda")
+    hook = hook_utils.get_ablate_neuron_hook(3, 669, -0.2, 'post')
+    with model.hooks([hook]):
+        _, ablated_cache = model.run_with_cache(test_prompts)
+    patched_post = ablated_cache["blocks.5.mlp.hook_post"]
+
+    neurons = [0, 1, 2]
+    exact_diffs = haystack_utils.get_neuron_patching_losses(test_prompts, model, neurons, patched_post, variant_batch_size=2)
+    original_loss = model(test_prompts, return_type="loss", loss_per_token=True)[:, -1]
+    for i, neuron in enumerate(neurons):
+        def patch_neuron_hook(value, hook):
+            value[:, :, neuron] = patched_post[:, :, neuron]
+            return value
+        with model.hooks([("blocks.5.mlp.hook_post", patch_neuron_hook)]):
+            patched_loss = model(test_prompts, return_type="loss", loss_per_token=True)[:, -1]
+        torch.testing.assert_close(exact_diffs[i], patched_loss - original_loss, atol=1e-4, rtol=0.0)
+
+    effects, top_neurons, top_exact_diffs = haystack_utils.get_neuron_attribution_patching_effects(test_prompts, model, patched_post, verify_top_k=5)
+    assert effects.shape == (model.cfg.d_mlp, len(test_prompts))
+    torch.testing.assert_close(top_exact_diffs, haystack_utils.get_neuron_patching_losses(test_prompts, model, top_neurons, patched_post))
+    # The last MLP only affects the loss through the unembedding, so the linear estimate is close for single neurons
+    torch.testing.assert_close(effects[top_neurons], top_exact_diffs, atol=0.05, rtol=0.2)
+
+
+def test_neuron_patching_losses_with_path_patched_mlp5():
+    # Same setup as the individual neuron cell of compute_verify_bigrams_data.py, against its original per-neuron loop
+    test_prompts = ["Die Präsidentin der Europäischen", "Als nächster Punkt folgt die"]
+    model = HookedTransformer.from_pretrained("EleutherAI/pythia-70m", fold_ln=True, device="cuda")
+    tokens = model.to_tokens(test_prompts)
+    deactivate_hooks = [hook_utils.get_ablate_neuron_hook(3, 669, 0.0, 'post')]
+    activate_hooks = [hook_utils.get_ablate_neuron_hook(3, 669, 3.0, 'post')]
+
+    ablated_post, activated_post = haystack_utils.get_direct_effect(tokens, model, deactivate_hooks, activate_hooks, pos=-1, return_type="cache")
+    def path_patch_mlp5_hook(value, hook):
+        return activated_post["hook_post"]
+    path_patch_hooks = deactivate_hooks + [('blocks.5.mlp.hook_post', path_patch_mlp5_hook)]
+
+    neurons = [0, 1, 2, 3, 4]
+    diffs = haystack_utils.get_neuron_patching_losses(tokens, model, neurons, ablated_post["hook_post"], path_patch_hooks, variant_batch_size=2)
+
+    _, _, _, baseline_loss = haystack_utils.get_direct_effect(tokens, model, deactivate_hooks, activate_hooks, pos=-1)
+    for i, neuron in enumerate(neurons):
+        def ablate_neuron_hook(value, hook):
+            value[:, :, neuron] = ablated_post["hook_post"][:, :, neuron]
+            return value
+        _, _, _, only_activated_loss = haystack_utils.get_direct_effect(
+            tokens, model, deactivate_hooks, activate_hooks + [('blocks.5.mlp.hook_post', ablate_neuron_hook)], pos=-1)
+        torch.testing.assert_close(diffs[i], only_activated_loss - baseline_loss, atol=1e-4, rtol=0.0)
+
+    effects, top_neurons, top_exact_diffs = haystack_utils.get_neuron_attribution_patching_effects(
+        tokens, model, ablated_post["hook_post"], path_patch_hooks, verify_top_k=3, variant_batch_size=2)
+    assert effects.shape == (model.cfg.d_mlp, len(test_prompts))
+    torch.testing.assert_close(top_exact_diffs, haystack_utils.get_neuron_patching_losses(tokens, model, top_neurons, ablated_post["hook_post"], path_patch_hooks))
+
+def test_crop_sweep_losses_match_cropped_prompts():
+    german_data = 'Abstimmungsstunde\nDie Präsidentin\nAls nächster Punkt folgt die Abstimmung.'
+    hook = hook_utils.get_ablate_neuron_hook(3, 669, -0.2, 'post')
+    freeze_act_names = ("blocks.4.hook_attn_out", "blocks.5.hook_attn_out")
+    model = HookedTransformer.from_pretrained("EleutherAI/pythia-70m", fold_ln=True, device="cuda")
+
+    original_losses, ablated_losses, frozen_losses = haystack_utils.get_crop_sweep_losses([german_data, "chicken"], model, [hook], freeze_act_names)
+    for crop_context_end in [5, 10, model.to_tokens(german_data).shape[1]]:
+        expected = haystack_utils.get_frozen_loss_difference_position(german_data, model, [hook], freeze_act_names, crop_context_end=crop_context_end)
+        actual = [losses[0, crop_context_end - 2].item() for losses in [original_losses, ablated_losses, frozen_losses]]
+        torch.testing.assert_close(actual, list(expected), atol=1e-4, rtol=0.0)
+    num_losses = model.to_tokens("chicken").shape[1] - 1
+    assert not original_losses[1, :num_losses].isnan().any() and original_losses[1, num_losses:].isnan().all()
+
+
+def test_left_crop_loss_differences_match_cropped_prompts():
+    model = HookedTransformer.from_pretrained("EleutherAI/pythia-70m", fold_ln=True, device="cuda")
+    tokens = model.to_tokens("Die Präsidentin der Europäischen Allianz")
+    hooks = [hook_utils.get_ablate_neuron_hook(3, 669, -0.2, 'post')]
+
+    loss_diffs = haystack_utils.get_left_crop_loss_differences(tokens, model, hooks, crop_batch_size=3)
+    for i, start in enumerate(range(-2, -tokens.shape[1], -1)):
+        original_loss = model(tokens[:, start:], return_type="loss", loss_per_token=True)[:, -1]
+        with model.hooks(hooks):
+            ablated_loss = model(tokens[:, start:], return_type="loss", loss_per_token=True)[:, -1]
+        torch.testing.assert_close(loss_diffs[:, i], ablated_loss - original_loss, atol=1e-4, rtol=0.0)
+
+
+def test_run_with_cache_plan_matches_run_with_cache():
+    test_prompts = ["chicken soup", "chicken wing"]
+    names = ["blocks.4.hook_attn_out", "blocks.5.mlp.hook_post"]
+    model = HookedTransformer.from_pretrained("EleutherAI/pythia-70m", fold_ln=True, device="cuda")
+
+    original_loss, original_cache = model.run_with_cache(test_prompts, return_type="loss", loss_per_token=True)
+    loss, cache = haystack_utils.run_with_cache_plan(test_prompts, model, names, return_type="loss", loss_per_token=True)
+    torch.testing.assert_close(loss, original_loss)
+    assert set(cache.keys()) == set(names)
+    for name in names:
+        torch.testing.assert_close(cache[name], original_cache[name])
+
+    _, offloaded_cache = haystack_utils.run_with_cache_plan(test_prompts, model, names, storage="cpu_fp16", return_type=None)
+    for name in names:
+        assert offloaded_cache[name].device.type == "cpu" and offloaded_cache[name].dtype == torch.float16
+        torch.testing.assert_close(offloaded_cache[name].float(), original_cache[name].cpu(), atol=1e-2, rtol=1e-2)
+
+
+def test_neuron_subset_logprob_differences_match_serial_direct_effect():
+    # Same metric as the serial get_direct_effect(return_type='logprobs') loop of compute_verify_bigrams_data.py
+    test_prompts = ["Die Präsidentin der Europäischen", "Als nächster Punkt folgt die"]
+    model = HookedTransformer.from_pretrained("EleutherAI/pythia-70m", fold_ln=True, device="cuda")
+    tokens = model.to_tokens(test_prompts)
+    deactivate_hooks = [hook_utils.get_ablate_neuron_hook(3, 669, 0.0, 'post')]
+    activate_hooks = [hook_utils.get_ablate_neuron_hook(3, 669, 3.0, 'post')]
+
+    neuron_subsets = [[0], [1, 2], [3, 4, 5]]
+    mean_logprobs, logprob_differences = haystack_utils.get_neuron_subset_logprob_differences(
+        tokens, model, neuron_subsets, deactivate_hooks, activate_hooks, variant_batch_size=2)
+
+    _, _, _, all_MLP5_logprobs = haystack_utils.get_direct_effect(tokens, model, deactivate_hooks, activate_hooks, pos=-2, return_type='logprobs')
+    torch.testing.assert_close(mean_logprobs, all_MLP5_logprobs.mean(0), atol=1e-3, rtol=0.0)
+    ablated_post, _ = haystack_utils.get_direct_effect(tokens, model, deactivate_hooks, activate_hooks, pos=-2, return_type="cache")
+    for i, neurons in enumerate(neuron_subsets):
+        def ablate_neurons_hook(value, hook):
+            value[:, :, neurons] = ablated_post["hook_post"][:, :, neurons]
+            return value
+        _, _, _, subset_logprobs = haystack_utils.get_direct_effect(
+            tokens, model, deactivate_hooks, activate_hooks + [('blocks.5.mlp.hook_post', ablate_neurons_hook)], pos=-2, return_type='logprobs')
+        torch.testing.assert_close(logprob_differences[i], (all_MLP5_logprobs - subset_logprobs).mean(0), atol=1e-3, rtol=0.0)
+
+    # Per prompt losses, as in the top / bottom neuron cell of compute_verify_bigrams_data.py
+    subset_losses = haystack_utils.get_neuron_subset_metrics(tokens, model, neuron_subsets, deactivate_hooks, activate_hooks, pos=-1, variant_batch_size=3)
+    _, _, _, all_MLP5_loss = haystack_utils.get_direct_effect(tokens, model, deactivate_hooks, activate_hooks, pos=-1)
+    torch.testing.assert_close(subset_losses[0], all_MLP5_loss, atol=1e-4, rtol=0.0)
+    for i, neurons in enumerate(neuron_subsets):
+        def ablate_neurons_hook(value, hook):
+            value[:, :, neurons] = ablated_post["hook_post"][:, :, neurons]
+            return value
+        _, _, _, subset_loss = haystack_utils.get_direct_effect(
+            tokens, model, deactivate_hooks, activate_hooks + [('blocks.5.mlp.hook_post', ablate_neurons_hook)], pos=-1)
+        torch.testing.assert_close(subset_losses[i + 1], subset_loss, atol=1e-4, rtol=0.0)
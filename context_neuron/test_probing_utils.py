@@ -0,0 +1,41 @@
+import numpy as np
+import torch
+from sklearn.model_selection import train_test_split
+
+import probing_utils
+from checkpoints_feature_formation import train_probe, SEED
+
+
+def get_probe_data(n=500):
+    generator = torch.Generator().manual_seed(0)
+    positive = torch.randn(n, 5, generator=generator, dtype=torch.float64)
+    negative = torch.randn(n, 5, generator=generator, dtype=torch.float64)
+    positive[:, 0] += 1.0
+    positive[:, 1] += 0.1
+    # Perfectly separable, which saturates the probabilities of an undamped Newton fit
+    positive[:, 2] = positive[:, 2].abs() + 1
+    negative[:, 2] = -negative[:, 2].abs() - 1
+    positive[:, 3] = negative[:, 3] = 0
+    positive[:, 4] = positive[:, 4].abs() * 100
+    negative[:, 4] = -negative[:, 4].abs()
+    return positive, negative
+
+
+def test_batched_probes_match_train_probe():
+    positive, negative = get_probe_data()
+
+    # Same scaling and split as get_layer_probe_performance
+    labels = torch.cat([torch.ones(len(positive)), torch.zeros(len(negative))])
+    data = torch.cat([positive, negative])
+    std = data.std(0, unbiased=False)
+    data = (data - data.mean(0)) / torch.where(std == 0, 1, std)
+    train_indices, test_indices = train_test_split(np.arange(len(labels)), test_size=0.2, random_state=SEED)
+    train_indices, test_indices = torch.from_numpy(train_indices), torch.from_numpy(test_indices)
+    weights, intercepts = probing_utils.get_batched_probes(data[train_indices], labels[train_indices])
+    f1s, mccs = probing_utils.get_batched_probe_scores(weights, intercepts, data[test_indices], labels[test_indices])
+
+    assert torch.isfinite(weights).all() and torch.isfinite(intercepts).all()
+    for column in range(positive.shape[1]):
+        f1, mcc = train_probe(positive[:, [column]], negative[:, [column]])
+        np.testing.assert_allclose([f1s[column], mccs[column]], [f1, mcc], atol=0.01)
+    assert f1s[2] == 1.0 and mccs[2] == 1.0
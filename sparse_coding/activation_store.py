@@ -0,0 +1,243 @@
+"""Pre-computed activation store for autoencoder training.
+
+Running this file writes the hook activations for the training tokens to memory-mapped .npy shards once:
+
+```
+python activation_store.py --activation_store_path /workspace/data/activations/tiny-stories-2L-33M_1_mlp.hook_post
+```
+
+Training runs started with the same --activation_store_path stream shuffled batches from the shards instead of rerunning the model,
+so every run in a sweep can share one activation dump.
+"""
+import os
+import sys
+import json
+import queue
+import threading
+
+import torch
+import numpy as np
+from torch import Tensor
+from jaxtyping import Int, Float
+from tqdm.auto import tqdm
+from transformer_lens import HookedTransformer
+
+sys.path.append("../")
+from utils.haystack_utils import get_device, get_truncated_cache
+
+
+# numpy has no bfloat16, so bfloat16 activations are stored as their raw int16 bits
+STORAGE_DTYPES = {
+    "float16": (torch.float16, np.float16),
+    "bfloat16": (torch.bfloat16, np.int16),
+}
+
+
+def get_shard_path(store_path: str, shard_index: int) -> str:
+    return os.path.join(store_path, f"shard_{shard_index}.npy")
+
+
+def load_store_metadata(store_path: str) -> dict:
+    metadata_path = os.path.join(store_path, "metadata.json")
+    if not os.path.exists(metadata_path):
+        raise FileNotFoundError(f"No complete activation store found at {store_path}, run activation_store.py first")
+    with open(metadata_path, "r") as f:
+        return json.load(f)
+
+
+def clear_store(store_path: str):
+    """Remove the metadata and all shards of a previous store at store_path. The metadata goes first, so a reader never pairs it
+    with shards of the new store."""
+    metadata_path = os.path.join(store_path, "metadata.json")
+    if os.path.exists(metadata_path):
+        os.remove(metadata_path)
+    for file_name in os.listdir(store_path):
+        if file_name.startswith("shard_") and file_name.endswith(".npy"):
+            os.remove(os.path.join(store_path, file_name))
+
+
+def save_store_metadata(store_path: str, metadata: dict):
+    """Write the metadata under a temporary name and rename it, so a crash never leaves a partial metadata file"""
+    metadata_path = os.path.join(store_path, "metadata.json")
+    with open(metadata_path + ".tmp", "w") as f:
+        json.dump(metadata, f, indent=4)
+    os.replace(metadata_path + ".tmp", metadata_path)
+
+
+def load_shard(store_path: str, shard_index: int) -> np.memmap:
+    """Memory-mapped shard, rows are only read from disk when they are accessed"""
+    return np.load(get_shard_path(store_path, shard_index), mmap_mode="r")
+
+
+def to_tensor(acts: np.ndarray, dtype: str) -> Float[Tensor, "n_tokens d_in"]:
+    torch_dtype, _ = STORAGE_DTYPES[dtype]
+    return torch.from_numpy(acts).view(torch_dtype)
+
+
+@torch.no_grad()
+def write_activation_store(
+    model: HookedTransformer,
+    all_tokens: Int[Tensor, "batch seq_len"],
+    hook_name: str,
+    store_path: str,
+    model_batch_size: int = 128,
+    shard_size: int = 2**22,
+    dtype: str = "bfloat16",
+):
+    """Run the model over all_tokens once and write the activations at hook_name to .npy shards of shard_size tokens each.
+    Any previous store at store_path is removed first and the metadata file is written last, so an interrupted dump is never
+    picked up by ActivationStore."""
+    torch_dtype, np_dtype = STORAGE_DTYPES[dtype]
+    os.makedirs(store_path, exist_ok=True)
+    clear_store(store_path)
+
+    num_tokens = all_tokens.numel()
+    num_written = 0
+    shard_sizes = []
+    shard = None
+    shard_pointer = 0
+    d_in = None
+    for i in tqdm(range(0, all_tokens.shape[0], model_batch_size)):
+        tokens = all_tokens[i : i + model_batch_size].to(torch.long)
+        with torch.autocast("cuda", torch.bfloat16):
+            cache = get_truncated_cache(tokens, model, hook_name)
+        d_in = cache[hook_name].shape[-1]
+        acts = cache[hook_name].reshape(-1, d_in).to(torch_dtype).cpu()
+        if torch_dtype == torch.bfloat16:
+            acts = acts.view(torch.int16)
+        acts = acts.numpy()
+
+        acts_pointer = 0
+        while acts_pointer < acts.shape[0]:
+            if shard is None:
+                shard_rows = min(shard_size, num_tokens - num_written)
+                shard = np.lib.format.open_memmap(
+                    get_shard_path(store_path, len(shard_sizes)), mode="w+", dtype=np_dtype, shape=(shard_rows, d_in)
+                )
+                shard_pointer = 0
+            num_rows = min(acts.shape[0] - acts_pointer, shard.shape[0] - shard_pointer)
+            shard[shard_pointer : shard_pointer + num_rows] = acts[acts_pointer : acts_pointer + num_rows]
+            shard_pointer += num_rows
+            acts_pointer += num_rows
+            num_written += num_rows
+            if shard_pointer == shard.shape[0]:
+                shard.flush()
+                shard_sizes.append(shard.shape[0])
+                shard = None
+
+    metadata = {
+        "hook_name": hook_name,
+        "d_in": d_in,
+        "dtype": dtype,
+        "num_tokens": num_written,
+        "shard_sizes": shard_sizes,
+    }
+    save_store_metadata(store_path, metadata)
+    print(f"Wrote {num_written} activations of {hook_name} to {len(shard_sizes)} shards in {store_path}")
+
+
+class ActivationStore:
+    """
+    Streams shuffled batches of activations from a store written by write_activation_store. Can be used in place of Buffer.
+    A background thread memory-maps shuffle_shards shards at a time in a random order and splits them into blocks of block_size
+    rows. Random blocks from all of these shards are gathered into a buffer of buffer_size rows, whose rows are shuffled and
+    queued as batches up to prefetch_batches ahead of the training loop. Cycles through the store indefinitely, counting epochs.
+
+    Host memory is bounded by the buffer, independent of the shard size: about 2 * buffer_size rows while a buffer is shuffled,
+    plus prefetch_batches * batch_size rows in the queue, at d_in * 2 bytes per row.
+    """
+
+    def __init__(
+        self,
+        store_path: str,
+        batch_size: int,
+        device,
+        shuffle_shards: int = 4,
+        prefetch_batches: int = 16,
+        seed: int = 47,
+        buffer_size: int = 2**19,
+        block_size: int = 2**12,
+    ):
+        self.metadata = load_store_metadata(store_path)
+        self.store_path = store_path
+        self.batch_size = batch_size
+        self.device = device
+        self.shuffle_shards = shuffle_shards
+        self.buffer_size = buffer_size
+        self.block_size = block_size
+        self.hook_name = self.metadata["hook_name"]
+        self.epoch = 0
+        self.generator = torch.Generator().manual_seed(seed)
+        self.pin_memory = torch.cuda.is_available() and str(device).startswith("cuda")
+
+        self.queue = queue.Queue(maxsize=prefetch_batches)
+        self.thread = threading.Thread(target=self.fill_queue, daemon=True)
+        self.thread.start()
+        print(
+            f"\nActivation store: {self.metadata['num_tokens']} tokens of {self.hook_name} in {len(self.metadata['shard_sizes'])} shards, "
+            f"batch_shape: {(batch_size, self.metadata['d_in'])}"
+        )
+
+    def fill_queue(self):
+        try:
+            num_shards = len(self.metadata["shard_sizes"])
+            blocks_per_buffer = max(1, self.buffer_size // self.block_size)
+            leftover = None
+            while True:
+                shard_order = torch.randperm(num_shards, generator=self.generator).tolist()
+                for i in range(0, num_shards, self.shuffle_shards):
+                    shards = {shard_index: load_shard(self.store_path, shard_index) for shard_index in shard_order[i : i + self.shuffle_shards]}
+                    blocks = [(shard_index, start) for shard_index, shard in shards.items() for start in range(0, shard.shape[0], self.block_size)]
+                    block_order = torch.randperm(len(blocks), generator=self.generator).tolist()
+                    for j in range(0, len(blocks), blocks_per_buffer):
+                        acts = to_tensor(np.concatenate([
+                            shards[shard_index][start : start + self.block_size]
+                            for shard_index, start in (blocks[k] for k in block_order[j : j + blocks_per_buffer])
+                        ]), self.metadata["dtype"])
+                        acts = acts[torch.randperm(acts.shape[0], generator=self.generator)]
+                        # Rows left over after the last full batch are carried over to the next buffer
+                        if leftover is not None:
+                            acts = torch.cat([leftover, acts])
+                        num_batches = acts.shape[0] // self.batch_size
+                        for k in range(num_batches):
+                            batch = acts[k * self.batch_size : (k + 1) * self.batch_size]
+                            self.queue.put(batch.pin_memory() if self.pin_memory else batch)
+                        leftover = acts[num_batches * self.batch_size :].clone()
+                self.epoch += 1
+        except Exception as e:
+            self.queue.put(e)
+
+    @torch.no_grad()
+    def __next__(self) -> Float[Tensor, "batch d_in"]:
+        batch = self.queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch.to(self.device, non_blocking=True)
+
+    def __iter__(self):
+        return self
+
+
+if __name__ == "__main__":
+    from process_tiny_stories_data import load_tinystories_tokens
+    from train_autoencoder import get_config
+
+    cfg = get_config()
+    assert cfg["activation_store_path"] is not None, "Pass --activation_store_path to choose where the activations are written"
+    torch.set_grad_enabled(False)
+
+    model = HookedTransformer.from_pretrained(
+        cfg["model"],
+        center_unembed=True,
+        center_writing_weights=True,
+        fold_ln=True,
+        device=get_device(),
+    )
+    prompt_data = load_tinystories_tokens(cfg["data_path"])
+    write_activation_store(
+        model,
+        prompt_data,
+        f'blocks.{cfg["layer"]}.{cfg["act"]}',
+        cfg["activation_store_path"],
+        model_batch_size=cfg["model_batch_size"],
+    )
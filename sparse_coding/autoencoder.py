@@ -39,6 +39,49 @@ class AutoEncoder(nn.Module):
             loss += reg_losses
         return loss, x_reconstruct, acts, mse_loss, reg_losses
 
+    @torch.no_grad()
+    def encode(
+        self, x: torch.Tensor, k: int | None = None, threshold: float | None = None, features: torch.Tensor | list[int] | None = None
+    ) -> torch.Tensor:
+        """Feature activations for inference, without the losses. Keeps only activations above threshold and each token's k largest
+        activations if given. features restricts the encoder to those columns of W_enc, e.g. to ablate a few directions."""
+        x_cent = x - self.b_dec
+        if features is None:
+            acts = F.relu(x_cent @ self.W_enc + self.b_enc)
+        else:
+            acts = F.relu(x_cent @ self.W_enc[:, features] + self.b_enc[features])
+        if threshold is not None:
+            acts = acts * (acts > threshold)
+        if k is not None:
+            values, indices = acts.topk(k, dim=-1)
+            acts = torch.zeros_like(acts).scatter_(-1, indices, values)
+        return acts
+
+    @torch.no_grad()
+    def decode(self, acts: torch.Tensor, features: torch.Tensor | list[int] | None = None) -> torch.Tensor:
+        """Reconstruction from dense feature activations, of only the given features if set"""
+        if features is None:
+            return acts @ self.W_dec + self.b_dec
+        return acts @ self.W_dec[features] + self.b_dec
+
+    @torch.no_grad()
+    def decode_sparse(self, values: torch.Tensor, indices: torch.Tensor) -> torch.Tensor:
+        """Reconstruction from the k active features of each token, as a gather and weighted sum over rows of W_dec"""
+        x_reconstruct = F.embedding_bag(
+            indices.reshape(-1, indices.shape[-1]), self.W_dec, per_sample_weights=values.reshape(-1, values.shape[-1]).to(self.W_dec.dtype), mode="sum"
+        )
+        return x_reconstruct.reshape(*values.shape[:-1], -1) + self.b_dec
+
+    @torch.no_grad()
+    def reconstruct(self, x: torch.Tensor, k: int | None = None, threshold: float | None = None) -> torch.Tensor:
+        """x_reconstruct of forward without computing the losses, for splicing the autoencoder into a model. With k set only the
+        k largest activations of each token are decoded."""
+        acts = self.encode(x, threshold=threshold)
+        if k is None:
+            return self.decode(acts)
+        values, indices = acts.topk(k, dim=-1)
+        return self.decode_sparse(values, indices)
+
     @torch.no_grad()
     def norm_decoder(self):
         self.W_dec.data = self.W_dec / self.W_dec.norm(dim=-1, keepdim=True)
@@ -191,7 +191,6 @@ class FunctionalEnsemble:
             new_leaves, _ = optree.tree_flatten(new_optim_states)
             leaves, _ = optree.tree_flatten(self.optim_states)
             for new_leaf, leaf in zip(new_leaves, leaves):
-                leaf = leaf.clone()
                 leaf.copy_(new_leaf)
 
             torchopt.apply_updates(self.params, updates)
@@ -0,0 +1,247 @@
+# Benchmark the haystack_utils and autoencoder_utils hot paths on a small randomly initialised model, without downloads.
+# Each function is timed across batch sizes and prompt lengths, and the results are appended to a JSON history, e.g.
+# python benchmark.py --history_path benchmarks.json
+# The last run is compared to the previous run on the same device and slowdowns beyond --regression_threshold are reported.
+import os
+import sys
+
+sys.path.append("../")
+
+import json
+import time
+import random
+import argparse
+import subprocess
+import warnings
+from itertools import product
+from typing import Callable
+
+import torch
+import numpy as np
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers
+from transformers import PreTrainedTokenizerFast
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+import utils.haystack_utils as haystack_utils
+import utils.hook_utils as hook_utils
+from utils.autoencoder_utils import batch_prompts, evaluate_autoencoder_reconstruction
+from autoencoder import AutoEncoder
+from train_autoencoder import Buffer
+
+
+TINY_MODEL_CONFIG = {
+    "n_layers": 6,
+    "d_model": 128,
+    "n_heads": 4,
+    "d_head": 32,
+    "d_mlp": 512,
+    "n_ctx": 512,
+    "act_fn": "gelu",
+    "normalization_type": "LN",
+}
+
+BENCHMARK_CONFIG = {
+    "vocab_size": 2000,
+    "num_prompts": 64,
+    "batch_sizes": [8, 32],
+    "prompt_lengths": [32, 128],
+    "repeats": 3,
+    "seed": 0,
+}
+
+
+def get_random_texts(n: int, length: int, seed: int = 0) -> list[str]:
+    """Texts of length words drawn from a fixed random vocabulary of letter sequences"""
+    rng = random.Random(seed)
+    words = ["".join(rng.choices("abcdefghijklmnopqrstuvwxyzäöü", k=rng.randint(1, 8))) for _ in range(5000)]
+    return [" ".join(rng.choices(words, k=length)) for _ in range(n)]
+
+
+def get_tiny_tokenizer(vocab_size: int, seed: int = 0) -> PreTrainedTokenizerFast:
+    """Byte-level BPE tokenizer trained in memory on random texts"""
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size, special_tokens=["<|endoftext|>"], initial_alphabet=pre_tokenizers.ByteLevel.alphabet(), show_progress=False
+    )
+    tokenizer.train_from_iterator(get_random_texts(2000, 64, seed), trainer)
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<|endoftext|>", eos_token="<|endoftext|>", pad_token="<|endoftext|>"
+    )
+
+
+def get_tiny_model(model_config: dict = TINY_MODEL_CONFIG, vocab_size: int = 2000, seed: int = 0, device: str | None = None) -> HookedTransformer:
+    tokenizer = get_tiny_tokenizer(vocab_size, seed)
+    cfg = HookedTransformerConfig(
+        **model_config, d_vocab=len(tokenizer), seed=seed, device=device or haystack_utils.get_device()
+    )
+    model = HookedTransformer(cfg, tokenizer=tokenizer)
+    model.eval()
+    return model
+
+
+def synchronize(device: str):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def time_function(fn: Callable, device: str, repeats: int) -> dict:
+    """Median wall time over repeats after one warmup call, peak memory and device syncs of one call. Peak memory
+    and syncs are only measured on cuda, where torch.cuda.set_sync_debug_mode warns on every synchronizing op."""
+    fn()
+    synchronize(device)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append(time.perf_counter() - start)
+
+    peak_memory_mb, syncs = None, None
+    if device.startswith("cuda"):
+        torch.cuda.reset_peak_memory_stats()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            torch.cuda.set_sync_debug_mode("warn")
+            try:
+                fn()
+                synchronize(device)
+            finally:
+                torch.cuda.set_sync_debug_mode("default")
+        syncs = sum("synchronizing" in str(warning.message) for warning in caught)
+        peak_memory_mb = torch.cuda.max_memory_allocated() / 2**20
+    return {"seconds": float(np.median(times)), "peak_memory_mb": peak_memory_mb, "syncs": syncs}
+
+
+def get_benchmarks(model: HookedTransformer, prompts: list[str], tokens: torch.Tensor, batch_size: int) -> dict[str, Callable]:
+    """Functions to time on one set of prompts, tokens holds the same prompts packed into rows"""
+    device = model.cfg.device
+    layer = model.cfg.n_layers // 2
+    hook_name = f"blocks.{layer}.mlp.hook_post"
+    encoder = AutoEncoder(model.cfg.d_mlp * 4, 0.0001, model.cfg.d_mlp).to(device)
+    ablation_hooks = [hook_utils.get_ablate_neuron_hook(3, 0, 0.0)]
+    activation_hooks = [hook_utils.get_ablate_neuron_hook(3, 0, 1.0)]
+
+    buffer_cfg = {
+        "buffer_size": batch_size * tokens.shape[1] * 4,
+        "buffer_batches": batch_size * 4,
+        "model_batch_size": batch_size,
+        "batch_size": batch_size,
+        "d_in": model.cfg.d_mlp,
+        "layer": layer,
+        "act": "mlp.hook_post",
+    }
+    buffer = Buffer(buffer_cfg, model, tokens, device)
+
+    return {
+        "get_mlp_activations": lambda: haystack_utils.get_mlp_activations(
+            prompts, layer, model, context_crop_start=0, disable_tqdm=True, batch_size=batch_size
+        ),
+        "get_average_loss": lambda: haystack_utils.get_average_loss(prompts, model, batch_size=batch_size),
+        "get_direct_effect": lambda: [
+            haystack_utils.get_direct_effect(prompts[i : i + batch_size], model, ablation_hooks, activation_hooks)
+            for i in range(0, len(prompts), batch_size)
+        ],
+        "evaluate_autoencoder_reconstruction": lambda: evaluate_autoencoder_reconstruction(
+            encoder, hook_name, prompts, model, show_tqdm=False
+        ),
+        "batch_prompts": lambda: batch_prompts(prompts, model, tokens.shape[1] - 1),
+        "Buffer.refresh": buffer.refresh,
+    }
+
+
+@torch.no_grad()
+def run_benchmarks(model: HookedTransformer, cfg: dict, names: list[str] | None = None) -> list[dict]:
+    results = []
+    for batch_size, prompt_length in product(cfg["batch_sizes"], cfg["prompt_lengths"]):
+        prompts = get_random_texts(cfg["num_prompts"], prompt_length, cfg["seed"] + 1)
+        num_tokens = sum(len(ids) for ids in model.tokenizer(prompts)["input_ids"])
+        seq_len = min(num_tokens // cfg["num_prompts"], model.cfg.n_ctx - 1)
+        tokens = batch_prompts(prompts, model, seq_len).long()
+
+        benchmarks = get_benchmarks(model, prompts, tokens, batch_size)
+        for name, fn in benchmarks.items():
+            if names is not None and name not in names:
+                continue
+            result = time_function(fn, model.cfg.device, cfg["repeats"])
+            result.update({
+                "name": name,
+                "batch_size": batch_size,
+                "prompt_length": prompt_length,
+                "num_tokens": num_tokens,
+                "tokens_per_second": num_tokens / result["seconds"],
+            })
+            print(
+                f"{name:<40} batch_size={batch_size:<4} prompt_length={prompt_length:<5} "
+                f"{result['tokens_per_second']:>12.0f} tokens/s  peak memory: {result['peak_memory_mb']}  syncs: {result['syncs']}"
+            )
+            results.append(result)
+    return results
+
+
+def get_git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+
+def load_history(history_path: str) -> list[dict]:
+    if not os.path.exists(history_path):
+        return []
+    with open(history_path, "r") as f:
+        return json.load(f)
+
+
+def append_history(history_path: str, run: dict):
+    history = load_history(history_path) + [run]
+    with open(history_path + ".tmp", "w") as f:
+        json.dump(history, f, indent=4)
+    os.replace(history_path + ".tmp", history_path)
+
+
+def compare_to_previous(history: list[dict], run: dict, regression_threshold: float = 0.1) -> list[str]:
+    """Cases of run that are more than regression_threshold slower than in the latest earlier run on the same device and model"""
+    previous_runs = [r for r in history if r["device"] == run["device"] and r["model_config"] == run["model_config"]]
+    if len(previous_runs) == 0:
+        return []
+    previous = {(r["name"], r["batch_size"], r["prompt_length"]): r for r in previous_runs[-1]["results"]}
+    regressions = []
+    for result in run["results"]:
+        key = (result["name"], result["batch_size"], result["prompt_length"])
+        if key in previous and result["seconds"] > previous[key]["seconds"] * (1 + regression_threshold):
+            regressions.append(
+                f"{key}: {previous[key]['seconds']:.4f}s -> {result['seconds']:.4f}s ({previous_runs[-1]['commit']} -> {run['commit']})"
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history_path", type=str, default="benchmarks.json")
+    parser.add_argument("--names", type=str, nargs="+", default=None, help="Only run these benchmarks")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=BENCHMARK_CONFIG["batch_sizes"])
+    parser.add_argument("--prompt_lengths", type=int, nargs="+", default=BENCHMARK_CONFIG["prompt_lengths"])
+    parser.add_argument("--num_prompts", type=int, default=BENCHMARK_CONFIG["num_prompts"])
+    parser.add_argument("--repeats", type=int, default=BENCHMARK_CONFIG["repeats"])
+    parser.add_argument("--regression_threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    cfg = {**BENCHMARK_CONFIG, **{key: value for key, value in vars(args).items() if key in BENCHMARK_CONFIG}}
+    torch.manual_seed(cfg["seed"])
+    model = get_tiny_model(TINY_MODEL_CONFIG, cfg["vocab_size"], cfg["seed"])
+
+    run = {
+        "timestamp": time.time(),
+        "commit": get_git_commit(),
+        "device": model.cfg.device,
+        "torch_version": torch.__version__,
+        "model_config": TINY_MODEL_CONFIG,
+        "benchmark_config": cfg,
+        "results": run_benchmarks(model, cfg, args.names),
+    }
+    regressions = compare_to_previous(load_history(args.history_path), run, args.regression_threshold)
+    append_history(args.history_path, run)
+    for regression in regressions:
+        print(f"Regression: {regression}")
@@ -3,6 +3,7 @@
 import torch
 from tqdm.auto import tqdm
 import os
+from glob import glob
 from datasets import Dataset, load_from_disk, concatenate_datasets, load_dataset
 
 device = (
@@ -23,7 +24,8 @@ os.makedirs(local_shard_dir, exist_ok=True)
 
 # %%
 # Read PyTorch files and convert to Hugging Face dataset
-for i in tqdm(range(46)):
+num_shards = len(glob("sparse_coding/data/wikipedia/de_batched_*.pt"))
+for i in tqdm(range(num_shards)):
     data_chunk = torch.load(f"sparse_coding/data/wikipedia/de_batched_{i}.pt").tolist()
     ds_chunk = Dataset.from_dict({"tokens": data_chunk})
     # Save this chunk as a shard
@@ -32,7 +34,7 @@ for i in tqdm(range(46)):
 
 # %%
 # Load all shards as a DatasetDict
-shard_paths = [f"{local_shard_dir}/shard_{i}" for i in range(46)]
+shard_paths = [f"{local_shard_dir}/shard_{i}" for i in range(num_shards)]
 # dataset_dict = DatasetDict({f"shard_{i}": load_dataset(shard_path) for i, shard_path in enumerate(shard_paths)})
 shard_datasets = [load_from_disk(shard_path) for shard_path in shard_paths]
 concatenated_dataset = concatenate_datasets(shard_datasets)
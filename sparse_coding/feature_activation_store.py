@@ -0,0 +1,253 @@
+"""Sparse on-disk store of autoencoder feature activations.
+
+Running this file encodes the hook activations of a set of prompts with a trained autoencoder and writes only the nonzero
+feature activations, so that feature analyses can read them from disk instead of rerunning the model:
+
+```
+python feature_activation_store.py --encoder_name 25_gallant-monkey --model_name tiny-stories-2L-33M --feature_store_path /workspace/data/features/25_gallant-monkey
+```
+
+Each shard holds the codes of up to shard_tokens token positions in CSR form: indptr (int64) delimits the rows of each token
+in indices (feature, int16 or int32) and values (float16). Every token row also records its token id, prompt id and position.
+A per-feature (CSC) copy of each shard is built and saved on the first feature query.
+"""
+import os
+import sys
+import json
+
+import torch
+import numpy as np
+from torch import Tensor
+from jaxtyping import Int, Float
+from tqdm.auto import tqdm
+from transformer_lens import HookedTransformer
+
+sys.path.append("../")
+import utils.haystack_utils as haystack_utils
+from utils.autoencoder_utils import AutoEncoderConfig
+from sparse_coding.autoencoder import AutoEncoder
+
+
+TOKEN_ARRAYS = ["tokens", "prompt_ids", "positions"]
+CSR_ARRAYS = ["indptr", "indices", "values"]
+
+
+def get_array_path(store_path: str, shard_index: int, name: str) -> str:
+    return os.path.join(store_path, f"shard_{shard_index}_{name}.npy")
+
+
+def load_store_metadata(store_path: str) -> dict:
+    metadata_path = os.path.join(store_path, "metadata.json")
+    if not os.path.exists(metadata_path):
+        raise FileNotFoundError(f"No complete feature activation store found at {store_path}, run feature_activation_store.py first")
+    with open(metadata_path, "r") as f:
+        return json.load(f)
+
+
+def clear_store(store_path: str):
+    """Remove the metadata and all shard arrays, including CSC copies, of a previous store at store_path. The metadata goes first,
+    so a reader never pairs it with shards of the new store."""
+    metadata_path = os.path.join(store_path, "metadata.json")
+    if os.path.exists(metadata_path):
+        os.remove(metadata_path)
+    for file_name in os.listdir(store_path):
+        if file_name.startswith("shard_") and file_name.endswith(".npy"):
+            os.remove(os.path.join(store_path, file_name))
+
+
+def save_store_metadata(store_path: str, metadata: dict):
+    """Write the metadata under a temporary name and rename it, so a crash never leaves a partial metadata file"""
+    metadata_path = os.path.join(store_path, "metadata.json")
+    with open(metadata_path + ".tmp", "w") as f:
+        json.dump(metadata, f, indent=4)
+    os.replace(metadata_path + ".tmp", metadata_path)
+
+
+def save_shard(store_path: str, shard_index: int, shard: dict[str, list[np.ndarray]], d_hidden: int) -> int:
+    row_lengths = np.concatenate(shard["row_lengths"])
+    arrays = {
+        "tokens": np.concatenate(shard["tokens"]).astype(np.int32),
+        "prompt_ids": np.concatenate(shard["prompt_ids"]).astype(np.int32),
+        "positions": np.concatenate(shard["positions"]).astype(np.int32),
+        "indptr": np.concatenate([[0], np.cumsum(row_lengths)]).astype(np.int64),
+        "indices": np.concatenate(shard["indices"]).astype(np.int16 if d_hidden <= np.iinfo(np.int16).max else np.int32),
+        "values": np.concatenate(shard["values"]).astype(np.float16),
+    }
+    for name, array in arrays.items():
+        np.save(get_array_path(store_path, shard_index, name), array)
+    return len(row_lengths)
+
+
+@torch.no_grad()
+def write_feature_activation_store(
+    prompts: list[str],
+    model: HookedTransformer,
+    encoder: AutoEncoder,
+    cfg: AutoEncoderConfig,
+    store_path: str,
+    batch_size: int = 16,
+    shard_tokens: int = 2**20,
+):
+    """Encode the activations at cfg.encoder_hook_point of every non-padding token of the prompts and write the nonzero codes to
+    shards of up to shard_tokens tokens. Any previous store at store_path is removed first, and the metadata file is written last,
+    so an interrupted run is never picked up by a reader."""
+    os.makedirs(store_path, exist_ok=True)
+    clear_store(store_path)
+    shard_sizes = []
+    shard = {name: [] for name in TOKEN_ARRAYS + ["row_lengths", "indices", "values"]}
+    num_shard_tokens = 0
+    num_nonzero = 0
+
+    for i in tqdm(range(0, len(prompts), batch_size)):
+        tokens = model.to_tokens(prompts[i : i + batch_size])
+        active_tokens = haystack_utils.get_active_token_mask(tokens, model)
+        cache = haystack_utils.get_truncated_cache(tokens, model, cfg.encoder_hook_point)
+        mid_acts = encoder.encode(cache[cfg.encoder_hook_point][active_tokens])
+
+        # Rows of active_tokens in row-major order, matching the order of mid_acts
+        prompt_ids, positions = torch.nonzero(active_tokens, as_tuple=True)
+        rows, features = torch.nonzero(mid_acts, as_tuple=True)
+        shard["tokens"].append(tokens[active_tokens].cpu().numpy())
+        shard["prompt_ids"].append((prompt_ids + i).cpu().numpy())
+        shard["positions"].append(positions.cpu().numpy())
+        shard["row_lengths"].append(torch.bincount(rows, minlength=mid_acts.shape[0]).cpu().numpy())
+        shard["indices"].append(features.cpu().numpy())
+        shard["values"].append(mid_acts[rows, features].half().cpu().numpy())
+        num_shard_tokens += mid_acts.shape[0]
+        num_nonzero += len(rows)
+
+        if num_shard_tokens >= shard_tokens:
+            shard_sizes.append(save_shard(store_path, len(shard_sizes), shard, encoder.d_hidden))
+            shard = {name: [] for name in shard}
+            num_shard_tokens = 0
+
+    if num_shard_tokens > 0:
+        shard_sizes.append(save_shard(store_path, len(shard_sizes), shard, encoder.d_hidden))
+
+    metadata = {
+        "hook_name": cfg.encoder_hook_point,
+        "d_hidden": encoder.d_hidden,
+        "num_prompts": len(prompts),
+        "num_tokens": sum(shard_sizes),
+        "num_nonzero": num_nonzero,
+        "shard_sizes": shard_sizes,
+    }
+    save_store_metadata(store_path, metadata)
+    print(
+        f"Wrote {num_nonzero} nonzero activations of {sum(shard_sizes)} tokens ({num_nonzero / max(sum(shard_sizes), 1):.1f} per token) "
+        f"to {len(shard_sizes)} shards in {store_path}"
+    )
+
+
+class FeatureActivationStore:
+    """
+    Reads a store written by write_feature_activation_store. All arrays are memory-mapped, so only the rows that are accessed are read.
+    Tokens are addressed by their global index, i.e. their row across all shards in order.
+    """
+
+    def __init__(self, store_path: str):
+        self.metadata = load_store_metadata(store_path)
+        self.store_path = store_path
+        self.d_hidden = self.metadata["d_hidden"]
+        self.shard_offsets = np.concatenate([[0], np.cumsum(self.metadata["shard_sizes"])])
+        self.shards = [
+            {name: np.load(get_array_path(store_path, i, name), mmap_mode="r") for name in TOKEN_ARRAYS + CSR_ARRAYS}
+            for i in range(len(self.metadata["shard_sizes"]))
+        ]
+
+    def __len__(self) -> int:
+        return self.metadata["num_tokens"]
+
+    def get_token_info(self, name: str) -> np.ndarray:
+        """Token ids, prompt ids or positions of all tokens in the store"""
+        return np.concatenate([shard[name] for shard in self.shards])
+
+    def get_token_activations(self, token_index: int) -> tuple[Int[Tensor, "n_active"], Float[Tensor, "n_active"]]:
+        """Active features and their activations of one token"""
+        shard_index = np.searchsorted(self.shard_offsets, token_index, side="right") - 1
+        shard = self.shards[shard_index]
+        row = token_index - self.shard_offsets[shard_index]
+        start, end = shard["indptr"][row], shard["indptr"][row + 1]
+        return torch.from_numpy(shard["indices"][start:end].astype(np.int64)), torch.from_numpy(shard["values"][start:end].astype(np.float32))
+
+    def get_dense_activations(self, start: int, end: int) -> Float[Tensor, "n_tokens d_hidden"]:
+        """Dense codes of the tokens in [start, end), the same values as encoder.encode(acts) up to float16 precision"""
+        dense = torch.zeros(end - start, self.d_hidden)
+        for shard_index, shard in enumerate(self.shards):
+            shard_start, shard_end = self.shard_offsets[shard_index], self.shard_offsets[shard_index + 1]
+            row_start, row_end = max(start, shard_start) - shard_start, min(end, shard_end) - shard_start
+            if row_start >= row_end:
+                continue
+            indptr = shard["indptr"][row_start : row_end + 1]
+            row_lengths = torch.from_numpy(np.diff(indptr))
+            rows = torch.repeat_interleave(torch.arange(len(row_lengths)), row_lengths) + shard_start + row_start - start
+            features = torch.from_numpy(shard["indices"][indptr[0] : indptr[-1]].astype(np.int64))
+            dense[rows, features] = torch.from_numpy(shard["values"][indptr[0] : indptr[-1]].astype(np.float32))
+        return dense
+
+    def build_csc(self, shard_index: int):
+        """Write the per-feature (CSC) arrays of a shard: csc_indptr delimits each feature's entries in csc_rows and csc_values"""
+        shard = self.shards[shard_index]
+        indices = np.asarray(shard["indices"])
+        order = np.argsort(indices, kind="stable")
+        rows = np.repeat(np.arange(len(shard["tokens"]), dtype=np.int32), np.diff(shard["indptr"]))
+        arrays = {
+            "csc_indptr": np.concatenate([[0], np.cumsum(np.bincount(indices, minlength=self.d_hidden))]).astype(np.int64),
+            "csc_rows": rows[order],
+            "csc_values": np.asarray(shard["values"])[order],
+        }
+        for name, array in arrays.items():
+            np.save(get_array_path(self.store_path, shard_index, name), array)
+
+    def get_csc_shard(self, shard_index: int) -> dict[str, np.ndarray]:
+        shard = self.shards[shard_index]
+        if "csc_indptr" not in shard:
+            if not os.path.exists(get_array_path(self.store_path, shard_index, "csc_indptr")):
+                self.build_csc(shard_index)
+            for name in ["csc_indptr", "csc_rows", "csc_values"]:
+                shard[name] = np.load(get_array_path(self.store_path, shard_index, name), mmap_mode="r")
+        return shard
+
+    def get_feature_activations(self, feature: int) -> tuple[Int[Tensor, "n_active"], Float[Tensor, "n_active"]]:
+        """Global token indices and activations of every token on which the feature is active, in token order"""
+        token_indices = []
+        values = []
+        for shard_index in range(len(self.shards)):
+            shard = self.get_csc_shard(shard_index)
+            start, end = shard["csc_indptr"][feature], shard["csc_indptr"][feature + 1]
+            token_indices.append(shard["csc_rows"][start:end].astype(np.int64) + self.shard_offsets[shard_index])
+            values.append(shard["csc_values"][start:end].astype(np.float32))
+        return torch.from_numpy(np.concatenate(token_indices)), torch.from_numpy(np.concatenate(values))
+
+    def get_feature_frequencies(self) -> Float[Tensor, "d_hidden"]:
+        """Fraction of tokens on which each feature is active"""
+        counts = sum(np.bincount(shard["indices"], minlength=self.d_hidden) for shard in self.shards)
+        return torch.from_numpy(counts / len(self)).float()
+
+
+if __name__ == "__main__":
+    import argparse
+    from process_tiny_stories_data import load_tinystories_validation_prompts
+    from utils.autoencoder_utils import load_encoder
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--encoder_name", type=str, required=True)
+    parser.add_argument("--model_name", type=str, default="tiny-stories-2L-33M")
+    parser.add_argument("--encoder_path", type=str, default="/workspace")
+    parser.add_argument("--data_path", type=str, default="/workspace/data/tinystories")
+    parser.add_argument("--feature_store_path", type=str, required=True)
+    parser.add_argument("--num_prompts", type=int, default=10_000)
+    parser.add_argument("--batch_size", type=int, default=16)
+    args = parser.parse_args()
+    torch.set_grad_enabled(False)
+
+    model = HookedTransformer.from_pretrained(
+        args.model_name,
+        center_unembed=True,
+        center_writing_weights=True,
+        fold_ln=True,
+        device=haystack_utils.get_device(),
+    )
+    encoder, cfg = load_encoder(args.encoder_name, args.model_name, model, save_path=args.encoder_path)
+    prompts = load_tinystories_validation_prompts(args.data_path)[: args.num_prompts]
+    write_feature_activation_store(prompts, model, encoder, cfg, args.feature_store_path, batch_size=args.batch_size)
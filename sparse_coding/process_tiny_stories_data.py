@@ -28,12 +28,9 @@ def create_hf_dataset(seq_len=127):
     )
 
     dataset = load_dataset("roneneldan/TinyStories", split="train")
-    prompts = []
-    for i in tqdm(range(len(dataset))):
-        text_prompt = dataset[i]["text"]
-        # Fix encoding issue for special characters like em-dash
-        # text_prompt = text_prompt.encode("windows-1252").decode("utf-8", errors="ignore")
-        prompts.append(text_prompt)
+    # Fix encoding issue for special characters like em-dash
+    # text_prompt = text_prompt.encode("windows-1252").decode("utf-8", errors="ignore")
+    prompts = (row["text"] for row in dataset)
 
     tokens = batch_prompts(prompts, model, seq_len=seq_len)
     #torch.save(tokens, f"{data_path}batched.pt")
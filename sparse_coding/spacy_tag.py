@@ -1,3 +1,8 @@
+
+import os
+import json
+import tempfile
+
 import numpy as np
 import pandas as pd
 import spacy
@@ -12,6 +17,77 @@ import spacy_alignments as tokenizations
 # https://universaldependencies.org/u/dep/
 # https://universaldependencies.org/u/pos/
 
+# Every attribute is stored as an int16 code per model token, indexing into the attribute's vocabulary in vocab.json.
+# Code 0 is the empty string, i.e. BOS, padding and tokens without a value. 'NONE' and 'MULTI' mark model tokens that align
+# to no or to several spaCy tokens.
+SPACY_ATTRIBUTES = {
+    'pos': lambda t: t.pos_,
+    'tag': lambda t: t.tag_,
+    'dep': lambda t: t.dep_,
+    'ent_type': lambda t: t.ent_type_,
+    'morph_number': lambda t: t.morph.to_dict().get('Number', ''),
+    'morph_person': lambda t: t.morph.to_dict().get('Person', ''),
+    'morph_prontype': lambda t: t.morph.to_dict().get('PronType', ''),
+    'morph_tense': lambda t: t.morph.to_dict().get('Tense', ''),
+    'morph_verbform': lambda t: t.morph.to_dict().get('VerbForm', ''),
+    'morph_aspect': lambda t: t.morph.to_dict().get('Aspect', ''),
+    'is_alpha': lambda t: str(t.is_alpha),
+    'is_stop': lambda t: str(t.is_stop),
+    'is_sent_end': lambda t: str(t.is_sent_end),
+    'is_sent_start': lambda t: str(t.is_sent_start),
+}
+
+# see https://universaldependencies.org/u/pos/
+pos_label_classes = [
+    'ADJ', 'ADP', 'DET', 'NOUN', 'PRON', 'PROPN', 'PUNCT', 'VERB', 'SPACE',
+    'NUM', 'ADV', 'AUX', 'CCONJ', 'SCONJ', 'INTJ', 'SYM', 'PART', 'MULTI'
+]
+dep_label_classes = [
+    'dep', 'punct', 'appos', 'pobj', 'prep', 'dobj', 'det', 'nsubj',
+    'amod', 'compound', 'ROOT', 'conj', 'advmod', 'nmod', 'cc',
+    'aux', 'nummod', 'advcl', 'attr', 'ccomp', 'poss',
+    'npadvmod', 'mark', 'nsubjpass', 'relcl', 'auxpass', 'acl',
+    'acomp', 'pcomp', 'xcomp', 'neg', 'meta'
+]
+ent_label_classes = ['PERSON', 'ORG', 'CARDINAL', 'DATE', 'GPE',
+    'WORK_OF_ART', 'PRODUCT', 'LAW', 'PERCENT', 'QUANTITY', 'TIME',
+    'NORP', 'FAC', 'ORDINAL', 'MONEY', 'LOC', 'EVENT', 'LANGUAGE']
+
+# Boolean label name -> (attribute, value)
+SPACY_LABELS = {
+    **{f'is_spacy_{pos.lower()}': ('pos', pos) for pos in pos_label_classes},
+    **{f'is_spacy_{dep}': ('dep', dep) for dep in dep_label_classes},
+
+    'is_singular': ('morph_number', 'Sing'),
+    'is_plural': ('morph_number', 'Plur'),
+
+    'is_third_person': ('morph_person', '3'),
+    'is_second_person': ('morph_person', '2'),
+    'is_first_person': ('morph_person', '1'),
+
+    'is_prs_pron': ('morph_prontype', 'Prs'),
+    'is_art_pron': ('morph_prontype', 'Art'),
+    'is_dem_pron': ('morph_prontype', 'Dem'),
+    'is_rel_pron': ('morph_prontype', 'Rel'),
+
+    'is_past_tense': ('morph_tense', 'Past'),
+    'is_present_tense': ('morph_tense', 'Pres'),
+
+    'is_fin_verb': ('morph_verbform', 'Fin'),
+    'is_part_verb': ('morph_verbform', 'Part'),
+    'is_inf_verb': ('morph_verbform', 'Inf'),
+
+    'is_perf_aspect': ('morph_aspect', 'Perf'),
+    'is_prog_aspect': ('morph_aspect', 'Prog'),
+
+    **{f'is_{ent}': ('ent_type', ent) for ent in ent_label_classes},
+
+    'is_stop': ('is_stop', 'True'),
+    'sent_end': ('is_sent_end', 'True'),
+    'sent_begin': ('is_sent_start', 'True'),
+}
+
+
 def get_spacy_tag(tok_ix2spacy_ixs, spacy_attribute_list):
     if len(tok_ix2spacy_ixs) == 1:
         return spacy_attribute_list[tok_ix2spacy_ixs[0]]
@@ -28,169 +104,153 @@ def get_model_labels(model2spacy, spacy_tag):
     ])
 
 
-def make_spacy_feature_df(model, token_tensor):
-    spacy.prefer_gpu()
-    nlp = spacy.load('en_core_web_trf')
+def encode(values: list[str], vocab: dict[str, int]) -> np.ndarray:
+    """Codes of values in vocab, new values are appended to vocab"""
+    return np.array([vocab.setdefault(value, len(vocab)) for value in values], dtype=np.int16)
+
+
+def get_array_path(store_path: str, shard_index: int, attribute: str) -> str:
+    return os.path.join(store_path, f"shard_{shard_index}_{attribute}.npy")
 
-    print('Starting spacy processing of dataset...')
-    texts = [model.to_string(token_tensor[i, 1:]) for i in range(len(token_tensor))]
-    docs = list(nlp.pipe(texts, batch_size=100))
-    print('Finished spacy processing of dataset.')
 
+def load_vocab(store_path: str) -> dict:
+    vocab_path = os.path.join(store_path, "vocab.json")
+    if not os.path.exists(vocab_path):
+        return {"num_shards": 0, "shard_sizes": [], "vocab": {attribute: [''] for attribute in SPACY_ATTRIBUTES}}
+    with open(vocab_path, "r") as f:
+        return json.load(f)
+
+
+def save_json(data: dict, path: str):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(temp_path, path)
+
+
+def tag_shard(docs, model, token_tensor, vocab: dict[str, dict[str, int]]) -> dict[str, np.ndarray]:
+    """Align the spaCy tokens of each doc to the model tokens of its row of token_tensor and encode every attribute"""
     n, seq_len = token_tensor.shape
-    pos_matrix = np.zeros((n, seq_len), dtype='<U5')
-    tag_matrix = np.zeros((n, seq_len), dtype='<U5')
-    dep_matrix = np.zeros((n, seq_len), dtype='<U10')
-    ent_type_matrix = np.zeros((n, seq_len), dtype='<U8')
-
-    morph_number_matrix = np.zeros((n, seq_len), dtype='<U5')
-    morph_person_matrix = np.zeros((n, seq_len), dtype='<U5')
-    morph_prontype_matrix = np.zeros((n, seq_len), dtype='<U5')
-    morph_tense_matrix = np.zeros((n, seq_len), dtype='<U5')
-    morph_verbform_matrix = np.zeros((n, seq_len), dtype='<U5')
-    morph_aspect_matrix = np.zeros((n, seq_len), dtype='<U5')
-
-    is_alpha_matrix = np.zeros((n, seq_len), dtype='<U5')
-    is_stop_matrix = np.zeros((n, seq_len), dtype='<U5')
-    is_sent_end_matrix = np.zeros((n, seq_len), dtype='<U5')
-    is_sent_begins_matrix = np.zeros((n, seq_len), dtype='<U5')
+    codes = {attribute: np.zeros((n, seq_len), dtype=np.int16) for attribute in SPACY_ATTRIBUTES}
+    special_codes = {attribute: encode(['NONE', 'MULTI'], vocab[attribute]) for attribute in SPACY_ATTRIBUTES}
 
     for i, doc in enumerate(docs):
-        if i % 1000 == 0:
-            print(timestamp(), i)
-
         model_tokens = model.to_str_tokens(token_tensor[i, 1:])
         spacy_tokens = [t.text for t in doc]
-
-        spacy_pos = np.array([t.pos_ for t in doc])
-        spacy_tag = np.array([t.tag_ for t in doc])
-        spacy_dep = np.array([t.dep_ for t in doc])
-        spacy_ent_type = np.array([t.ent_type_ for t in doc])
-
-        spacy_morph_number = np.array(
-            [t.morph.to_dict().get('Number', '') for t in doc])
-        spacy_morph_person = np.array(
-            [t.morph.to_dict().get('Person', '') for t in doc])
-        spacy_morph_prontype = np.array(
-            [t.morph.to_dict().get('PronType', '') for t in doc])
-        spacy_morph_tense = np.array(
-            [t.morph.to_dict().get('Tense', '') for t in doc])
-        spacy_morph_verbform = np.array(
-            [t.morph.to_dict().get('VerbForm', '') for t in doc])
-        spacy_morph_aspect = np.array(
-            [t.morph.to_dict().get('Aspect', '') for t in doc])
-
-        spacy_is_alpha = np.array([t.is_alpha for t in doc])
-        spacy_is_stop = np.array([t.is_stop for t in doc])
-
-        spacy_end_sent = np.array([t.is_sent_end for t in doc])
-        spacy_begin_sent = np.array([t.is_sent_start for t in doc])
-
-        gpt2spacy, spacy2gpt = tokenizations.get_alignments(
-            model_tokens, spacy_tokens)
-
-        # offset by 1 for BOS
-        pos_matrix[i, 1:] = get_model_labels(gpt2spacy, spacy_pos)
-        tag_matrix[i, 1:] = get_model_labels(gpt2spacy, spacy_tag)
-        dep_matrix[i, 1:] = get_model_labels(gpt2spacy, spacy_dep)
-        ent_type_matrix[i, 1:] = get_model_labels(gpt2spacy, spacy_ent_type)
-
-        morph_number_matrix[i, 1:] = get_model_labels(
-            gpt2spacy, spacy_morph_number)
-        morph_person_matrix[i, 1:] = get_model_labels(
-            gpt2spacy, spacy_morph_person)
-        morph_prontype_matrix[i, 1:] = get_model_labels(
-            gpt2spacy, spacy_morph_prontype)
-        morph_tense_matrix[i, 1:] = get_model_labels(
-            gpt2spacy, spacy_morph_tense)
-        morph_verbform_matrix[i, 1:] = get_model_labels(
-            gpt2spacy, spacy_morph_verbform)
-        morph_aspect_matrix[i, 1:] = get_model_labels(
-            gpt2spacy, spacy_morph_aspect)
-
-        is_alpha_matrix[i, 1:] = get_model_labels(gpt2spacy, spacy_is_alpha)
-        is_stop_matrix[i, 1:] = get_model_labels(gpt2spacy, spacy_is_stop)
+        gpt2spacy, spacy2gpt = tokenizations.get_alignments(model_tokens, spacy_tokens)
+
+        # Index of the spaCy token of every model token, or -2 / -1 for the NONE / MULTI codes
+        alignment = np.array([ixs[0] if len(ixs) == 1 else (-2 if len(ixs) == 0 else -1) for ixs in gpt2spacy], dtype=np.int64)
+        for attribute, get_value in SPACY_ATTRIBUTES.items():
+            doc_codes = np.concatenate([encode([get_value(t) for t in doc], vocab[attribute]), special_codes[attribute]])
+            # offset by 1 for BOS
+            codes[attribute][i, 1:] = doc_codes[alignment]
         # spacy always deleclares end of sequence true
-        is_sent_end_matrix[i, 1:-1] = \
-            get_model_labels(gpt2spacy, spacy_end_sent)[:-1]
-        is_sent_begins_matrix[i, 1:] = get_model_labels(
-            gpt2spacy, spacy_begin_sent)
-
-    # see https://universaldependencies.org/u/pos/
-    pos_labels = {
-        'is_spacy_adj': pos_matrix == 'ADJ',
-        'is_spacy_adp': pos_matrix == 'ADP',
-        'is_spacy_det': pos_matrix == 'DET',
-        'is_spacy_noun': pos_matrix == 'NOUN',
-        'is_spacy_pron': pos_matrix == 'PRON',
-        'is_spacy_propn': pos_matrix == 'PROPN',
-        'is_spacy_punct': pos_matrix == 'PUNCT',
-        'is_spacy_verb': pos_matrix == 'VERB',
-        'is_spacy_space': pos_matrix == 'SPACE',
-        'is_spacy_num': pos_matrix == 'NUM',
-        'is_spacy_adv': pos_matrix == 'ADV',
-        'is_spacy_aux': pos_matrix == 'AUX',
-        'is_spacy_cconj': pos_matrix == 'CCONJ',
-        'is_spacy_sconj': pos_matrix == 'SCONJ',
-        'is_spacy_intj': pos_matrix == 'INTJ',
-        'is_spacy_sym': pos_matrix == 'SYM',
-        'is_spacy_part': pos_matrix == 'PART',
-        'is_spacy_multi': pos_matrix == 'MULTI',
-    }
-    dep_label_classes = [
-        'dep', 'punct', 'appos', 'pobj', 'prep', 'dobj', 'det', 'nsubj',
-        'amod', 'compound', 'ROOT', 'conj', 'advmod', 'nmod', 'cc', 
-        'aux', 'nummod', 'advcl', 'attr', 'ccomp', 'poss',
-        'npadvmod', 'mark', 'nsubjpass', 'relcl', 'auxpass', 'acl',
-        'acomp', 'pcomp', 'xcomp', 'neg', 'meta'
-    ]
-    dependency_labels = {
-        f'is_spacy_{dep}': dep_matrix == dep for dep in dep_label_classes
-    }
-
-    morph_labels = {
-        'is_singular': morph_number_matrix == 'Sing',
-        'is_plural': morph_number_matrix == 'Plur',
-
-        'is_third_person': morph_person_matrix == '3',
-        'is_second_person': morph_person_matrix == '2',
-        'is_first_person': morph_person_matrix == '1',
-
-        'is_prs_pron': morph_prontype_matrix == 'Prs',
-        'is_art_pron': morph_prontype_matrix == 'Art',
-        'is_dem_pron': morph_prontype_matrix == 'Dem',
-        'is_rel_pron': morph_prontype_matrix == 'Rel',
-
-        'is_past_tense': morph_tense_matrix == 'Past',
-        'is_present_tense': morph_tense_matrix == 'Pres',
-
-        'is_fin_verb': morph_verbform_matrix == 'Fin',
-        'is_part_verb': morph_verbform_matrix == 'Part',
-        'is_inf_verb': morph_verbform_matrix == 'Inf',
-
-        'is_perf_aspect': morph_aspect_matrix == 'Perf',
-        'is_prog_aspect': morph_aspect_matrix == 'Prog',
-    }
-
-    ent_label_classes = ['PERSON', 'ORG', 'CARDINAL', 'DATE', 'GPE',
-        'WORK_OF_', 'PRODUCT', 'LAW', 'PERCENT', 'QUANTITY', 'TIME',
-        'NORP', 'FAC', 'ORDINAL', 'MONEY', 'LOC', 'EVENT', 'LANGUAGE']
-
-    ent_labels = {
-        f'is_{ent}': ent_type_matrix == ent for ent in ent_label_classes
-    }
-
-    misc_labels = {
-        'is_stop': is_stop_matrix == 'True',
-        'sent_end': is_sent_end_matrix == 'True',
-        'sent_begin': is_sent_begins_matrix == 'True',
-    }
-
-    label_sets = [
-        pos_labels, dependency_labels, morph_labels, ent_labels, misc_labels
-    ]
-    full_label_dict = {k: v.flatten() for label_set in label_sets
-                        for k, v in label_set.items()}
-
-    label_df = pd.DataFrame(full_label_dict)
-    return label_df
\ No newline at end of file
+        codes['is_sent_end'][i, -1] = 0
+    return codes
+
+
+def tag_tokens(
+    model,
+    token_tensor,
+    store_path: str,
+    shard_size: int = 10_000,
+    batch_size: int = 100,
+    n_process: int = 4,
+    spacy_model: str = 'en_core_web_trf',
+):
+    """Tag the rows of token_tensor (n, seq_len), which start with BOS, in shards of shard_size rows. spaCy parses each shard
+    with n_process processes. Shards and the attribute vocabularies are written atomically, so an interrupted run resumes
+    at the first missing shard."""
+    os.makedirs(store_path, exist_ok=True)
+    state = load_vocab(store_path)
+    vocab = {attribute: {value: code for code, value in enumerate(values)} for attribute, values in state["vocab"].items()}
+
+    if n_process == 1:
+        spacy.prefer_gpu()
+    nlp = spacy.load(spacy_model)
+
+    for shard_index, start in enumerate(range(0, len(token_tensor), shard_size)):
+        if shard_index < state["num_shards"]:
+            continue
+        print(timestamp(), f'Tagging rows {start} to {min(start + shard_size, len(token_tensor))}')
+        shard_tokens = token_tensor[start : start + shard_size]
+        texts = (model.to_string(shard_tokens[i, 1:]) for i in range(len(shard_tokens)))
+        docs = nlp.pipe(texts, batch_size=batch_size, n_process=n_process)
+        codes = tag_shard(docs, model, shard_tokens, vocab)
+
+        for attribute, attribute_codes in codes.items():
+            path = get_array_path(store_path, shard_index, attribute)
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, attribute_codes)
+            os.replace(path + ".tmp", path)
+        state["num_shards"] = shard_index + 1
+        state["shard_sizes"] = state["shard_sizes"][:shard_index] + [len(shard_tokens)]
+        state["vocab"] = {attribute: list(values) for attribute, values in vocab.items()}
+        save_json(state, os.path.join(store_path, "vocab.json"))
+
+
+class SpacyTagStore:
+    """
+    Reads a store written by tag_tokens. The code arrays are memory-mapped and boolean labels, see SPACY_LABELS, are only
+    computed when they are requested. Labels are flattened over (row, position) like the columns of make_spacy_feature_df.
+    """
+
+    def __init__(self, store_path: str):
+        state = load_vocab(store_path)
+        if state["num_shards"] == 0:
+            raise FileNotFoundError(f"No tagged shards found at {store_path}, run tag_tokens first")
+        self.store_path = store_path
+        self.shard_sizes = state["shard_sizes"]
+        self.vocab = state["vocab"]
+
+    def get_codes(self, attribute: str) -> np.ndarray:
+        """(n, seq_len) int16 codes of an attribute, decoded by self.vocab[attribute]"""
+        shards = [np.load(get_array_path(self.store_path, i, attribute), mmap_mode="r") for i in range(len(self.shard_sizes))]
+        return shards[0] if len(shards) == 1 else np.concatenate(shards)
+
+    def get_values(self, attribute: str) -> np.ndarray:
+        """(n, seq_len) string values of an attribute"""
+        return np.array(self.vocab[attribute])[self.get_codes(attribute)]
+
+    def get_label(self, name: str) -> np.ndarray:
+        attribute, value = SPACY_LABELS[name]
+        if value not in self.vocab[attribute]:
+            return np.zeros(sum(self.shard_sizes) * self.get_codes(attribute).shape[1], dtype=bool)
+        return (self.get_codes(attribute) == self.vocab[attribute].index(value)).flatten()
+
+    def get_label_df(self, names: list[str] | None = None) -> pd.DataFrame:
+        names = list(SPACY_LABELS) if names is None else names
+        return pd.DataFrame({name: self.get_label(name) for name in names})
+
+
+def make_spacy_feature_df(model, token_tensor, store_path: str | None = None, n_process: int = 1, **kwargs):
+    """One boolean column per SPACY_LABELS label and one row per token. Without store_path the tags are written to a
+    temporary store that is removed afterwards."""
+    if store_path is not None:
+        tag_tokens(model, token_tensor, store_path, n_process=n_process, **kwargs)
+        return SpacyTagStore(store_path).get_label_df()
+    with tempfile.TemporaryDirectory() as temp_path:
+        tag_tokens(model, token_tensor, temp_path, n_process=n_process, **kwargs)
+        return SpacyTagStore(temp_path).get_label_df()
+
+
+if __name__ == "__main__":
+    import argparse
+    import torch
+    from transformer_lens import HookedTransformer
+    from process_tiny_stories_data import load_tinystories_tokens
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name", type=str, default="tiny-stories-2L-33M")
+    parser.add_argument("--data_path", type=str, default="/workspace/data/tinystories")
+    parser.add_argument("--tag_store_path", type=str, required=True)
+    parser.add_argument("--num_rows", type=int, default=100_000)
+    parser.add_argument("--shard_size", type=int, default=10_000)
+    parser.add_argument("--n_process", type=int, default=4)
+    args = parser.parse_args()
+    torch.set_grad_enabled(False)
+
+    model = HookedTransformer.from_pretrained(args.model_name, device="cpu")
+    token_tensor = load_tinystories_tokens(args.data_path)[: args.num_rows]
+    tag_tokens(model, token_tensor, args.tag_store_path, shard_size=args.shard_size, n_process=args.n_process)
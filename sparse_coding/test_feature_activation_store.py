@@ -0,0 +1,74 @@
+import os
+import sys
+sys.path.append("../")  # Add the parent directory to the system path
+
+import torch
+from transformer_lens import HookedTransformer
+
+import utils.haystack_utils as haystack_utils
+from utils.autoencoder_utils import AutoEncoderConfig
+from sparse_coding.autoencoder import AutoEncoder
+from sparse_coding.feature_activation_store import FeatureActivationStore, write_feature_activation_store
+
+
+PROMPTS = ["Once upon a time there was a cat.", "The dog ran", "She said hello to her friend in the park.", "Hi"]
+
+
+def get_model_and_encoder():
+    model = HookedTransformer.from_pretrained("EleutherAI/pythia-70m", fold_ln=True, device=haystack_utils.get_device())
+    cfg = AutoEncoderConfig(layer=1, act_name="hook_mlp_out", expansion_factor=1, l1_coeff=0.0, d_in=model.cfg.d_model)
+    encoder = AutoEncoder(64, 0.0, model.cfg.d_model).to(haystack_utils.get_device())
+    # A negative encoder bias keeps the codes sparse
+    encoder.b_enc.data[:] = -1.0
+    return model, encoder, cfg
+
+
+@torch.no_grad()
+def get_dense_codes(prompts, model, encoder, cfg, batch_size):
+    codes = []
+    for i in range(0, len(prompts), batch_size):
+        tokens = model.to_tokens(prompts[i : i + batch_size])
+        active_tokens = haystack_utils.get_active_token_mask(tokens, model)
+        _, cache = model.run_with_cache(tokens, names_filter=cfg.encoder_hook_point)
+        codes.append(encoder(cache[cfg.encoder_hook_point][active_tokens])[2])
+    return torch.cat(codes).cpu()
+
+
+def test_feature_activation_store_round_trip(tmp_path):
+    model, encoder, cfg = get_model_and_encoder()
+    codes = get_dense_codes(PROMPTS, model, encoder, cfg, batch_size=2)
+    assert (codes > 0).any() and (codes == 0).any()
+
+    # Small shards, so that reads span shard boundaries
+    write_feature_activation_store(PROMPTS, model, encoder, cfg, str(tmp_path), batch_size=2, shard_tokens=5)
+    store = FeatureActivationStore(str(tmp_path))
+    assert len(store) == codes.shape[0] and len(store.shards) > 1
+
+    torch.testing.assert_close(store.get_dense_activations(0, len(store)), codes, atol=1e-2, rtol=1e-2)
+    torch.testing.assert_close(store.get_dense_activations(3, 11), codes[3:11], atol=1e-2, rtol=1e-2)
+    for token_index in range(len(store)):
+        features, values = store.get_token_activations(token_index)
+        torch.testing.assert_close(features, codes[token_index].nonzero()[:, 0])
+        torch.testing.assert_close(values, codes[token_index][features], atol=1e-2, rtol=1e-2)
+    for feature in range(encoder.d_hidden):
+        token_indices, values = store.get_feature_activations(feature)
+        torch.testing.assert_close(token_indices, codes[:, feature].nonzero()[:, 0])
+        torch.testing.assert_close(values, codes[token_indices, feature], atol=1e-2, rtol=1e-2)
+    torch.testing.assert_close(store.get_feature_frequencies(), (codes > 0).float().mean(0))
+
+
+def test_feature_activation_store_rewrite_removes_stale_shards(tmp_path):
+    model, encoder, cfg = get_model_and_encoder()
+    write_feature_activation_store(PROMPTS, model, encoder, cfg, str(tmp_path), batch_size=2, shard_tokens=5)
+    old_store = FeatureActivationStore(str(tmp_path))
+    old_store.get_feature_activations(0)  # Builds the CSC copies of every shard
+
+    write_feature_activation_store(PROMPTS[:2], model, encoder, cfg, str(tmp_path), batch_size=2)
+    store = FeatureActivationStore(str(tmp_path))
+    assert len(store.shards) == 1
+    assert sorted(os.listdir(tmp_path)) == sorted(["metadata.json"] + [f"shard_0_{name}.npy" for name in ["tokens", "prompt_ids", "positions", "indptr", "indices", "values"]])
+
+    codes = get_dense_codes(PROMPTS[:2], model, encoder, cfg, batch_size=2)
+    token_indices, values = store.get_feature_activations(0)
+    torch.testing.assert_close(token_indices, codes[:, 0].nonzero()[:, 0])
+    torch.testing.assert_close(values, codes[token_indices, 0], atol=1e-2, rtol=1e-2)
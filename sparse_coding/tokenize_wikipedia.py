@@ -1,15 +1,12 @@
-import json
 import os
 import sys
-from itertools import islice
 import argparse
+from glob import glob
+from typing import Iterator
 
 import torch
 from datasets import load_dataset, Dataset
 from transformer_lens import HookedTransformer
-from tqdm import tqdm
-import psutil
-import ijson
 
 
 sys.path.append("../")  # Add the parent directory to the system path
@@ -19,53 +16,17 @@ from utils.autoencoder_utils import batch_prompts
 
 # languages = ["bg", "cs", "da", "de", "el", "es", "en", "et", "fi", "fr", "ga", "hr", "hu", "it", "lt", "lv", "mt", "nl", "pl", "pt", "ro", "sk", "sl", "sv"]
 wikipedia_languages = ["de"]
-datasets: dict[str, list[str]] = {lang: [] for lang in wikipedia_languages}
 
 
-def add_to_dataset(
-    data: Dataset, language: str, n_batches: int, batch_size: int, min_chars=500
-):
-    save_filename = f"sparse_coding/data/wikipedia/{language}_samples.json"
-
-    n_lines = batch_size * n_batches
-    lines_count = 0
-    """Get lines of sufficient length and add to the global datasets dictionary"""
-    for i, line in tqdm(enumerate(data)):
+def get_long_lines(data: Dataset, min_chars=500) -> Iterator[str]:
+    """Stream the lines of sufficient length, so the full dataset never has to be held in memory"""
+    for line in data:
         if len(line["text"]) > min_chars:
-            datasets[language].append(line["text"])
-            lines_count += 1
-
-        # if lines_count == n_lines:
-        #     break
-
-        if psutil.virtual_memory().percent > 90:
-            print(
-                f"Memory overusage detected at {psutil.virtual_memory().percent}% and {i} lines, saving..."
-            )
-            with open(save_filename, "w", encoding="utf-8") as f:
-                json.dump(datasets[language], f)
-            print(f"\n{language}: {len(datasets[language])}")
-            return
-
-    with open(save_filename, "w", encoding="utf-8") as f:
-        json.dump(datasets[language], f)
-    print(
-        f"Saved {len(datasets[language])} lines of {language} data, {os.path.getsize(save_filename)} bytes"
-    )
-
+            yield line["text"]
 
-def chunked(iterable: list[str], n: int):
-    it = iter(iterable)
-    while True:
-        chunk = list(islice(it, n))
-        if not chunk:
-            return
-        yield chunk
 
-
-def tokenize_dataset(language: str, n_batches: int, batch_size: int):
+def tokenize_dataset(data: Dataset, language: str, rows_per_shard: int, min_chars=500):
     seq_len = 127
-    filename = f"sparse_coding/data/wikipedia/{language}_samples.json"
     model = HookedTransformer.from_pretrained(
         "EleutherAI/pythia-70m",
         center_unembed=True,
@@ -74,16 +35,20 @@ def tokenize_dataset(language: str, n_batches: int, batch_size: int):
         device=get_device(),
     )
 
-    with open(filename, "rb") as f:
-        items = ijson.items(f, "item")
-        for i, batch in enumerate(chunked(items, batch_size)):
-            # if i == n_batches:
-            #     break
-            tensor = batch_prompts(batch, model, seq_len)
-            torch.save(
-                tensor, f"sparse_coding/data/wikipedia/{language}_batched_{i}.pt"
-            )
-            del tensor
+    # Packed and shuffled on disk, the returned tensor is memory-mapped
+    tensor = batch_prompts(
+        get_long_lines(data, min_chars), model, seq_len, output_path=f"sparse_coding/data/wikipedia/{language}_batched.npy"
+    )
+    # Also write the rows as .pt shards, the input format of create_dataset.py. create_dataset.py counts the shards on disk,
+    # so shards of a previous run are removed first.
+    for path in glob(f"sparse_coding/data/wikipedia/{language}_batched_*.pt"):
+        os.remove(path)
+    num_shards = (tensor.shape[0] + rows_per_shard - 1) // rows_per_shard
+    for i in range(num_shards):
+        torch.save(
+            tensor[i * rows_per_shard : (i + 1) * rows_per_shard].clone(), f"sparse_coding/data/wikipedia/{language}_batched_{i}.pt"
+        )
+    print(f"Saved {tensor.shape[0]} rows of {language} data in {num_shards} shards")
 
 
 if __name__ == "__main__":
@@ -91,21 +56,20 @@ if __name__ == "__main__":
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     parser.add_argument(
-        "--n_batches",
+        "--rows_per_shard",
         type=int,
-        help="Number of batches to process",
-        default=1,
+        help="Number of tokenized rows per .pt shard",
+        default=2**18,
     )
     parser.add_argument(
-        "--batch_size",
+        "--min_chars",
         type=int,
-        help="Number of lines of data per batch",
-        default=50_000,
+        help="Minimum number of characters of a line to be included",
+        default=500,
     )
     args = parser.parse_args()
 
     os.makedirs("sparse_coding/data/wikipedia", exist_ok=True)
     for language in wikipedia_languages:
         data: Dataset = load_dataset("wikipedia", f"20220301.{language}", split="train")
-        add_to_dataset(data, language, args.n_batches, args.batch_size)
-        tokenize_dataset(language, args.n_batches, args.batch_size)
+        tokenize_dataset(data, language, args.rows_per_shard, args.min_chars)
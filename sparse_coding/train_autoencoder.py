@@ -30,8 +30,9 @@ from utils.autoencoder_utils import (
     AutoEncoderConfig,
     act_name_to_d_in
 )
-from utils.haystack_utils import get_device
+from utils.haystack_utils import get_device, get_truncated_cache
 from autoencoder import AutoEncoder
+from activation_store import ActivationStore
 import time
 
 
@@ -96,9 +97,7 @@ class Buffer:
                 ]
                 tokens = tokens.to(torch.long)
                 with torch.no_grad():
-                    _, cache = self.model.run_with_cache(
-                        tokens, names_filter=self.hook_name
-                    )
+                    cache = get_truncated_cache(tokens, self.model, self.hook_name)
                 acts = cache[self.hook_name].reshape(-1, self.cfg["d_in"])
                 # print(tokens.shape, acts.shape, self.pointer, self.token_pointer, self.buffer[self.pointer: self.pointer+acts.shape[0]].shape)
                 if len(self.buffer) - self.pointer > 0:
@@ -185,6 +184,15 @@ def get_num_similar_dec_features(W_dec: Float[Tensor, "d_hidden d_mlp"]):
     return cosine_sims
 
 
+def get_activation_buffer(cfg: dict, model: HookedTransformer, prompt_data: Int[Tensor, "n_examples seq_len"], device: str) -> Buffer | ActivationStore:
+    """Stream activations from the pre-computed store if one is configured, otherwise run the model as training goes"""
+    if cfg.get("activation_store_path") is not None:
+        buffer = ActivationStore(cfg["activation_store_path"], cfg["batch_size"], device, seed=cfg["seed"])
+        assert buffer.hook_name == f'blocks.{cfg["layer"]}.{cfg["act"]}', f"Activation store holds {buffer.hook_name} activations"
+        return buffer
+    return Buffer(cfg, model, prompt_data, device)
+
+
 def main(
     encoder: AutoEncoder,
     model: HookedTransformer,
@@ -284,7 +292,7 @@ def main(
             encoder_optim.state_dict()["state"][2]["exp_avg_sq"][dead_direction_indices] = 0
 
     dead_directions = torch.ones(size=(encoder.d_hidden,)).bool().to(device)
-    buffer = Buffer(cfg, model, prompt_data, device)
+    buffer = get_activation_buffer(cfg, model, prompt_data, device)
     eval_batch = torch.cat(list(islice(buffer, cfg["num_eval_batches"])), dim=0).detach().cpu()
     print(f"Eval batch shape: {eval_batch.shape}")
 
@@ -458,11 +466,12 @@ DEFAULT_CONFIG = {
     "save_checkpoint_models": False,
     "reg": "l1", # l1 | sqrt | hoyer | hoyer_d | hoyer_d_scaled_l1 | combined_hoyer_l1 | combined_hoyer_sqrt
     "finetune_encoder": None,
+    "activation_store_path": None,  # Stream activations written by activation_store.py instead of running the model during training
 }
 
 
-def get_config():
-    cfg = DEFAULT_CONFIG.copy()
+def get_config(default_config: dict = DEFAULT_CONFIG):
+    cfg = default_config.copy()
 
     # Accept alternative config values from command line
     parser = argparse.ArgumentParser(
@@ -475,8 +484,11 @@ def get_config():
                 parser.add_argument(f"--{key}", action="store_false")
             else:
                 parser.add_argument(f"--{key}", action="store_true")
+        elif type(value) == list:
+            parser.add_argument(f"--{key}", type=type(value[0]), nargs="+", default=value)
         else:
-            parser.add_argument(f"--{key}", type=type(value), default=value)
+            # Options that default to None take a string, e.g. a file path
+            parser.add_argument(f"--{key}", type=str if value is None else type(value), default=value)
     args = parser.parse_args()
     parsed_args = vars(args)
     cfg.update(parsed_args)
@@ -0,0 +1,250 @@
+# Train a sweep of sparse autoencoders in one process. All members read the same activation batch each step and
+# their forward, backward and optimizer update run as a single vmapped call through FunctionalEnsemble.
+# Members are the grid of --l1_coeffs and --expansion_factors, all other options are shared with train_autoencoder.py, e.g.
+# python train_autoencoder_ensemble.py --l1_coeffs 0.0001 0.0002 0.0004 --expansion_factors 4 8
+import os
+import sys
+
+sys.path.append("../")
+
+import json
+import random
+from itertools import islice, product
+
+import torch
+import torchopt
+import numpy as np
+import torch.nn.functional as F
+from torch import Tensor
+from tqdm.auto import tqdm
+from jaxtyping import Float, Bool
+from transformer_lens import HookedTransformer
+import wandb
+
+from autoencoders.ensemble import FunctionalEnsemble
+from autoencoders.learned_dict import LearnedDict
+from autoencoders.sae_ensemble import FunctionalSAE, FunctionalTiedSAE, FunctionalMaskedSAE, FunctionalMaskedTiedSAE
+from process_tiny_stories_data import (
+    load_tinystories_validation_prompts,
+    load_tinystories_tokens,
+)
+from train_autoencoder import DEFAULT_CONFIG, get_config, get_activation_buffer
+from utils.autoencoder_utils import act_name_to_d_in
+from utils.haystack_utils import get_device
+
+
+ENSEMBLE_CONFIG = {
+    **DEFAULT_CONFIG,
+    "l1_coeffs": [0.0001, 0.0002, 0.0004, 0.0008],
+    "expansion_factors": [4],
+    "tied": False,
+}
+
+
+def get_ensemble(cfg: dict, device: str) -> tuple[FunctionalEnsemble, list[str]]:
+    """One ensemble member per combination of l1 coefficient and expansion factor. Members with different dictionary
+    sizes are padded to the largest size and use the masked SAEs, which zero out the unused components."""
+    members = list(product(cfg["l1_coeffs"], cfg["expansion_factors"]))
+    dict_sizes = [cfg["d_in"] * expansion_factor for _, expansion_factor in members]
+    torch.manual_seed(cfg["seed"])
+    if len(set(dict_sizes)) == 1:
+        sig = FunctionalTiedSAE if cfg["tied"] else FunctionalSAE
+        models = [sig.init(cfg["d_in"], dict_size, l1_coeff, device=device) for (l1_coeff, _), dict_size in zip(members, dict_sizes)]
+    else:
+        sig = FunctionalMaskedTiedSAE if cfg["tied"] else FunctionalMaskedSAE
+        models = [
+            sig.init(cfg["d_in"], dict_size, max(dict_sizes), l1_coeff, device=device)
+            for (l1_coeff, _), dict_size in zip(members, dict_sizes)
+        ]
+    ensemble = FunctionalEnsemble(
+        models, sig, torchopt.adam, {"lr": cfg["lr"], "betas": (cfg["beta1"], cfg["beta2"])}, device=device
+    )
+    names = [f"l1_{l1_coeff:.2e}_x{expansion_factor}" for l1_coeff, expansion_factor in members]
+    print(f"Training {len(names)} autoencoders with {sig.__name__}: {names}")
+    return ensemble, names
+
+
+def get_member(ensemble: FunctionalEnsemble, member: int) -> tuple[dict[str, Tensor], dict[str, Tensor]]:
+    """Views into the stacked params and buffers of one member, writing to them updates the ensemble"""
+    params = {key: value[member] for key, value in ensemble.params.items()}
+    buffers = {key: value[member] for key, value in ensemble.buffers.items()}
+    return params, buffers
+
+
+def get_live_components(ensemble: FunctionalEnsemble) -> Bool[Tensor, "n_models n_components"]:
+    """Components that belong to each member's dictionary, i.e. excluding the padding of masked SAEs"""
+    if "coef_mask" in ensemble.buffers:
+        return ~ensemble.buffers["coef_mask"]
+    return torch.ones(ensemble.params["encoder"].shape[:2], dtype=torch.bool, device=ensemble.device)
+
+
+@torch.no_grad()
+def resample_dead_directions(
+    ensemble: FunctionalEnsemble,
+    member: int,
+    eval_batch: Float[Tensor, "batch d_in"],
+    dead_directions: Bool[Tensor, "n_components"],
+    batch_size: int,
+) -> int:
+    """Same resampling scheme as train_autoencoder.main, applied to a single member of the ensemble"""
+    dead_direction_indices = torch.argwhere(dead_directions).flatten()
+    num_dead_directions = len(dead_direction_indices)
+    if num_dead_directions == 0:
+        return 0
+
+    params, buffers = get_member(ensemble, member)
+    learned_dict = ensemble.sig.to_learned_dict(params, buffers)
+    x_reconstruct = torch.cat(
+        [learned_dict.predict(eval_batch[i : i + batch_size].to(ensemble.device)) for i in range(0, eval_batch.shape[0], batch_size)]
+    ).cpu()
+
+    # Losses per batch item
+    l2_loss = (x_reconstruct - eval_batch).pow(2).sum(-1)
+    loss = l2_loss.pow(2)
+    indices = torch.multinomial(loss / loss.sum(), num_dead_directions, replacement=False)
+    neuron_inputs = F.normalize(eval_batch[indices], dim=-1).to(ensemble.device)
+
+    if "decoder" in params:
+        params["decoder"][dead_direction_indices] = neuron_inputs
+        active_directions = torch.argwhere(~dead_directions & get_live_components(ensemble)[member]).flatten()
+        mean_active_norm = params["encoder"][active_directions].norm(p=2, dim=-1).mean() * 0.2
+        params["encoder"][dead_direction_indices] = neuron_inputs * mean_active_norm
+    else:
+        # Tied dictionaries normalise the encoder rows, so their scale doesn't matter
+        params["encoder"][dead_direction_indices] = neuron_inputs
+    params["encoder_bias"][dead_direction_indices] = 0
+
+    # Reset the Adam moments of the resampled directions
+    for optim_state in ensemble.optim_states:
+        if hasattr(optim_state, "mu"):
+            for moments in (optim_state.mu, optim_state.nu):
+                for value in moments.values():
+                    value[member, dead_direction_indices] = 0
+    return num_dead_directions
+
+
+@torch.no_grad()
+def evaluate_reconstruction_loss(learned_dict: LearnedDict, encoded_hook_name: str, data: list[str], model: HookedTransformer) -> float:
+    def encode_activations_hook(value, hook):
+        x_reconstruct = learned_dict.predict(value.reshape(-1, value.shape[-1]).float())
+        return x_reconstruct.reshape(value.shape).to(value.dtype)
+
+    losses = []
+    with model.hooks([(encoded_hook_name, encode_activations_hook)]):
+        for prompt in data:
+            losses.append(model(prompt, return_type="loss").item())
+    return np.mean(losses)
+
+
+def main(
+    ensemble: FunctionalEnsemble,
+    names: list[str],
+    model: HookedTransformer,
+    cfg: dict,
+    prompt_data,
+    eval_prompts: list[str],
+    device: str,
+):
+    num_eval_tokens = cfg["num_eval_batches"] * cfg["batch_size"]
+    if torch.numel(prompt_data) < (num_eval_tokens + cfg["buffer_size"]):
+        raise ValueError(
+            f"Not enough tokens for training: {torch.numel(prompt_data)} < {num_eval_tokens} + {cfg['buffer_size']}"
+        )
+    num_training_batches = int(cfg["num_training_tokens"]) // cfg["batch_size"]
+    hook_name = f'blocks.{cfg["layer"]}.{cfg["act"]}'
+
+    if cfg["use_wandb"]:
+        wandb.init(project=f'{cfg["model"]}-{cfg["layer"]}-autoencoder', config=cfg)
+        wandb_name = wandb.run.name
+        save_name = f"{wandb_name.split('-')[-1]}_" + "_".join(wandb_name.split("-")[:-1]) + "_ensemble"
+        cfg["wandb_name"] = wandb_name
+    else:
+        save_name = "local_ensemble"
+    cfg["save_name"] = save_name
+    cfg["member_names"] = names
+    os.makedirs(f"{cfg['save_path']}/{cfg['model']}", exist_ok=True)
+    with open(f"{cfg['save_path']}/{cfg['model']}/{save_name}.json", "w") as f:
+        json.dump(cfg, f, indent=4)
+
+    live_components = get_live_components(ensemble)
+    dead_directions = live_components.clone()
+    buffer = get_activation_buffer(cfg, model, prompt_data, device)
+    eval_batch = torch.cat(list(islice(buffer, cfg["num_eval_batches"])), dim=0).detach().cpu().float()
+    print(f"Eval batch shape: {eval_batch.shape}")
+
+    reset_steps = [25000, 50000, 75000, 100000]
+    count_dead_direction_steps = [step - 12500 for step in reset_steps]
+    dead_directions_reset_interval = 50000
+    eval_interval = 500
+    save_interval = 10000
+
+    for batch_index in tqdm(range(num_training_batches)):
+        batch = next(buffer).to(device).float()
+        loss_data, aux_data = ensemble.step_batch(batch)
+
+        active = aux_data["c"] != 0  # n_models batch n_components
+        dead_directions = (active.sum(dim=1) == 0) & dead_directions
+        avg_directions = active.sum(dim=-1).float().mean(dim=-1).tolist()
+
+        loss_dict = {"batch": batch_index, "epoch": buffer.epoch}
+        member_losses = {key: value.tolist() for key, value in loss_data.items()}
+        for member, name in enumerate(names):
+            loss_dict[f"{name}/loss"] = member_losses["loss"][member]
+            loss_dict[f"{name}/mse_loss"] = member_losses["l_reconstruction"][member]
+            loss_dict[f"{name}/reg_loss"] = member_losses["l_l1"][member]
+            loss_dict[f"{name}/avg_directions"] = avg_directions[member]
+
+        if (batch_index + 1) % eval_interval == 0:
+            num_dead_directions = dead_directions.sum(dim=-1).tolist()
+            for member, name in enumerate(names):
+                learned_dict = ensemble.sig.to_learned_dict(*get_member(ensemble, member))
+                reconstruction_loss = evaluate_reconstruction_loss(learned_dict, hook_name, eval_prompts, model)
+                loss_dict[f"{name}/reconstruction_loss"] = reconstruction_loss
+                loss_dict[f"{name}/dead_directions"] = num_dead_directions[member]
+                print(
+                    f"\n(Batch {batch_index}, {name}) Loss: {loss_dict[f'{name}/loss']:.2f}, MSE loss: {loss_dict[f'{name}/mse_loss']:.2f}, "
+                    f"reg_loss: {loss_dict[f'{name}/reg_loss']:.2f}, Avg directions: {avg_directions[member]:.2f}, "
+                    f"Dead directions: {num_dead_directions[member]}, Reconstruction loss: {reconstruction_loss:.2f}"
+                )
+
+        if (batch_index + 1) % save_interval == 0:
+            torch.save(ensemble.state_dict(), f"{cfg['save_path']}/{cfg['model']}/{save_name}.pt")
+
+        if (batch_index + 1) in reset_steps:
+            for member, name in enumerate(names):
+                num_resampled = resample_dead_directions(ensemble, member, eval_batch, dead_directions[member], cfg["batch_size"])
+                print(f"\nResampled {num_resampled} dead directions of {name}")
+
+        if ((batch_index + 1) in count_dead_direction_steps + reset_steps) or (
+            ((batch_index + 1) > max(reset_steps)) and ((batch_index + 1) % dead_directions_reset_interval == 0)
+        ):
+            dead_directions = live_components.clone()
+
+        if cfg["use_wandb"]:
+            wandb.log(loss_dict)
+
+    torch.save(ensemble.state_dict(), f"{cfg['save_path']}/{cfg['model']}/{save_name}.pt")
+    if cfg["use_wandb"]:
+        wandb.finish()
+
+
+if __name__ == "__main__":
+    cfg = get_config(ENSEMBLE_CONFIG)
+    prompt_data = load_tinystories_tokens(cfg["data_path"])
+    eval_prompts = load_tinystories_validation_prompts(cfg["data_path"])[: cfg["num_eval_prompts"]]
+
+    np.random.seed(cfg["seed"])
+    random.seed(cfg["seed"])
+
+    device = get_device()
+    model = HookedTransformer.from_pretrained(
+        cfg["model"],
+        center_unembed=True,
+        center_writing_weights=True,
+        fold_ln=True,
+        device=device,
+    )
+    cfg["d_in"] = act_name_to_d_in(model, cfg["act"])
+
+    ensemble, names = get_ensemble(cfg, device)
+    main(ensemble, names, model, cfg, prompt_data, eval_prompts, device)
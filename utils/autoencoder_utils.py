@@ -7,7 +7,10 @@ from jaxtyping import Int, Float
 from torch import Tensor
 import einops
 from dataclasses import dataclass
-from typing import Literal
+from typing import Literal, Iterable, Iterator
+from itertools import islice
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from transformer_lens import HookedTransformer
 import torch
 from collections import Counter
@@ -80,8 +83,7 @@ def get_direction_ablation_hook(encoder, direction, hook_pos=None):
     if type(direction) == int:
         direction = [direction]
     def subtract_direction_hook(value, hook):
-        x_cent = value[0, :] - encoder.b_dec
-        acts = F.relu(x_cent @ encoder.W_enc[:, direction] + encoder.b_enc[direction])
+        acts = encoder.encode(value[0, :], features=direction)
         direction_impact_on_reconstruction = einops.einsum(acts, encoder.W_dec[direction, :], "pos directions, directions d_mlp -> pos d_mlp") # + encoder.b_dec ???
         if hook_pos is not None:
             value[:, hook_pos, :] -= direction_impact_on_reconstruction[hook_pos]
@@ -109,6 +111,70 @@ def evaluate_direction_ablation_single_prompt(prompt: str, encoder: AutoEncoder,
             ablated_loss = model(prompt, return_type="loss", loss_per_token=True)
     return original_loss, ablated_loss
 
+def get_feature_ablation_losses(
+    prompts: str | list[str] | Int[Tensor, "batch pos"],
+    encoder: AutoEncoder,
+    model: HookedTransformer,
+    cfg: AutoEncoderConfig,
+    features: Int[Tensor, "n_features"] | list[int],
+    pos: None | int = None,
+    fwd_hooks: list = [],
+    variant_batch_size: int = 8,
+) -> Float[Tensor, "n_features batch"]:
+    """ Exact loss change from ablating each single feature like evaluate_direction_ablation_single_prompt, for a batch of prompts.
+    Chunks of variant_batch_size features are evaluated in one stacked forward pass each, with fwd_hooks applied to every variant. """
+    tokens = prompts if isinstance(prompts, Tensor) else model.to_tokens(prompts)
+    features = torch.as_tensor(features, dtype=torch.long).tolist()
+    original_loss = haystack_utils.get_repeated_losses(tokens, model, 1, fwd_hooks, pos=pos)
+
+    loss_diffs = []
+    for i in range(0, len(features), variant_batch_size):
+        chunk = features[i:i + variant_batch_size]
+
+        def ablate_features_hook(value, hook):
+            value = value.reshape(len(chunk), *tokens.shape, -1)
+            # Every variant has the same activations upstream of its ablation
+            acts = encoder.encode(value[0], features=chunk)
+            direction_impact_on_reconstruction = einops.einsum(
+                acts, encoder.W_dec[chunk], "batch pos feature, feature d_mlp -> feature batch pos d_mlp"
+            )
+            if pos is not None:
+                value[:, :, pos] -= direction_impact_on_reconstruction[:, :, pos]
+            else:
+                value -= direction_impact_on_reconstruction
+            return value.reshape(-1, *value.shape[2:])
+
+        loss = haystack_utils.get_repeated_losses(
+            tokens, model, len(chunk), fwd_hooks, [(cfg.encoder_hook_point, ablate_features_hook)], pos
+        )
+        loss_diffs.append(loss - original_loss)
+    return torch.cat(loss_diffs)
+
+@torch.no_grad()
+def get_feature_attribution_patching_effects(
+    prompts: str | list[str] | Int[Tensor, "batch pos"],
+    encoder: AutoEncoder,
+    model: HookedTransformer,
+    cfg: AutoEncoderConfig,
+    pos: None | int = None,
+    fwd_hooks: list = [],
+    verify_top_k: int | None = None,
+    variant_batch_size: int = 8,
+) -> Float[Tensor, "d_hidden batch"] | tuple[Float[Tensor, "d_hidden batch"], Int[Tensor, "k"], Float[Tensor, "k batch"]]:
+    """ Attribution patching: linear estimate of get_feature_ablation_losses for every feature from one forward and one backward pass.
+    Ablating a feature subtracts acts * W_dec[feature] from the activation, so its estimate is -acts * (W_dec[feature] @ loss gradient).
+    With verify_top_k the k features with the largest absolute mean estimate are also ablated exactly and returned with their exact
+    loss changes. """
+    activation, gradient = haystack_utils.get_activation_loss_gradient(prompts, model, cfg.encoder_hook_point, fwd_hooks, pos)
+    if pos is not None:
+        activation, gradient = activation[:, [pos]], gradient[:, [pos]]
+    effects = -(encoder.encode(activation) * (gradient @ encoder.W_dec.T)).sum(1).T
+    if verify_top_k is None:
+        return effects
+    top_features = effects.mean(1).abs().topk(verify_top_k).indices
+    exact_effects = get_feature_ablation_losses(prompts, encoder, model, cfg, top_features, pos, fwd_hooks, variant_batch_size)
+    return effects, top_features, exact_effects
+
 def eval_ablation_token_rank(prompt: str, encoder: AutoEncoder, model: HookedTransformer, direction: int | list[int], cfg: AutoEncoderConfig, answer_token: str, pos: int = -2):
     encoder_hook_point = f"blocks.{cfg.layer}.{cfg.act_name}"
     answer_token_index = model.to_single_token(answer_token)
@@ -125,26 +191,72 @@ def eval_ablation_token_rank(prompt: str, encoder: AutoEncoder, model: HookedTra
         ablated_answer_logit = ablated_logits[answer_token_index]
     return answer_logprob.item(), ablated_answer_logprob.item(), answer_logit.item(), ablated_answer_logit.item(), answer_rank, ablated_answer_rank
 
-def eval_direction_tokens_global(max_activations, prompts, model, encoder, cfg, percentage_threshold = 0.25):
-    max_activation_value = max_activations.max(dim=0)[0]
-    threshold_per_direction = max_activation_value * percentage_threshold
-    token_wise_activations = torch.zeros((encoder.d_hidden, model.cfg.d_vocab), dtype=torch.int32)
-
-    for i, prompt in tqdm(enumerate(prompts), total=len(prompts)):
-        tokens = model.to_tokens(prompt).flatten().cpu()
-        activations = get_acts(prompt, model, encoder, cfg).cpu()
-        num_tokens = activations.shape[0]
-        for position in range(10, num_tokens):
-            valid_directions = torch.argwhere(activations[position] > threshold_per_direction).flatten().cpu()
-            if len(valid_directions) > 0:
-                token_wise_activations[valid_directions, tokens[position]] += 1
+@torch.no_grad()
+def eval_direction_tokens_global(
+    max_activations,
+    prompts,
+    model,
+    encoder,
+    cfg,
+    percentage_threshold=0.25,
+    batch_size=16,
+    layout: Literal["dense", "coo", "csr"] = "dense",
+    start_pos=10,
+):
+    """Count how often each direction activates above percentage_threshold of its max activation on each token, from position start_pos onwards.
+    Prompts are run in right-padded batches and the (direction, token) pairs of a whole batch are counted at once.
+    Returns a (d_hidden, d_vocab) int32 tensor, dense or as a sparse COO/CSR tensor that only stores the observed pairs."""
+    device = encoder.W_enc.device
+    threshold_per_direction = max_activations.max(dim=0)[0].to(device) * percentage_threshold
+    d_vocab = model.cfg.d_vocab
+    # Pairs are stored as flat indices direction * d_vocab + token
+    if layout == "dense":
+        token_wise_activations = torch.zeros(encoder.d_hidden * d_vocab, dtype=torch.int32)
+    pair_indices, pair_counts = [], []
+
+    def merge_pairs():
+        pair_index, inverse = torch.unique(torch.cat(pair_indices), return_inverse=True)
+        pair_count = torch.zeros(len(pair_index), dtype=torch.int32).index_add_(0, inverse, torch.cat(pair_counts))
+        pair_indices[:] = [pair_index]
+        pair_counts[:] = [pair_count]
+
+    for i in tqdm(range(0, len(prompts), batch_size)):
+        tokens = model.to_tokens(prompts[i : i + batch_size])
+        active_tokens = haystack_utils.get_active_token_mask(tokens, model)
+        active_tokens[:, :start_pos] = False
+        cache = haystack_utils.get_truncated_cache(tokens, model, cfg.encoder_hook_point)
+        mid_acts = encoder.encode(cache[cfg.encoder_hook_point][active_tokens])
+        token_indices, directions = torch.nonzero(mid_acts > threshold_per_direction, as_tuple=True)
+        pair_index = directions * d_vocab + tokens[active_tokens][token_indices]
+
+        if layout == "dense":
+            pair_index = pair_index.cpu()
+            token_wise_activations.index_add_(0, pair_index, torch.ones_like(pair_index, dtype=torch.int32))
+        else:
+            pair_index, pair_count = torch.unique(pair_index, return_counts=True)
+            pair_indices.append(pair_index.cpu())
+            pair_counts.append(pair_count.to(torch.int32).cpu())
+            if len(pair_indices) >= 64:
+                merge_pairs()
+
+    if layout == "dense":
+        return token_wise_activations.reshape(encoder.d_hidden, d_vocab)
+
+    if len(pair_indices) == 0:
+        pair_indices.append(torch.zeros(0, dtype=torch.long))
+        pair_counts.append(torch.zeros(0, dtype=torch.int32))
+    merge_pairs()
+    indices = torch.stack([pair_indices[0] // d_vocab, pair_indices[0] % d_vocab])
+    token_wise_activations = torch.sparse_coo_tensor(indices, pair_counts[0], (encoder.d_hidden, d_vocab)).coalesce()
+    if layout == "csr":
+        return token_wise_activations.to_sparse_csr()
     return token_wise_activations
 
 @torch.no_grad()
 def get_acts(prompt: str | Tensor, model: HookedTransformer, encoder: AutoEncoder, cfg: AutoEncoderConfig):
-    _, cache = model.run_with_cache(prompt, names_filter=cfg.encoder_hook_point)
+    cache = haystack_utils.get_truncated_cache(prompt, model, cfg.encoder_hook_point)
     acts = cache[cfg.encoder_hook_point].squeeze(0)
-    _, _, mid_acts, _, _ = encoder(acts)
+    mid_acts = encoder.encode(acts)
     return mid_acts
 
 
@@ -223,27 +335,88 @@ def load_encoder(save_name, model_name, model: HookedTransformer, save_path=".")
     encoder.to(get_device())
     return encoder, cfg
 
-def batch_prompts(data: list[str], model: HookedTransformer, seq_len: int):
-    tensors = []
-    for prompt in tqdm(data):
-        tokens = model.to_tokens(prompt).cpu()
-        tensors.append(tokens)
-
-    batched_tensor = torch.cat(tensors, dim=1)
-    batched_tensor = einops.rearrange(
-        batched_tensor[
-            :, : (batched_tensor.shape[1] - batched_tensor.shape[1] % seq_len)
-        ],
-        "batch (x seq_len) -> (batch x) seq_len",
-        seq_len=seq_len,
-    )
+def tokenize_prompts(prompts: list[str], model: HookedTransformer) -> list[np.ndarray]:
+    """Same tokens as model.to_tokens(prompt) for each prompt (BOS prepended, truncated to n_ctx), in one batch encode call"""
+    bos = [model.tokenizer.bos_token_id]
+    input_ids = model.tokenizer(prompts, add_special_tokens=False)["input_ids"]
+    return [np.array(bos + ids[: model.cfg.n_ctx - 1], dtype=np.int32) for ids in input_ids]
 
-    batched_bos = torch.zeros(batched_tensor.shape[0], 1, dtype=torch.long)
-    batched_bos[:] = model.tokenizer.bos_token_id
-    batched_tensor = torch.cat([batched_bos, batched_tensor], dim=1)
-    batched_tensor = batched_tensor[torch.randperm(batched_tensor.shape[0])]
-    batched_tensor = batched_tensor.to(torch.int32)
-    return batched_tensor
+
+def iterate_packed_rows(
+    data: Iterable[str],
+    model: HookedTransformer,
+    seq_len: int,
+    tokenize_batch_size: int = 1000,
+    num_workers: int = 4,
+) -> Iterator[Int[np.ndarray, "rows seq_len_plus_bos"]]:
+    """Streams the prompts as [BOS] + seq_len rows of the concatenated token stream, like batch_prompts before shuffling.
+    Prompts are tokenized in batches on a thread pool (the fast tokenizer releases the GIL) with at most 2 * num_workers
+    batches in flight, so data can be an iterator over a dataset that doesn't fit in memory. The tail of the token
+    stream that doesn't fill a row is dropped."""
+    data = iter(data)
+    pending = deque()
+    leftover = np.zeros(0, dtype=np.int32)
+    bos = model.tokenizer.bos_token_id
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        while True:
+            while len(pending) < 2 * num_workers:
+                prompts = list(islice(data, tokenize_batch_size))
+                if not prompts:
+                    break
+                pending.append(executor.submit(tokenize_prompts, prompts, model))
+            if not pending:
+                return
+
+            token_stream = np.concatenate([leftover] + pending.popleft().result())
+            num_rows = len(token_stream) // seq_len
+            leftover = token_stream[num_rows * seq_len :]
+            if num_rows == 0:
+                continue
+            rows = np.empty((num_rows, seq_len + 1), dtype=np.int32)
+            rows[:, 0] = bos
+            rows[:, 1:] = token_stream[: num_rows * seq_len].reshape(num_rows, seq_len)
+            yield rows
+
+
+def batch_prompts(
+    data: Iterable[str],
+    model: HookedTransformer,
+    seq_len: int,
+    output_path: str | None = None,
+    tokenize_batch_size: int = 1000,
+    num_workers: int = 4,
+    shuffle_chunk_size: int = 2**16,
+) -> Int[Tensor, "rows seq_len_plus_bos"]:
+    """Tokenize data into a shuffled int32 tensor of [BOS] + seq_len rows.
+
+    If output_path is given the rows are written to disk instead of being held in memory: the packed rows are appended
+    to a temporary file as they are produced, then gathered through a random permutation into an .npy file at output_path,
+    shuffle_chunk_size rows at a time. The returned tensor is backed by that memory-mapped file."""
+    if output_path is None:
+        packed = np.concatenate(list(tqdm(iterate_packed_rows(data, model, seq_len, tokenize_batch_size, num_workers))))
+        return torch.from_numpy(packed)[torch.randperm(len(packed))]
+
+    unshuffled_path = f"{output_path}.unshuffled"
+    num_rows = 0
+    with open(unshuffled_path, "wb") as f:
+        for rows in tqdm(iterate_packed_rows(data, model, seq_len, tokenize_batch_size, num_workers)):
+            rows.tofile(f)
+            num_rows += len(rows)
+
+    unshuffled = np.memmap(unshuffled_path, dtype=np.int32, mode="r", shape=(num_rows, seq_len + 1))
+    packed = np.lib.format.open_memmap(output_path, mode="w+", dtype=np.int32, shape=(num_rows, seq_len + 1))
+    permutation = torch.randperm(num_rows).numpy()
+    for i in tqdm(range(0, num_rows, shuffle_chunk_size)):
+        # Sorting the gathered indices keeps the reads from the unshuffled file mostly sequential
+        indices = permutation[i : i + shuffle_chunk_size]
+        order = np.argsort(indices)
+        chunk = np.empty((len(indices), seq_len + 1), dtype=np.int32)
+        chunk[order] = unshuffled[indices[order]]
+        packed[i : i + len(indices)] = chunk
+    packed.flush()
+    del unshuffled
+    os.remove(unshuffled_path)
+    return torch.from_numpy(packed)
 
 def get_encoder_feature_frequencies(data: list[str], model: HookedTransformer, encoder: AutoEncoder, cfg: AutoEncoderConfig):
     num_feature_activations = torch.zeros(encoder.d_hidden).to(get_device())
@@ -251,9 +424,7 @@ def get_encoder_feature_frequencies(data: list[str], model: HookedTransformer, e
     total_tokens = 0
     for prompt in tqdm(data):
         tokens = model.to_tokens(prompt)
-        _, cache = model.run_with_cache(
-            tokens, names_filter=f"blocks.{cfg.layer}.{cfg.act_name}"
-            )
+        cache = haystack_utils.get_truncated_cache(tokens, model, f"blocks.{cfg.layer}.{cfg.act_name}")
         acts = cache[f"blocks.{cfg.layer}.{cfg.act_name}"].squeeze(0)
         _, _, mid_acts, _, _ = encoder(acts)
         num_feature_activations = num_feature_activations + (mid_acts>0).sum(dim=0)
@@ -272,9 +443,7 @@ def get_encoder_feature_frequencies(data: list[str], model: HookedTransformer, e
 @torch.no_grad()
 def evaluate_autoencoder_reconstruction(autoencoder: AutoEncoder, encoded_hook_name: str, data: list[str], model: HookedTransformer, reconstruction_loss_only: bool = False, show_tqdm=True):
     def encode_activations_hook(value, hook):
-        value = value.squeeze(0)
-        _, x_reconstruct, _, _, _ = autoencoder(value)
-        return x_reconstruct.unsqueeze(0)
+        return autoencoder.reconstruct(value)
     reconstruct_hooks = [(encoded_hook_name, encode_activations_hook)]
 
     def zero_ablate_hook(value, hook):
@@ -351,11 +520,7 @@ def train_autoencoder_evaluate_autoencoder_reconstruction(autoencoder: AutoEncod
 def batched_reconstruction_loss(encoder: AutoEncoder, encoded_hook_name: str, data: list[str], model: HookedTransformer, batch_size: int):
     """ For some reason slower than non batched? """
     def encode_activations_hook(value, hook):
-        current_batch_size = value.shape[0]
-        value = einops.rearrange(value, "b s d -> (b s) d")
-        _, x_reconstruct, _, _, _ = encoder(value)
-        x_reconstruct = einops.rearrange(x_reconstruct, "(b s) d -> b s d", b=current_batch_size)
-        return x_reconstruct
+        return encoder.reconstruct(value)
     reconstruct_hooks = [(encoded_hook_name, encode_activations_hook)]
 
     losses = []
@@ -394,7 +559,7 @@ def encoder_dla_batched(
     encoder_hook_point = f"blocks.{cfg.layer}.{cfg.act_name}"
 
     batch_dim, seq_len = tokens.shape
-    _, cache = model.run_with_cache(tokens)
+    cache = haystack_utils.get_truncated_cache(tokens, model, encoder_hook_point)
     mlp_activations = cache[encoder_hook_point][:, :-1]
     _, _, mid_acts, _, _ = encoder(mlp_activations)
 
@@ -506,9 +671,7 @@ def get_encode_activations_hook(
     encoder: AutoEncoder, encoder_neuron, cfg: AutoEncoderConfig, pos=-1
 ):
     def encode_activations_hook(value, hook):
-        _, x_reconstruct, acts, _, _ = encoder(value[:, pos])
-        feature_activations = acts[:, encoder_neuron]
-        value[:, pos] = x_reconstruct
+        value[:, pos] = encoder.reconstruct(value[:, pos])
         return value
 
     return [(cfg.encoder_hook_point, encode_activations_hook)]
@@ -604,7 +767,7 @@ def print_direction_activations(
     threshold=0,
 ):
     for prompt in data:
-        _, cache = model.run_with_cache(prompt, names_filter=cfg.encoder_hook_point)
+        cache = haystack_utils.get_truncated_cache(prompt, model, cfg.encoder_hook_point)
         acts = cache[cfg.encoder_hook_point].squeeze(0)
         _, _, mid_acts, _, _ = encoder(acts)
         neuron_act = mid_acts[:, encoder_neuron]
@@ -626,7 +789,7 @@ def get_context_effect_on_feature_activations(
     context_active_loss = (
         model(tokens, return_type="loss", loss_per_token=True)[:, -1].mean().item()
     )
-    _, cache = model.run_with_cache(tokens, names_filter=cfg.encoder_hook_point)
+    cache = haystack_utils.get_truncated_cache(tokens, model, cfg.encoder_hook_point)
     acts = cache[cfg.encoder_hook_point]
     _, _, mid_acts, _, _ = encoder(acts)
     feature_activation_context_active = mid_acts[:, -2, encoder_neuron].mean().item()
@@ -636,7 +799,7 @@ def get_context_effect_on_feature_activations(
             model(tokens, return_type="loss", loss_per_token=True)[:, -1].mean().item()
         )
 
-        _, cache = model.run_with_cache(tokens, names_filter=cfg.encoder_hook_point)
+        cache = haystack_utils.get_truncated_cache(tokens, model, cfg.encoder_hook_point)
         acts = cache[cfg.encoder_hook_point]
         _, _, mid_acts, _, _ = encoder(acts)
         feature_activation_context_inactive = (
@@ -668,11 +831,11 @@ def get_encoder_token_reconstruction_losses(
     cfg: AutoEncoderConfig,
 ):
     # Set all features to context active or inactive
-    _, cache = model.run_with_cache(tokens, names_filter=cfg.encoder_hook_point)
+    cache = haystack_utils.get_truncated_cache(tokens, model, cfg.encoder_hook_point)
     acts_active = cache[cfg.encoder_hook_point][:, -2]
 
     with model.hooks(deactivate_context_hook):
-        _, cache = model.run_with_cache(tokens, names_filter=cfg.encoder_hook_point)
+        cache = haystack_utils.get_truncated_cache(tokens, model, cfg.encoder_hook_point)
         acts_inactive = cache[cfg.encoder_hook_point][:, -2]
 
     def activate_feature_hook(value, hook):
@@ -775,9 +938,7 @@ def get_encoder_feature_reconstruction_losses(
 
 def generate_with_encoder(model: HookedTransformer, autoencoder: AutoEncoder, cfg: AutoEncoderConfig, input: str, k=20):
     def encode_activations_hook(value, hook):
-        value = value.squeeze(0)
-        _, x_reconstruct, _, _, _ = autoencoder(value)
-        return x_reconstruct.unsqueeze(0)
+        return autoencoder.reconstruct(value)
     reconstruct_hooks = [(f'blocks.{cfg.layer}.{cfg.act_name}', encode_activations_hook)]
 
     with model.hooks(reconstruct_hooks):
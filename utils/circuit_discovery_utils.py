@@ -31,7 +31,7 @@ from typing import Literal
 from transformer_lens.utils import test_prompt
 
 from sparse_coding.train_autoencoder import AutoEncoder
-from utils.autoencoder_utils import custom_forward, AutoEncoderConfig, evaluate_autoencoder_reconstruction, get_encoder_feature_frequencies, load_encoder, generate_with_encoder
+from utils.autoencoder_utils import custom_forward, AutoEncoderConfig, eval_direction_tokens_global, evaluate_autoencoder_reconstruction, get_encoder_feature_frequencies, load_encoder, generate_with_encoder
 import utils.haystack_utils as haystack_utils
 from utils.plotting_utils import line
 
@@ -132,18 +132,3 @@ def eval_direction_tokens(direction, max_activations, max_activation_token_indic
             break
     token_counts = Counter(activating_tokens)
     return token_counts, threshold
-
-def eval_direction_tokens_global(max_activations, prompts, model, encoder, cfg, percentage_threshold = 0.25):
-    max_activation_value = max_activations.max(dim=0)[0]
-    threshold_per_direction = max_activation_value * percentage_threshold
-    token_wise_activations = torch.zeros((encoder.d_hidden, model.cfg.d_vocab), dtype=torch.int32)
-
-    for i, prompt in tqdm(enumerate(prompts), total=len(prompts)):
-        tokens = model.to_tokens(prompt).flatten().cpu()
-        activations = get_acts(prompt, model, encoder, cfg).cpu()
-        num_tokens = activations.shape[0]
-        for position in range(10, num_tokens):
-            valid_directions = torch.argwhere(activations[position] > threshold_per_direction).flatten().cpu()
-            if len(valid_directions) > 0:
-                token_wise_activations[valid_directions, tokens[position]] += 1
-    return token_wise_activations
\ No newline at end of file
@@ -0,0 +1,159 @@
+import os
+from typing import Literal
+
+import torch
+from torch import Tensor
+from jaxtyping import Int, Float
+from tqdm.auto import tqdm
+from transformer_lens import HookedTransformer
+
+import utils.haystack_utils as haystack_utils
+from utils.autoencoder_utils import AutoEncoderConfig
+from sparse_coding.autoencoder import AutoEncoder
+
+
+# Fraction of a feature's max activation below which the non-top modes of get_top_activating_examples_for_direction look for examples
+MODE_THRESHOLDS = {"upper": 2 / 3, "middle": 1 / 3, "lower": 1 / 10}
+
+
+class FeatureExampleIndex:
+    """
+    Keeps the k strongest (value, prompt_id, token_pos) examples of every autoencoder feature, where each prompt contributes its
+    max activation per feature like get_max_activations. Besides the overall top k, every feature has k slots per activation bucket.
+    Buckets are geometric, bins_per_octave per doubling of the activation starting at min_activation, so examples at a fraction of
+    a feature's max activation are still available after the top k has moved past them.
+
+    The examples are stored in (d_hidden, 1 + n_buckets, k) arrays, slot 0 being the overall top k, and are updated with one topk
+    over each batch of prompts. New prompt shards can be added to a saved index at any time, prompt ids continue from num_prompts.
+    """
+
+    def __init__(self, d_hidden: int, k: int = 20, n_buckets: int = 24, min_activation: float = 0.01, bins_per_octave: int = 2):
+        self.d_hidden = d_hidden
+        self.k = k
+        self.n_buckets = n_buckets
+        self.min_activation = min_activation
+        self.bins_per_octave = bins_per_octave
+        self.num_prompts = 0
+        self.values = torch.zeros(d_hidden, 1 + n_buckets, k)
+        self.prompt_ids = torch.full((d_hidden, 1 + n_buckets, k), -1, dtype=torch.int32)
+        self.positions = torch.zeros(d_hidden, 1 + n_buckets, k, dtype=torch.int32)
+
+    def get_bucket(self, values: Float[Tensor, "..."]) -> Int[Tensor, "..."]:
+        bucket = torch.log2(values.clamp(min=self.min_activation) / self.min_activation) * self.bins_per_octave
+        return bucket.floor().long().clamp(max=self.n_buckets - 1)
+
+    @torch.no_grad()
+    def add_activations(
+        self, max_activations: Float[Tensor, "n_prompts d_hidden"], max_positions: Int[Tensor, "n_prompts d_hidden"]
+    ):
+        """Merge the per prompt max activations of the next n_prompts prompts into the index"""
+        max_activations = max_activations.float().cpu().T  # d_hidden n_prompts
+        max_positions = max_positions.to(torch.int32).cpu().T
+        n_prompts = max_activations.shape[1]
+        prompt_ids = torch.arange(self.num_prompts, self.num_prompts + n_prompts, dtype=torch.int32).expand(self.d_hidden, -1)
+
+        # Candidates for every slot, zeroed where the activation is outside the slot's bucket
+        in_bucket = self.get_bucket(max_activations).unsqueeze(1) == torch.arange(self.n_buckets).view(1, -1, 1)
+        in_slot = torch.cat([torch.ones_like(in_bucket[:, :1]), in_bucket], dim=1) & (max_activations > 0).unsqueeze(1)
+        candidate_values = torch.where(in_slot, max_activations.unsqueeze(1), 0)
+
+        values = torch.cat([self.values, candidate_values], dim=-1)
+        positions = torch.cat([self.positions, max_positions.unsqueeze(1).expand_as(candidate_values)], dim=-1)
+        ids = torch.cat([self.prompt_ids, torch.where(in_slot, prompt_ids.unsqueeze(1), -1)], dim=-1)
+        self.values, index = values.topk(self.k, dim=-1)
+        self.positions = positions.gather(-1, index)
+        self.prompt_ids = ids.gather(-1, index)
+        self.num_prompts += n_prompts
+
+    @torch.no_grad()
+    def add_prompts(
+        self, prompts: list[str], model: HookedTransformer, encoder: AutoEncoder, cfg: AutoEncoderConfig, batch_size: int = 16
+    ):
+        """Run the next shard of prompts in right-padded batches and add their max activation per feature. The last position of
+        each prompt is excluded, as in get_max_activations."""
+        for i in tqdm(range(0, len(prompts), batch_size)):
+            tokens = model.to_tokens(prompts[i : i + batch_size])
+            active_tokens = haystack_utils.get_active_token_mask(tokens, model)
+            active_tokens[torch.arange(tokens.shape[0]), active_tokens.sum(dim=1) - 1] = False
+            cache = haystack_utils.get_truncated_cache(tokens, model, cfg.encoder_hook_point)
+            acts = cache[cfg.encoder_hook_point]
+            mid_acts = encoder.encode(acts.reshape(-1, acts.shape[-1]))
+            mid_acts = mid_acts.reshape(*tokens.shape, -1).masked_fill(~active_tokens.unsqueeze(-1), 0)
+            max_activations, max_positions = mid_acts.max(dim=1)
+            self.add_activations(max_activations, max_positions)
+
+    def get_examples(
+        self, direction: int, k: int = 10, mode: Literal["lower", "middle", "upper", "top"] = "top"
+    ) -> tuple[Int[Tensor, "k"], Int[Tensor, "k"], Float[Tensor, "k"]]:
+        """Prompt ids, token positions and activations of the strongest examples of a direction. The non-top modes return the
+        strongest retained bucket examples at or below a fraction of the direction's max activation, see MODE_THRESHOLDS."""
+        values, prompt_ids, positions = self.values[direction], self.prompt_ids[direction], self.positions[direction]
+        if mode == "top":
+            values, prompt_ids, positions = values[0], prompt_ids[0], positions[0]
+        else:
+            # Examples in the top slot are also kept in their bucket, so only the bucket slots are searched
+            threshold = values[0, 0] * MODE_THRESHOLDS[mode]
+            values, prompt_ids, positions = values[1:].flatten(), prompt_ids[1:].flatten(), positions[1:].flatten()
+            values = torch.where(values <= threshold, values, 0)
+            values, index = values.topk(min(self.k, len(values)))
+            prompt_ids, positions = prompt_ids[index], positions[index]
+        active = values > 0
+        return prompt_ids[active][:k], positions[active][:k], values[active][:k]
+
+    def get_top_activating_examples_for_direction(
+        self, prompts: list[str], direction: int, k: int = 10, mode: Literal["lower", "middle", "upper", "top"] = "top"
+    ) -> tuple[list[str], Int[Tensor, "k"]]:
+        """Same return values as autoencoder_utils.get_top_activating_examples_for_direction, for the prompts the index was built on"""
+        prompt_ids, positions, _ = self.get_examples(direction, k, mode)
+        return [prompts[i] for i in prompt_ids], positions
+
+    def state_dict(self) -> dict:
+        return {
+            "k": self.k,
+            "n_buckets": self.n_buckets,
+            "min_activation": self.min_activation,
+            "bins_per_octave": self.bins_per_octave,
+            "num_prompts": self.num_prompts,
+            "values": self.values,
+            "prompt_ids": self.prompt_ids,
+            "positions": self.positions,
+        }
+
+    def save(self, path: str):
+        torch.save(self.state_dict(), path)
+
+    @classmethod
+    def load(cls, path: str) -> "FeatureExampleIndex":
+        state = torch.load(path)
+        index = cls(
+            state["values"].shape[0], state["k"], state["n_buckets"], state["min_activation"], state["bins_per_octave"]
+        )
+        index.num_prompts = state["num_prompts"]
+        index.values = state["values"]
+        index.prompt_ids = state["prompt_ids"]
+        index.positions = state["positions"]
+        return index
+
+
+def get_feature_example_index(
+    encoder: AutoEncoder,
+    cfg: AutoEncoderConfig,
+    encoder_name: str,
+    prompts: list[str],
+    model: HookedTransformer,
+    save_path="/workspace",
+    k: int = 20,
+    batch_size: int = 16,
+) -> FeatureExampleIndex:
+    """Index version of autoencoder_utils.get_activations. A saved index is loaded and only extended with the prompts it doesn't
+    cover yet, so prompts can be appended to in shards."""
+    path = f"{save_path}/data/{encoder_name}_feature_example_index.pt"
+    if os.path.exists(path):
+        index = FeatureExampleIndex.load(path)
+    else:
+        index = FeatureExampleIndex(encoder.d_hidden, k=k)
+    if index.num_prompts < len(prompts):
+        index.add_prompts(prompts[index.num_prompts :], model, encoder, cfg, batch_size=batch_size)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        index.save(path)
+    return index
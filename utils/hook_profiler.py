@@ -0,0 +1,141 @@
+import json
+import time
+import warnings
+from contextlib import nullcontext
+from functools import partial
+from typing import Callable
+
+import torch
+import pandas as pd
+from transformer_lens.hook_points import HookPoint
+
+
+def get_hook_fn_name(fn: Callable) -> str:
+    if isinstance(fn, partial):
+        return get_hook_fn_name(fn.func)
+    return getattr(fn, "__qualname__", repr(fn))
+
+
+class HookProfiler:
+    """
+    Opt-in profiler for forward hooks. Hooks are wrapped either explicitly with wrap_hooks, or implicitly for every hook that
+    is added to any HookPoint while the profiler is entered, which also covers hooks built inside helpers such as
+    haystack_utils.get_direct_effect:
+
+        profiler = HookProfiler()
+        with profiler:
+            haystack_utils.get_direct_effect(prompts, model, ablation_hooks, activation_hooks)
+        profiler.summary()
+
+    Every hook call records its wall time, the activation sizes and, on cuda, the memory it allocated and the number of
+    host-device syncs it caused. Outputs that are a different tensor than the hook's input are flagged as replaced, which is
+    what cache replay and clone-and-modify hooks do. The device is synchronised around every hook call so time is
+    attributed to the right hook, so absolute model run times are slower while profiling.
+    """
+
+    def __init__(self, count_syncs: bool = True):
+        self.count_syncs = count_syncs
+        self.records = []
+        self.original_add_hook = None
+
+    def wrap_hook(self, fn: Callable) -> Callable:
+        profiler = self
+
+        def profiled_hook(value, hook: HookPoint):
+            on_cuda = isinstance(value, torch.Tensor) and value.is_cuda
+            count_syncs = on_cuda and profiler.count_syncs
+            if on_cuda:
+                torch.cuda.synchronize()
+                memory_before = torch.cuda.memory_allocated()
+                torch.cuda.reset_peak_memory_stats()
+
+            with warnings.catch_warnings(record=True) if count_syncs else nullcontext() as caught:
+                if count_syncs:
+                    warnings.simplefilter("always")
+                    torch.cuda.set_sync_debug_mode("warn")
+                start = time.perf_counter()
+                try:
+                    output = fn(value, hook=hook)
+                    if on_cuda:
+                        torch.cuda.synchronize()
+                finally:
+                    end = time.perf_counter()
+                    if count_syncs:
+                        torch.cuda.set_sync_debug_mode("default")
+
+            is_tensor = isinstance(value, torch.Tensor)
+            profiler.records.append({
+                "hook_name": hook.name,
+                "fn": get_hook_fn_name(fn),
+                "start": start,
+                "seconds": end - start,
+                "shape": tuple(value.shape) if is_tensor else None,
+                "activation_mb": value.numel() * value.element_size() / 2**20 if is_tensor else None,
+                "allocated_mb": (torch.cuda.memory_allocated() - memory_before) / 2**20 if on_cuda else None,
+                "peak_allocated_mb": (torch.cuda.max_memory_allocated() - memory_before) / 2**20 if on_cuda else None,
+                "syncs": sum("synchronizing" in str(warning.message) for warning in caught) if count_syncs else None,
+                "replaced": isinstance(output, torch.Tensor) and is_tensor and output.data_ptr() != value.data_ptr(),
+            })
+            return output
+
+        profiled_hook.__qualname__ = get_hook_fn_name(fn)
+        return profiled_hook
+
+    def wrap_hooks(self, fwd_hooks: list[tuple[str | Callable, Callable]]) -> list[tuple[str | Callable, Callable]]:
+        return [(name, self.wrap_hook(fn)) for name, fn in fwd_hooks]
+
+    def __enter__(self):
+        self.original_add_hook = HookPoint.add_hook
+        original_add_hook = self.original_add_hook
+        profiler = self
+
+        def add_hook(hook_point: HookPoint, hook: Callable, *args, **kwargs):
+            return original_add_hook(hook_point, profiler.wrap_hook(hook), *args, **kwargs)
+
+        HookPoint.add_hook = add_hook
+        return self
+
+    def __exit__(self, *exc):
+        HookPoint.add_hook = self.original_add_hook
+        self.original_add_hook = None
+
+    def reset(self):
+        self.records = []
+
+    def get_records(self) -> pd.DataFrame:
+        return pd.DataFrame(self.records)
+
+    def summary(self) -> pd.DataFrame:
+        """Per (hook_name, fn) totals, sorted by total time"""
+        df = self.get_records()
+        if len(df) == 0:
+            return df
+        summary = df.groupby(["hook_name", "fn"]).agg(
+            calls=("seconds", "size"),
+            total_ms=("seconds", lambda x: x.sum() * 1000),
+            mean_ms=("seconds", lambda x: x.mean() * 1000),
+            activation_mb=("activation_mb", "max"),
+            allocated_mb=("allocated_mb", "sum"),
+            peak_allocated_mb=("peak_allocated_mb", "max"),
+            syncs=("syncs", "sum"),
+            replaced=("replaced", "mean"),
+        )
+        return summary.sort_values("total_ms", ascending=False).reset_index()
+
+    def save_chrome_trace(self, path: str):
+        """Write the hook calls as complete events for chrome://tracing or Perfetto"""
+        t0 = min((record["start"] for record in self.records), default=0)
+        events = [
+            {
+                "name": f"{record['hook_name']}: {record['fn']}",
+                "ph": "X",
+                "ts": (record["start"] - t0) * 1e6,
+                "dur": record["seconds"] * 1e6,
+                "pid": 0,
+                "tid": 0,
+                "args": {key: value for key, value in record.items() if key not in ["start", "seconds"]},
+            }
+            for record in self.records
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events}, f, default=str)
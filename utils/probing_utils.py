@@ -17,6 +17,7 @@ from sklearn.metrics import f1_score, matthews_corrcoef
 from sklearn.utils import shuffle
 
 from utils.hook_utils import save_activation
+import utils.haystack_utils as haystack_utils
 
 pio.renderers.default = "notebook_connected+notebook"
 device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -31,12 +32,7 @@ def get_act_dimension(model, prompt, activation_hook_name, activation_slice):
     return prompt_activations.shape[-1]
 
 def get_new_word_labels(model: HookedTransformer, tokens: torch.Tensor) -> np.ndarray[bool]:
-    prompt_labels = []
-    for i in range(tokens.shape[0] - 1):
-        next_token_str = model.to_single_str_token(tokens[i + 1].item())
-        next_is_space = next_token_str[0] in [" ", ",", ".", ":", ";", "!", "?"] # [" "] # 
-        prompt_labels.append(next_is_space)
-    return np.array(prompt_labels)
+    return haystack_utils.get_next_token_punctuation_mask(tokens, model, fill_last_pos=False).cpu().numpy()
 
 def get_new_word_labels_and_activations(
     model: HookedTransformer, 
@@ -84,7 +80,8 @@ def get_new_word_labels_and_resid_activations(
     num_class_examples=20_000, scale_x=True
 ) -> tuple[defaultdict, np.ndarray]:
     '''Get activations and labels for predicting word end from activation'''
-    _, cache = model.run_with_cache(model.to_tokens(german_data[0])[0])
+    resid_names = haystack_utils.get_decompose_resid_names(model)
+    cache = haystack_utils.get_truncated_cache(model.to_tokens(german_data[0])[0], model, resid_names)
     resid = cache.decompose_resid(apply_ln=False)[:, 0, :-1, :]
     
     positive_activations = {i: np.empty((num_class_examples, model.cfg.d_model)) for i in range(resid.shape[0])}
@@ -94,7 +91,7 @@ def get_new_word_labels_and_resid_activations(
     for prompt in german_data:
         tokens = model.to_tokens(prompt)[0]
         labels = get_new_word_labels(model, tokens)
-        _, cache = model.run_with_cache(tokens)
+        cache = haystack_utils.get_truncated_cache(tokens, model, resid_names)
         resid = cache.decompose_resid(apply_ln=False)[:, 0, :-1, :]
 
         for i in range(resid.shape[0]):
@@ -133,7 +130,7 @@ def get_is_german_labels_and_resid_activations(
     start = 0
     for prompt in german_data:
         tokens = model.to_tokens(prompt)[0]
-        _, cache = model.run_with_cache(tokens)
+        cache = haystack_utils.get_truncated_cache(tokens, model, f'blocks.{layer}.hook_resid_pre')
         acts = cache[f'blocks.{layer}.hook_resid_pre'][0].cpu().numpy()
 
 
@@ -148,7 +145,7 @@ def get_is_german_labels_and_resid_activations(
     start = 0
     for prompt in english_data:
         tokens = model.to_tokens(prompt)[0]
-        _, cache = model.run_with_cache(tokens)
+        cache = haystack_utils.get_truncated_cache(tokens, model, f'blocks.{layer}.hook_resid_pre')
         acts = cache[f'blocks.{layer}.hook_resid_pre'][0].cpu().numpy()
 
         if start < num_class_examples:
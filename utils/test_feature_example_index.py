@@ -0,0 +1,67 @@
+import sys
+sys.path.append("../")  # Add the parent directory to the system path
+
+import torch
+
+from utils.autoencoder_utils import get_top_activating_examples_for_direction
+from utils.feature_example_index import FeatureExampleIndex, MODE_THRESHOLDS
+
+
+def get_max_activations(n_prompts=60, d_hidden=6, max_position=30):
+    generator = torch.Generator().manual_seed(0)
+    # Continuous values, so there are no ties between nonzero activations, with about a third of the prompts inactive per feature
+    max_activations = torch.relu(torch.randn(n_prompts, d_hidden, generator=generator) * 2 + 1)
+    max_activations[0] = 0
+    max_positions = torch.randint(0, max_position, (n_prompts, d_hidden), generator=generator)
+    return max_activations, max_positions
+
+
+def test_top_examples_match_get_top_activating_examples_for_direction():
+    max_activations, max_positions = get_max_activations()
+    prompts = [f"prompt {i}" for i in range(max_activations.shape[0])]
+    index = FeatureExampleIndex(max_activations.shape[1], k=20)
+    index.add_activations(max_activations, max_positions)
+
+    for direction in range(max_activations.shape[1]):
+        expected_prompts, expected_positions = get_top_activating_examples_for_direction(prompts, direction, max_activations, max_positions, k=10)
+        top_prompts, positions = index.get_top_activating_examples_for_direction(prompts, direction, k=10)
+        assert top_prompts == expected_prompts
+        torch.testing.assert_close(positions.long(), expected_positions.long())
+
+
+def test_incremental_add_activations_matches_single_pass(tmp_path):
+    max_activations, max_positions = get_max_activations()
+    index = FeatureExampleIndex(max_activations.shape[1], k=5, n_buckets=8)
+    index.add_activations(max_activations, max_positions)
+
+    incremental_index = FeatureExampleIndex(max_activations.shape[1], k=5, n_buckets=8)
+    for start, end in [(0, 7), (7, 30), (30, 60)]:
+        incremental_index.add_activations(max_activations[start:end], max_positions[start:end])
+    incremental_index.save(tmp_path / "index.pt")
+    incremental_index = FeatureExampleIndex.load(tmp_path / "index.pt")
+
+    assert incremental_index.num_prompts == index.num_prompts == max_activations.shape[0]
+    torch.testing.assert_close(incremental_index.values, index.values)
+    # Empty slots have no example, so only the filled slots have to agree
+    filled = index.values > 0
+    torch.testing.assert_close(incremental_index.prompt_ids[filled], index.prompt_ids[filled])
+    torch.testing.assert_close(incremental_index.positions[filled], index.positions[filled])
+    assert (index.prompt_ids[~filled] == -1).all()
+
+
+def test_mode_examples_match_brute_force():
+    max_activations, max_positions = get_max_activations()
+    # Every slot can hold all prompts, so no example is evicted from its bucket
+    index = FeatureExampleIndex(max_activations.shape[1], k=max_activations.shape[0])
+    index.add_activations(max_activations, max_positions)
+
+    for direction in range(max_activations.shape[1]):
+        activations = max_activations[:, direction]
+        for mode, fraction in MODE_THRESHOLDS.items():
+            prompt_ids, positions, values = index.get_examples(direction, k=10, mode=mode)
+            candidates = torch.where(activations <= activations.max() * fraction, activations, 0)
+            expected_values, expected_prompt_ids = candidates.topk(10)
+            active = expected_values > 0
+            torch.testing.assert_close(values, expected_values[active])
+            torch.testing.assert_close(prompt_ids.long(), expected_prompt_ids[active])
+            torch.testing.assert_close(positions.long(), max_positions[expected_prompt_ids[active], direction])
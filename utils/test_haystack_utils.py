@@ -0,0 +1,178 @@
+import sys
+sys.path.append("../")  # Add the parent directory to the system path
+
+import torch
+from transformer_lens import HookedTransformer
+
+import utils.haystack_utils as haystack_utils
+import utils.hook_utils as hook_utils
+
+
+TEST_PROMPTS = ["Die Präsidentin der Europäischen Union", "Als nächster Punkt folgt die", "chicken soup"]
+DEACTIVATED_COMPONENTS = ("blocks.4.hook_attn_out", "blocks.5.hook_attn_out", "blocks.4.hook_mlp_out")
+ACTIVATED_COMPONENTS = ("blocks.5.hook_mlp_out",)
+
+
+def get_model():
+    return HookedTransformer.from_pretrained("EleutherAI/pythia-70m", fold_ln=True, device="cuda")
+
+
+def get_freeze_hooks(cache, names):
+    def freeze_hook(value, hook):
+        return cache[hook.name]
+    return [(name, freeze_hook) for name in names]
+
+
+def get_serial_direct_effect(tokens, model, context_ablation_hooks, context_activation_hooks, return_type="loss"):
+    """The four runs of get_direct_effect as separate forward passes with cached patches"""
+    with model.hooks(fwd_hooks=context_activation_hooks):
+        original_metric = model(tokens, return_type=return_type, loss_per_token=True)
+    with model.hooks(fwd_hooks=context_ablation_hooks):
+        ablated_metric, ablated_cache = model.run_with_cache(tokens, return_type=return_type, loss_per_token=True)
+    with model.hooks(fwd_hooks=context_activation_hooks + get_freeze_hooks(ablated_cache, DEACTIVATED_COMPONENTS)):
+        context_and_activated_metric, activated_cache = model.run_with_cache(tokens, return_type=return_type, loss_per_token=True)
+    patch_hooks = get_freeze_hooks(activated_cache, ACTIVATED_COMPONENTS) + get_freeze_hooks(ablated_cache, DEACTIVATED_COMPONENTS)
+    with model.hooks(fwd_hooks=context_ablation_hooks + patch_hooks):
+        only_activated_metric = model(tokens, return_type=return_type, loss_per_token=True)
+    return original_metric, ablated_metric, context_and_activated_metric, only_activated_metric
+
+
+def test_variant_metrics_match_serial_runs():
+    model = get_model()
+    tokens = model.to_tokens(TEST_PROMPTS)
+    ablation_hook = hook_utils.get_ablate_neuron_hook(3, 669, 0.0, 'post')
+    activation_hook = hook_utils.get_ablate_neuron_hook(3, 669, 3.0, 'post')
+    variants = {"original": [], "ablated": [ablation_hook], "activated": [activation_hook], "patched": [ablation_hook]}
+    patches = {"patched": {"blocks.4.hook_attn_out": "activated"}}
+
+    # Batches of 2 and 1 prompts, so the patches copy multi-row slices
+    losses = haystack_utils.get_variant_metrics(tokens, model, variants, patches, batch_size=2)
+    assert losses.shape == (len(variants), len(TEST_PROMPTS), tokens.shape[1] - 1)
+
+    original_loss = model(tokens, return_type="loss", loss_per_token=True)
+    with model.hooks([ablation_hook]):
+        ablated_loss = model(tokens, return_type="loss", loss_per_token=True)
+    with model.hooks([activation_hook]):
+        activated_loss, activated_cache = model.run_with_cache(tokens, return_type="loss", loss_per_token=True)
+    with model.hooks([ablation_hook] + get_freeze_hooks(activated_cache, ["blocks.4.hook_attn_out"])):
+        patched_loss = model(tokens, return_type="loss", loss_per_token=True)
+    for i, expected_loss in enumerate([original_loss, ablated_loss, activated_loss, patched_loss]):
+        torch.testing.assert_close(losses[i], expected_loss, atol=1e-4, rtol=0.0)
+
+    # Hooks of one variant never touch the rows of another
+    with model.hooks(haystack_utils.get_variant_hooks({"original": [], "ablated": [ablation_hook]}, tokens.shape[0])):
+        _, cache = model.run_with_cache(tokens.repeat(2, 1), names_filter="blocks.3.mlp.hook_post")
+    assert (cache["blocks.3.mlp.hook_post"][tokens.shape[0]:, :, 669] == 0).all()
+    torch.testing.assert_close(cache["blocks.3.mlp.hook_post"][:tokens.shape[0]], model.run_with_cache(tokens)[1]["blocks.3.mlp.hook_post"])
+
+
+def test_direct_effect_matches_serial_runs():
+    model = get_model()
+    tokens = model.to_tokens(TEST_PROMPTS)
+    ablation_hooks = [hook_utils.get_ablate_neuron_hook(3, 669, 0.0, 'post')]
+    activation_hooks = [hook_utils.get_ablate_neuron_hook(3, 669, 3.0, 'post')]
+
+    losses = haystack_utils.get_direct_effect(tokens, model, ablation_hooks, activation_hooks, pos=None,
+                                              deactivated_components=DEACTIVATED_COMPONENTS, activated_components=ACTIVATED_COMPONENTS)
+    expected_losses = get_serial_direct_effect(tokens, model, ablation_hooks, activation_hooks)
+    for loss, expected_loss in zip(losses, expected_losses):
+        torch.testing.assert_close(loss, expected_loss, atol=1e-4, rtol=0.0)
+
+    last_losses = haystack_utils.get_direct_effect(tokens, model, ablation_hooks, activation_hooks, pos=-1)
+    for loss, expected_loss in zip(last_losses, expected_losses):
+        torch.testing.assert_close(loss, expected_loss[:, -1], atol=1e-4, rtol=0.0)
+
+
+def test_context_effect_matches_serial_runs():
+    model = get_model()
+    tokens = model.to_tokens(TEST_PROMPTS)
+    ablation_hooks = [hook_utils.get_ablate_neuron_hook(3, 669, 0.0, 'post')]
+    activation_hooks = [hook_utils.get_ablate_neuron_hook(3, 669, 3.0, 'post')]
+    downstream_components = ["blocks.4.hook_mlp_out", "blocks.5.hook_mlp_out"]
+
+    losses = haystack_utils.get_context_effect(tokens, model, ablation_hooks, activation_hooks, downstream_components)
+
+    original_loss = model(tokens, return_type="loss", loss_per_token=True)
+    with model.hooks(fwd_hooks=activation_hooks):
+        activated_loss, activated_cache = model.run_with_cache(tokens, return_type="loss", loss_per_token=True)
+    with model.hooks(fwd_hooks=ablation_hooks):
+        ablated_loss, ablated_cache = model.run_with_cache(tokens, return_type="loss", loss_per_token=True)
+    with model.hooks(fwd_hooks=activation_hooks + get_freeze_hooks(ablated_cache, downstream_components)):
+        direct_effect_loss = model(tokens, return_type="loss", loss_per_token=True)
+    with model.hooks(fwd_hooks=ablation_hooks + get_freeze_hooks(activated_cache, downstream_components)):
+        indirect_effect_loss = model(tokens, return_type="loss", loss_per_token=True)
+    for loss, expected_loss in zip(losses, [original_loss, activated_loss, ablated_loss, direct_effect_loss, indirect_effect_loss]):
+        torch.testing.assert_close(loss, expected_loss, atol=1e-4, rtol=0.0)
+
+
+def test_ablated_performance_matches_serial_runs():
+    model = get_model()
+    hook = hook_utils.get_ablate_neuron_hook(3, 669, -0.2, 'post')
+
+    original_loss, ablated_loss, percent_increase = haystack_utils.get_ablated_performance(TEST_PROMPTS, model, [hook])
+
+    expected_original_losses = [model(prompt, return_type="loss").item() for prompt in TEST_PROMPTS]
+    with model.hooks([hook]):
+        expected_ablated_losses = [model(prompt, return_type="loss").item() for prompt in TEST_PROMPTS]
+    expected_original_loss = sum(expected_original_losses) / len(TEST_PROMPTS)
+    expected_ablated_loss = sum(expected_ablated_losses) / len(TEST_PROMPTS)
+    torch.testing.assert_close(original_loss, expected_original_loss, atol=1e-4, rtol=0.0)
+    torch.testing.assert_close(ablated_loss, expected_ablated_loss, atol=1e-4, rtol=0.0)
+    torch.testing.assert_close(percent_increase, (expected_ablated_loss - expected_original_loss) / expected_original_loss * 100, atol=1e-2, rtol=0.0)
+
+
+def test_batched_mlp_activations_match_serial_activations():
+    prompts = ["Hi there", "Die Präsidentin der Europäischen Kommission hat heute im Parlament gesprochen.", "The quick brown fox jumps", "chicken soup"]
+    model = get_model()
+    lengths = [model.to_tokens(prompt).shape[1] for prompt in prompts]
+    assert min(lengths) < 5 and max(lengths) > 10
+
+    # The crop end is past the length of the short prompts, so their padding falls inside the crop
+    for kwargs in [dict(mean=True), dict(mean=False), dict(mean=False, pos=-1)]:
+        serial_acts = haystack_utils.get_mlp_activations(prompts, 3, model, context_crop_start=2, context_crop_end=10, **kwargs)
+        batched_acts = haystack_utils.get_mlp_activations(prompts, 3, model, context_crop_start=2, context_crop_end=10, batch_size=3, **kwargs)
+        torch.testing.assert_close(batched_acts, serial_acts, atol=1e-4, rtol=1e-4)
+
+    # The crop start is past the length of the short prompts, which then contribute no activations
+    serial_acts = haystack_utils.get_mlp_activations(prompts, 3, model, context_crop_start=5, mean=False, neurons=torch.tensor([669, 1]))
+    batched_acts = haystack_utils.get_mlp_activations_batched(prompts, 3, model, batch_size=2, context_crop_start=5, mean=False, neurons=torch.tensor([669, 1]))
+    assert serial_acts.shape[0] == sum(max(length - 5, 0) for length in lengths)
+    torch.testing.assert_close(batched_acts, serial_acts, atol=1e-4, rtol=1e-4)
+    batched_mean = haystack_utils.get_mlp_activations_batched(prompts, 3, model, batch_size=2, context_crop_start=5, mean=True, neurons=torch.tensor([669, 1]))
+    torch.testing.assert_close(batched_mean, serial_acts.mean(0), atol=1e-4, rtol=1e-4)
+
+
+def test_and_conditions_match_serial_runs():
+    model = get_model()
+    generator = torch.Generator().manual_seed(0)
+    common_tokens = torch.arange(1000, 1100)
+    prompts = torch.randint(1000, 1100, (6, 9), generator=generator)
+    prompts = torch.cat([torch.full((6, 1), model.tokenizer.bos_token_id), prompts], dim=1).cuda()
+    option = " Vorschlag"
+    answer_token = model.to_tokens(option).flatten()[-1].item()
+    deactivate_hooks = [hook_utils.get_ablate_neuron_hook(3, 669, 0.0, 'post')]
+    activate_hooks = [hook_utils.get_ablate_neuron_hook(3, 669, 3.0, 'post')]
+
+    for type in ["loss", "logits"]:
+        torch.manual_seed(0)
+        result = haystack_utils.compute_and_conditions(prompts, model, option, type, common_tokens, activate_hooks, deactivate_hooks, batch_size=4)
+
+        # The eight get_value calls of the serial implementation, with the same ablated prompts
+        torch.manual_seed(0)
+        token_conditions = {
+            "YY": prompts,
+            "NY": haystack_utils.create_ablation_prompts(prompts, "NYY", common_tokens),
+            "YN": haystack_utils.create_ablation_prompts(prompts, "YNY", common_tokens),
+            "NN": haystack_utils.create_ablation_prompts(prompts, "NNY", common_tokens),
+        }
+        for condition, tokens in token_conditions.items():
+            _, _, _, activated_metric = get_serial_direct_effect(tokens, model, deactivate_hooks, activate_hooks, return_type=type)
+            with model.hooks(fwd_hooks=deactivate_hooks):
+                ablated_metric = model(tokens, return_type=type, loss_per_token=True)
+            if type == "loss":
+                activated_value, ablated_value = activated_metric[:, -1].mean().item(), ablated_metric[:, -1].mean().item()
+            else:
+                activated_value = activated_metric[:, -2, answer_token].mean().item()
+                ablated_value = ablated_metric[:, -2, answer_token].mean().item()
+            torch.testing.assert_close(result[condition + "Y"], activated_value, atol=1e-4, rtol=1e-4)
+            torch.testing.assert_close(result[condition + "N"], ablated_value, atol=1e-4, rtol=1e-4)